@@ -0,0 +1,123 @@
+"""Measures how many stats per second AsynchronousStatsConsumer reads from
+a stats endpoint, and how late the IOLoop runs its callbacks meanwhile.
+
+A fake circusd-stats publishing the stats of *--topics* processes as fast
+as it can runs in its own process. Each mode consumes them for
+*--duration* seconds: one message per callback, bursts decoded in the
+IOLoop, and bursts decoded in a worker thread or process.
+
+Usage::
+
+    python benchmarks/stats_consumer.py --topics 1000 --burst-size 100
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import multiprocessing
+import time
+
+import zmq
+from zmq.eventloop import ioloop
+
+ioloop.install()
+
+from circusweb.stats_client import (AsynchronousStatsConsumer,  # NOQA
+                                    make_executor)
+
+
+ENDPOINT = 'tcp://127.0.0.1:5598'
+
+
+def publish(endpoint, topics):
+    context = zmq.Context()
+    socket = context.socket(zmq.PUB)
+    socket.bind(endpoint)
+    stats = [('stat.watcher-%d.%d' % (i % 10, i),
+              json.dumps({'pid': i, 'cpu': 0.5, 'mem': 1.2, 'age': 30.,
+                          'mem_info1': '10M', 'mem_info2': '20M',
+                          'ctime': '0:00.01', 'nice': 0,
+                          'username': 'circus', 'cmdline': 'sleep 120'}))
+             for i in range(topics)]
+    while True:
+        for topic, stat in stats:
+            socket.send_multipart([topic.encode('utf8'),
+                                   stat.encode('utf8')])
+
+
+def run(loop, duration, burst_size, decoder):
+    dispatched = [0]
+
+    def callback(watcher, subtopic, stat, endpoint):
+        dispatched[0] += 1
+
+    executor = make_executor(decoder)
+    consumer = AsynchronousStatsConsumer(
+        ['stat.'], loop, callback, endpoint=ENDPOINT, burst_size=burst_size,
+        executor=executor)
+
+    # the largest delay of a callback scheduled every 10ms, e.g. a page
+    # request waiting for the stats to be consumed
+    lag = [0]
+    last = [time.time()]
+
+    def tick():
+        now = time.time()
+        lag[0] = max(lag[0], now - last[0] - .01)
+        last[0] = now
+
+    ticker = ioloop.PeriodicCallback(tick, 10, loop)
+
+    def start():
+        consumer.received = 0
+        dispatched[0] = 0
+        last[0] = time.time()
+        ticker.start()
+
+    # leaves the time to the subscription to reach the publisher
+    loop.add_timeout(time.time() + .5, start)
+    loop.add_timeout(time.time() + .5 + duration, loop.stop)
+    loop.start()
+    ticker.stop()
+    consumer.stop()
+    if executor is not None:
+        executor.shutdown()
+    return consumer.received, dispatched[0], lag[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--topics', default=1000, type=int,
+                        help='Number of processes whose stats are published')
+    parser.add_argument('--burst-size', default=100, type=int,
+                        help='Maximum number of messages read at once')
+    parser.add_argument('--duration', default=5., type=float,
+                        help='Seconds during which each mode is measured')
+    args = parser.parse_args()
+
+    publisher = multiprocessing.Process(target=publish,
+                                        args=(ENDPOINT, args.topics))
+    publisher.daemon = True
+    publisher.start()
+    loop = ioloop.IOLoop.instance()
+
+    modes = [('one by one', None, 'loop'),
+             ('bursts', args.burst_size, 'loop'),
+             ('bursts+thread', args.burst_size, 'thread'),
+             ('bursts+process', args.burst_size, 'process')]
+
+    print('%15s %14s %14s %12s' % ('mode', 'received/s', 'dispatched/s',
+                                   'max lag'))
+    try:
+        for name, burst_size, decoder in modes:
+            received, dispatched, lag = run(loop, args.duration, burst_size,
+                                            decoder)
+            print('%15s %14d %14d %10.1fms' % (
+                name, received / args.duration, dispatched / args.duration,
+                lag * 1000))
+    finally:
+        publisher.terminate()
+
+
+if __name__ == '__main__':
+    main()
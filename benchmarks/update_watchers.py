@@ -0,0 +1,114 @@
+"""Measures how long AsynchronousCircusClient.update_watchers takes to
+refresh the state of a circusd as its number of watchers grows.
+
+A fake circusd answering the 'list', 'options' and 'globaloptions' commands
+after a fixed latency runs in a thread, so the numbers only depend on the
+number of round trips and on how many of them are in flight at once.
+
+Usage::
+
+    python benchmarks/update_watchers.py --latency 0.005 --concurrency 20
+"""
+from __future__ import print_function
+
+import argparse
+import heapq
+import json
+import threading
+import time
+
+import zmq
+from zmq.eventloop import ioloop
+
+ioloop.install()
+
+from circusweb.client import AsynchronousCircusClient  # NOQA
+
+
+ENDPOINT = 'tcp://127.0.0.1:5599'
+
+
+class FakeCircusd(threading.Thread):
+
+    def __init__(self, endpoint, latency):
+        super(FakeCircusd, self).__init__()
+        self.daemon = True
+        self.endpoint = endpoint
+        self.latency = latency
+        self.watchers = []
+        self.context = zmq.Context()
+        self.socket = self.context.socket(zmq.ROUTER)
+        self.socket.bind(endpoint)
+
+    def reply(self, msg):
+        command = msg['command']
+        if command == 'list':
+            res = {'watchers': self.watchers}
+        elif command == 'options':
+            res = {'options': {'numprocesses': 1, 'cmd': 'sleep',
+                               'args': '120', 'use_sockets': False}}
+        elif command == 'globaloptions':
+            res = {'options': {'check_delay': 5,
+                               'stats_endpoint': 'tcp://127.0.0.1:5557',
+                               'pubsub_endpoint': 'tcp://127.0.0.1:5556'}}
+        else:
+            res = {'status': 'error', 'reason': 'unknown command'}
+        res.setdefault('status', 'ok')
+        res['id'] = msg['id']
+        return json.dumps(res).encode('utf8')
+
+    def run(self):
+        poller = zmq.Poller()
+        poller.register(self.socket, zmq.POLLIN)
+        due = []
+
+        while True:
+            timeout = None
+            if due:
+                timeout = max(0, (due[0][0] - time.time()) * 1000)
+            for __ in dict(poller.poll(timeout)):
+                while True:
+                    try:
+                        ident, msg = self.socket.recv_multipart(zmq.NOBLOCK)
+                    except zmq.Again:
+                        break
+                    heapq.heappush(due, (time.time() + self.latency, ident,
+                                         self.reply(json.loads(msg))))
+
+            now = time.time()
+            while due and due[0][0] <= now:
+                __, ident, res = heapq.heappop(due)
+                self.socket.send_multipart([ident, res])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--latency', default=0.005, type=float,
+                        help='Latency of each circusd reply, in seconds')
+    parser.add_argument('--concurrency', default=20, type=int,
+                        help="Number of concurrent 'options' calls")
+    parser.add_argument('--watchers', default='10,50,100,300,1000',
+                        help='Comma separated numbers of watchers to test')
+    args = parser.parse_args()
+
+    circusd = FakeCircusd(ENDPOINT, args.latency)
+    circusd.start()
+    loop = ioloop.IOLoop.instance()
+
+    print('%10s %12s %12s' % ('watchers', 'sequential', 'concurrent'))
+    for count in [int(c) for c in args.watchers.split(',')]:
+        circusd.watchers = ['watcher-%d' % i for i in range(count)]
+        timings = []
+        for concurrency in (1, args.concurrency):
+            client = AsynchronousCircusClient(
+                loop, ENDPOINT, options_concurrency=concurrency)
+            start = time.time()
+            loop.run_sync(client.update_watchers)
+            timings.append(time.time() - start)
+            assert len(client.watchers) == count
+            client.stop()
+        print('%10d %11.3fs %11.3fs' % (count, timings[0], timings[1]))
+
+
+if __name__ == '__main__':
+    main()
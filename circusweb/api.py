@@ -0,0 +1,347 @@
+"""JSON API, mirroring the operations of the web ui.
+
+Every url is prefixed by /api/v1/, endpoints are base64 encoded like in
+the web ui. The read-only resources are served from the state cached by
+the controller and carry an ETag derived from the version of this state,
+so polling them with If-None-Match costs no round trip to circusd as long
+as nothing changed. The endpoints stay connected as long as the API is
+asked about them, see APIHandler.connect.
+"""
+import functools
+import json
+from base64 import b64decode, b64encode
+from datetime import timedelta
+
+import tornado.ioloop
+import tornado.web
+from tornado import gen
+from tornado.web import URLSpec
+
+from circus.exc import CallError
+from circusweb.namespace import StatsStream
+from circusweb.session import (connect_to_circus, disconnect_from_circus,
+                               get_controller)
+
+
+class APIHandler(tornado.web.RequestHandler):
+
+    # endpoint -> timeout releasing the reference the API holds on it, see
+    # connect
+    leases = {}
+    # seconds without API request after which an endpoint is released
+    lease_ttl = 300.
+
+    def prepare(self):
+        self.set_header('Content-Type', 'application/json; charset=UTF-8')
+
+    def write_error(self, status_code, **kwargs):
+        reason = self._reason
+        if 'exc_info' in kwargs:
+            exception = kwargs['exc_info'][1]
+            if isinstance(exception, tornado.web.HTTPError):
+                reason = exception.log_message or reason
+            else:
+                reason = str(exception)
+        self.finish({'status': 'error', 'reason': reason})
+
+    def get_json_body(self):
+        try:
+            return json.loads(self.request.body)
+        except ValueError:
+            raise tornado.web.HTTPError(400, 'Invalid JSON body')
+
+    def decode_endpoint(self, encoded_endpoint):
+        try:
+            endpoint = b64decode(encoded_endpoint)
+        except (TypeError, ValueError):
+            raise tornado.web.HTTPError(400, 'Invalid endpoint')
+        # b64decode skips the characters out of the alphabet, e.g. of a
+        # raw tcp:// endpoint
+        if b64encode(endpoint) != encoded_endpoint:
+            raise tornado.web.HTTPError(400, 'Invalid endpoint')
+        return endpoint
+
+    @gen.coroutine
+    def get_client(self, encoded_endpoint):
+        """Returns the client of an endpoint, connecting to it if needed."""
+        endpoint = self.decode_endpoint(encoded_endpoint)
+        client = yield self.connect(endpoint)
+        raise gen.Return(client)
+
+    @gen.coroutine
+    def connect(self, endpoint):
+        """Returns the client of an endpoint, connecting to it if needed.
+
+        The API holds a single reference on each endpoint it uses, released
+        once it didn't get any request about it for *lease_ttl* seconds.
+        """
+        loop = tornado.ioloop.IOLoop.instance()
+        if endpoint not in self.leases:
+            try:
+                yield gen.Task(connect_to_circus, loop, endpoint)
+            except CallError as e:
+                raise tornado.web.HTTPError(502, str(e))
+            if endpoint in self.leases:
+                # taken by a concurrent request meanwhile
+                disconnect_from_circus(endpoint)
+        if endpoint in self.leases:
+            loop.remove_timeout(self.leases[endpoint])
+        self.leases[endpoint] = loop.add_timeout(
+            timedelta(seconds=self.lease_ttl),
+            functools.partial(self.release, endpoint))
+        raise gen.Return(get_controller().get_client(endpoint))
+
+    @classmethod
+    def release(cls, endpoint):
+        del cls.leases[endpoint]
+        disconnect_from_circus(endpoint)
+
+    def set_version_etag(self, *clients):
+        """Sets the ETag of the response from the version of the clients
+        state."""
+        self.set_header('Etag', '"%s"' % '-'.join(
+            '%s:%d' % (b64encode(client.endpoint), client.version)
+            for client in clients))
+
+    def not_modified(self, *clients):
+        """Returns True, answering with a 304, when the ETag sent by the
+        client still matches the state of the clients."""
+        self.set_version_etag(*clients)
+        if self.check_etag_header():
+            self.set_status(304)
+            return True
+        return False
+
+    def run(self, command, *args, **kwargs):
+        """Runs a controller command and writes its result."""
+        return self.write_result(gen.Task(getattr(get_controller(), command),
+                                          *args, **kwargs))
+
+    @gen.coroutine
+    def write_result(self, future):
+        try:
+            res = yield future
+        except CallError as e:
+            raise tornado.web.HTTPError(502, str(e))
+        if res.get('status') != 'ok':
+            self.set_status(400)
+        self.write(res)
+
+
+def describe_watchers(client):
+    return dict((name, {'options': options,
+                        'status': client.statuses.get(name, 'unknown')})
+                for name, options in client.watchers)
+
+
+class EndpointsHandler(APIHandler):
+
+    def get(self):
+        controller = get_controller()
+        clients = controller.clients.values() if controller else []
+        if self.not_modified(*clients):
+            return
+        endpoints = {}
+        for client in clients:
+            endpoints[client.endpoint] = {
+                'id': b64encode(client.endpoint),
+                'stats_endpoint': client.stats_endpoint,
+                'pubsub_endpoint': client.pubsub_endpoint,
+                'check_delay': client.check_delay,
+                'use_sockets': client.use_sockets,
+                'watchers': len(client.watchers)}
+        self.write({'status': 'ok', 'endpoints': endpoints})
+
+
+class AllWatchersHandler(APIHandler):
+    """The watchers of several endpoints at once, all the connected ones by
+    default or the ones given with ?endpoint=<id>."""
+
+    @gen.coroutine
+    def get(self):
+        controller = get_controller()
+        encoded = self.get_arguments('endpoint')
+        if encoded:
+            clients = yield [self.get_client(endpoint)
+                             for endpoint in encoded]
+        else:
+            clients = list(controller.clients.values()) if controller else []
+
+        if self.not_modified(*clients):
+            return
+        yield [gen.Task(controller.get_statuses, client.endpoint)
+               for client in clients]
+        self.set_version_etag(*clients)
+        self.write({'status': 'ok', 'endpoints': dict(
+            (client.endpoint, describe_watchers(client))
+            for client in clients)})
+
+
+class WatchersHandler(APIHandler):
+
+    @gen.coroutine
+    def get(self, endpoint):
+        client = yield self.get_client(endpoint)
+        if self.not_modified(client):
+            return
+        yield gen.Task(get_controller().get_statuses, client.endpoint)
+        self.set_version_etag(client)
+        self.write({'status': 'ok', 'watchers': describe_watchers(client)})
+
+    @gen.coroutine
+    def post(self, endpoint):
+        client = yield self.get_client(endpoint)
+        body = self.get_json_body()
+        if not body.get('name') or not body.get('cmd'):
+            raise tornado.web.HTTPError(400, 'name and cmd are required')
+        options = dict((key, str(value)) for key, value in body.items()
+                       if key in ('numprocesses', 'working_dir'))
+        if body.get('shell'):
+            options['shell'] = 'on'
+        yield self.run('add_watcher', body['name'], client.endpoint,
+                       body['cmd'], **options)
+
+
+class WatcherHandler(APIHandler):
+
+    @gen.coroutine
+    def get(self, endpoint, name):
+        client = yield self.get_client(endpoint)
+        if name not in client.watchers_options:
+            raise tornado.web.HTTPError(404, 'Unknown watcher %s' % name)
+        if self.not_modified(client):
+            return
+        controller = get_controller()
+        pids = yield gen.Task(controller.get_pids, name, client.endpoint)
+        yield gen.Task(controller.get_statuses, client.endpoint)
+        self.set_version_etag(client)
+        self.write({'status': 'ok', 'watcher': {
+            'name': name, 'options': client.watchers_options[name],
+            'status': client.statuses.get(name, 'unknown'), 'pids': pids}})
+
+
+class WatcherCommandHandler(APIHandler):
+
+    commands = {'incr': 'incrproc', 'decr': 'decrproc',
+                'switch_status': 'switch_status'}
+
+    @gen.coroutine
+    def post(self, endpoint, name, command):
+        client = yield self.get_client(endpoint)
+        yield self.run(self.commands[command], name, endpoint=client.endpoint)
+
+
+class KillProcessHandler(APIHandler):
+
+    @gen.coroutine
+    def post(self, endpoint, name, pid):
+        client = yield self.get_client(endpoint)
+        yield self.run('killproc', name, pid, endpoint=client.endpoint)
+
+
+class SocketsHandler(APIHandler):
+
+    @gen.coroutine
+    def get(self, endpoint):
+        client = yield self.get_client(endpoint)
+        if client.sockets is not None and self.not_modified(client):
+            return
+        sockets = yield gen.Task(get_controller().get_sockets,
+                                 endpoint=client.endpoint)
+        self.set_version_etag(client)
+        self.write({'status': 'ok', 'sockets': sockets})
+
+
+class BulkHandler(APIHandler):
+    """Runs several operations, on several endpoints, at once.
+
+    The body is a JSON object with a list of operations such as
+    {"endpoint": "dGNwOi8vMTI3LjAuMC4xOjU1NTU=", "watcher": "sleeper",
+    "action": "incr", "args": {"nb": 2}}, with the endpoint base64 encoded
+    like in the urls. The response holds the result of each of them in the
+    same order.
+    """
+
+    @gen.coroutine
+    def post(self):
+        operations = self.get_json_body().get('operations')
+        if not isinstance(operations, list):
+            raise tornado.web.HTTPError(400, 'A list of operations is '
+                                             'expected')
+        try:
+            operations = [(op['endpoint'], op['watcher'], op['action'],
+                           op.get('args')) for op in operations]
+        except (KeyError, TypeError) as e:
+            raise tornado.web.HTTPError(400, 'Invalid operation: %s' % e)
+        operations = [(self.decode_endpoint(endpoint), name, action, args)
+                      for endpoint, name, action, args in operations]
+
+        @gen.coroutine
+        def connect(endpoint):
+            try:
+                yield self.connect(endpoint)
+            except tornado.web.HTTPError:
+                pass  # reported in the results of its operations
+
+        yield [connect(endpoint) for endpoint in
+               set(endpoint for endpoint, __, __, __ in operations)]
+        results = yield gen.Task(get_controller().bulk, operations)
+        self.write({'status': 'ok', 'results': results})
+
+
+class StreamsHandler(APIHandler):
+    """The state of the stats streams of the pages."""
+
+    def get(self):
+        streams = list(StatsStream.streams)
+        self.write({'status': 'ok', 'streams': {
+            'connected': len(streams),
+            'slow': sum(1 for p in streams if p.slow_since is not None),
+            'queued': sum(p.queue_size() for p in streams
+                          if not p.is_closed),
+            'coalesced': sum(len(p.coalesced) for p in streams),
+            'dropped': StatsStream.metrics['dropped'],
+            'evicted': StatsStream.metrics['evicted']}})
+
+
+class ConnectionsHandler(APIHandler):
+    """The clients and stats consumers kept by the controller."""
+
+    def get(self):
+        controller = get_controller()
+        counters = controller.get_counters() if controller else {}
+        self.write({'status': 'ok', 'connections': counters})
+
+
+class ReloadconfigHandler(APIHandler):
+
+    @gen.coroutine
+    def post(self, endpoint):
+        client = yield self.get_client(endpoint)
+        yield self.run('reloadconfig', endpoint=client.endpoint)
+
+
+urls = [
+    URLSpec(r'/api/v1/endpoints/',
+            EndpointsHandler, name='api_endpoints'),
+    URLSpec(r'/api/v1/watchers/',
+            AllWatchersHandler, name='api_all_watchers'),
+    URLSpec(r'/api/v1/bulk/',
+            BulkHandler, name='api_bulk'),
+    URLSpec(r'/api/v1/streams/',
+            StreamsHandler, name='api_streams'),
+    URLSpec(r'/api/v1/connections/',
+            ConnectionsHandler, name='api_connections'),
+    URLSpec(r'/api/v1/([^/]+)/watchers/',
+            WatchersHandler, name='api_watchers'),
+    URLSpec(r'/api/v1/([^/]+)/watchers/([^/]+)/',
+            WatcherHandler, name='api_watcher'),
+    URLSpec(r'/api/v1/([^/]+)/watchers/([^/]+)/(incr|decr|switch_status)/',
+            WatcherCommandHandler, name='api_watcher_command'),
+    URLSpec(r'/api/v1/([^/]+)/watchers/([^/]+)/processes/([^/]+)/kill/',
+            KillProcessHandler, name='api_kill_process'),
+    URLSpec(r'/api/v1/([^/]+)/sockets/',
+            SocketsHandler, name='api_sockets'),
+    URLSpec(r'/api/v1/([^/]+)/reloadconfig/',
+            ReloadconfigHandler, name='api_reloadconfig'),
+]
@@ -0,0 +1,148 @@
+"""Bundles of the static files, served under content-hash urls.
+
+In production mode, the scripts included by every page are concatenated
+into a single bundle at startup, minified when rjsmin is installed, and
+written with their gzip and, when brotli is installed, brotli variants.
+The name of each bundle holds the hash of its content, so browsers can
+cache them forever.
+"""
+import gzip
+import hashlib
+import io
+import os
+from collections import OrderedDict
+
+import tornado.web
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import rjsmin
+except ImportError:
+    rjsmin = None
+
+
+# bundle name -> static files, in the order the pages include them
+BUNDLES = OrderedDict([
+    ('circus.js', ['socket.io.js', 'jquery.min.js', 'rickshaw.min.js',
+                   'd3.v2.js', 'circus.js']),
+    ('circus.css', ['circus.css']),
+])
+
+CONTENT_TYPES = {'.js': 'application/javascript; charset=UTF-8',
+                 '.css': 'text/css; charset=UTF-8'}
+
+ASSETS_URL = '/assets/'
+
+# a year, the content of an url never changes
+MAX_AGE = 365 * 24 * 3600
+
+REFUSED = ('q=0', 'q=0.0', 'q=0.00', 'q=0.000')
+
+
+def minify(name, content):
+    if rjsmin is None or not name.endswith('.js') or '.min.' in name:
+        return content
+    return rjsmin.jsmin(content.decode('utf-8')).encode('utf-8')
+
+
+def gzip_compress(content):
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=9,
+                       mtime=0) as f:
+        f.write(content)
+    return buf.getvalue()
+
+
+class Assets(object):
+    """Builds the *bundles* of the files of *static_path* into *build_path*
+    and keeps their content and compressed variants in memory."""
+
+    def __init__(self, static_path, build_path, bundles=BUNDLES):
+        self.static_path = static_path
+        self.build_path = build_path
+        self.bundles = bundles
+        # bundle name -> hashed file name
+        self.names = {}
+        # hashed file name -> (content type, {encoding: content})
+        self.files = {}
+
+    def build(self):
+        if not os.path.isdir(self.build_path):
+            os.makedirs(self.build_path)
+
+        for name, sources in self.bundles.items():
+            parts = []
+            for source in sources:
+                with open(os.path.join(self.static_path, source), 'rb') as f:
+                    parts.append(minify(source, f.read()))
+            # scripts may not end with a semicolon
+            separator = b';\n' if name.endswith('.js') else b'\n'
+            content = separator.join(parts)
+
+            base, ext = os.path.splitext(name)
+            digest = hashlib.md5(content).hexdigest()[:12]
+            filename = '%s-%s%s' % (base, digest, ext)
+
+            variants = {'identity': content, 'gzip': gzip_compress(content)}
+            if brotli is not None:
+                variants['br'] = brotli.compress(content)
+            self.write(filename, variants)
+
+            self.names[name] = filename
+            self.files[filename] = CONTENT_TYPES[ext], variants
+
+    def write(self, filename, variants):
+        """Writes a bundle and its variants, e.g. for a frontend server
+        serving them."""
+        suffixes = {'identity': '', 'gzip': '.gz', 'br': '.br'}
+        for encoding, content in variants.items():
+            path = os.path.join(self.build_path, filename + suffixes[encoding])
+            if os.path.exists(path):
+                continue
+            tmp = '%s.%d' % (path, os.getpid())
+            with open(tmp, 'wb') as f:
+                f.write(content)
+            os.rename(tmp, path)
+
+    def url(self, name):
+        return ASSETS_URL + self.names[name]
+
+
+def accepted_encodings(header):
+    encodings = set()
+    for value in header.split(','):
+        encoding, __, params = value.partition(';')
+        encoding = encoding.strip()
+        if encoding and params.replace(' ', '') not in REFUSED:
+            encodings.add(encoding)
+    return encodings
+
+
+class AssetHandler(tornado.web.RequestHandler):
+    """Serves the bundles, compressed if the browser accepts it."""
+
+    def get(self, filename):
+        assets = self.application.assets
+        if assets is None or filename not in assets.files:
+            raise tornado.web.HTTPError(404)
+        content_type, variants = assets.files[filename]
+
+        accepted = accepted_encodings(
+            self.request.headers.get('Accept-Encoding', ''))
+        encoding = 'identity'
+        for candidate in ('br', 'gzip'):
+            if candidate in variants and candidate in accepted:
+                encoding = candidate
+                break
+
+        self.set_header('Content-Type', content_type)
+        self.set_header('Cache-Control',
+                        'public, max-age=%d, immutable' % MAX_AGE)
+        self.set_header('Vary', 'Accept-Encoding')
+        if encoding != 'identity':
+            self.set_header('Content-Encoding', encoding)
+        self.finish(variants[encoding])
@@ -1,23 +1,33 @@
 from __future__ import print_function
 
 import os
+import signal
 import sys
 import json
 import socket
 import os.path
 import argparse
+import tempfile
 from uuid import uuid4
 from base64 import b64decode, b64encode
+import functools
 from functools import wraps
 
-from circusweb import logger, __version__
+from circusweb import api, logger, __version__
+from circusweb.assets import Assets, AssetHandler
 from circus.exc import CallError
 from circus.util import LOG_LEVELS, configure_logger
 from zmq.eventloop import ioloop
-from circusweb.util import AutoDiscovery, run_command
-from circusweb.session import (SessionManager, get_controller,
+from circusweb.util import AutoDiscovery, gather, run_command
+from circusweb.controller import Controller
+from circusweb.fragments import FragmentCache
+from circusweb.session import (SessionManager, MemoryBackend, SQLiteBackend,
+                               get_controller, set_controller,
                                connect_to_circus, disconnect_from_circus)
-from circusweb.namespace import SocketIOConnection
+from circusweb.namespace import SocketIOConnection, StatsStream
+from circusweb.relay import run_relay, stop_relay
+from circusweb.stats_client import make_executor
+from circusweb.websocket import StatsWebSocket
 
 # Install zmq.eventloop to replace tornado.ioloop
 ioloop.install()
@@ -25,6 +35,8 @@ ioloop.install()
 try:
     import tornado.httpserver
     import tornado.ioloop
+    import tornado.netutil
+    import tornado.process
     import tornado.web
 
     from tornado import gen
@@ -35,7 +47,7 @@ try:
     import tornadio2
 
     from mako import exceptions
-    from tomako import MakoTemplateLoader
+    from mako.lookup import TemplateLookup
 except ImportError as e:
     reqs = os.path.join(os.path.abspath(os.path.dirname(__file__)),
                         'web-requirements.txt')
@@ -48,13 +60,9 @@ CURDIR = os.path.dirname(__file__)
 TMPLDIR = os.path.join(CURDIR, 'templates')
 STATIC_PATH = os.path.join(CURDIR, 'media')
 
-
-session_opts = {
-    'session.type': 'file',
-    'session.cookie_expires': 300,
-    'session.data_dir': './data',
-    'session.auto': True
-}
+# the part of the templates namespace which is the same for every request
+TEMPLATE_GLOBALS = {'version': __version__, 'b64encode': b64encode,
+                    'dumps': json.dumps}
 
 
 def require_logged_user(func):
@@ -74,17 +82,49 @@ def require_logged_user(func):
 
 class BaseHandler(tornado.web.RequestHandler):
 
+    @gen.coroutine
     def prepare(self):
         session_id = self.get_secure_cookie('session_id')
-        if not session_id or not SessionManager.get(session_id):
+        session = session_id and SessionManager.get(session_id)
+        self.new_session = not session
+        if not session:
             session_id = uuid4().hex
             session = SessionManager.new(session_id)
             self.set_secure_cookie('session_id', session_id)
-        else:
-            session = SessionManager.get(session_id)
         self.session = session
         self.session_id = session_id
 
+        # sessions kept by a persistent backend outlive the connections to
+        # the endpoints, e.g. after a restart
+        controller = get_controller()
+        for endpoint in list(session.endpoints):
+            if SessionManager.hold(session_id, endpoint):
+                connecting = gen.Task(connect_to_circus,
+                                      tornado.ioloop.IOLoop.instance(),
+                                      endpoint)
+            elif controller is not None and endpoint in controller.connecting:
+                # connected by a concurrent request of the session
+                connecting = controller.connecting[endpoint]
+            else:
+                continue
+            try:
+                yield connecting
+            except CallError:
+                SessionManager.references.get(session_id,
+                                              set()).discard(endpoint)
+                session.endpoints.discard(endpoint)
+            controller = get_controller()
+
+    def on_finish(self):
+        session = getattr(self, 'session', None)
+        if session is None:
+            # prepare failed before loading it
+            return
+        # don't keep the sessions of the requests which didn't use them,
+        # e.g. health checks and crawlers
+        if not (self.new_session and session.empty):
+            SessionManager.save(self.session_id, session)
+
     def render_template(self, template_path, **data):
         namespace = self.get_template_namespace()
         if self.session.messages:
@@ -93,12 +133,13 @@ class BaseHandler(tornado.web.RequestHandler):
         else:
             messages = []
         server = '%s://%s/' % (self.request.protocol, self.request.host)
+        namespace.update(TEMPLATE_GLOBALS)
         namespace.update({'controller': get_controller(),
-                          'version': __version__,
-                          'b64encode': b64encode,
-                          'dumps': json.dumps,
+                          'assets': app.assets,
                           'session': self.session, 'messages': messages,
-                          'SERVER': server})
+                          'SERVER': server,
+                          'fragment': functools.partial(self.render_fragment,
+                                                        namespace)})
 
         # Stats endpoints
         controller = get_controller()
@@ -117,15 +158,26 @@ class BaseHandler(tornado.web.RequestHandler):
         namespace.update(data)
 
         try:
-            template = app.loader.load(template_path)
-            return template.generate(**namespace)
+            template = app.lookup.get_template(template_path)
+            return template.render(**namespace)
         except Exception:
             print(exceptions.text_error_template().render())
 
+    def render_fragment(self, namespace, template_path, scope, version,
+                        **data):
+        """Renders a template included in a page, in production mode the
+        result is reused until *version* changes."""
+        def render():
+            return app.lookup.get_template(template_path).render(
+                **dict(namespace, **data))
+
+        if app.fragments is None:
+            return render()
+        return app.fragments.get((template_path, scope), version, render)
+
     def clean_user_session(self):
         """Disconnect the endpoint the user was logged on + Remove cookies."""
-        for endpoint in self.session.endpoints:
-            disconnect_from_circus(endpoint)
+        SessionManager.release(self.session_id)
         self.session.endpoints = set()
 
     def run_command(self, *args, **kwargs):
@@ -141,6 +193,11 @@ class IndexHandler(BaseHandler):
     @gen.coroutine
     def get(self):
         controller = get_controller()
+        # fetch all the statuses before rendering, the template only reads
+        # them from the cache
+        yield [gen.Task(controller.get_statuses, endpoint)
+               for endpoint in self.session.endpoints
+               if controller.get_client(endpoint) is not None]
         self.finish(self.render_template('index.html', controller=controller))
 
 
@@ -168,24 +225,49 @@ class ConnectHandler(BaseHandler):
             self.redirect(self.reverse_url('disconnect'))
             raise StopIteration()
 
-        for endpoint in endpoints:
-            try:
-                yield gen.Task(connect_to_circus,
-                               tornado.ioloop.IOLoop.instance(),
-                               endpoint)
-            except CallError:
-                self.session.messages.append("Impossible to connect to %s" %
-                                             endpoint)
-            else:
-                if endpoint not in app.auto_discovery.get_endpoints():
-                    app.auto_discovery.discovered_endpoints.add(endpoint)
-                self.session.endpoints.add(endpoint)
+        loop = tornado.ioloop.IOLoop.instance()
+        futures = dict((endpoint, gen.Task(connect_to_circus, loop, endpoint))
+                       for endpoint in endpoints
+                       if endpoint not in self.session.endpoints)
+        connected, failed, pending = yield gather(
+            futures, self.settings['endpoint_deadline'])
+
+        for endpoint in connected:
+            if endpoint not in app.auto_discovery.get_endpoints():
+                app.auto_discovery.discovered_endpoints.add(endpoint)
+            self.session.endpoints.add(endpoint)
+            SessionManager.hold(self.session_id, endpoint)
+        for endpoint in failed:
+            self.session.messages.append("Impossible to connect to %s" %
+                                         endpoint)
+        for endpoint, future in pending.items():
+            self.session.messages.append(
+                "%s is slow to answer, it will be added once connected" %
+                endpoint)
+            future.add_done_callback(functools.partial(
+                self.on_late_connection, self.session_id, endpoint))
+
         for endpoint in endpoints_list:
             if endpoint not in endpoints:
                 self.session.endpoints.remove(endpoint)
+                SessionManager.release(self.session_id, endpoint)
 
         self.redirect(self.reverse_url('index'))
 
+    @staticmethod
+    def on_late_connection(session_id, endpoint, future):
+        """Adds an endpoint which connected after the deadline to the
+        session, or releases it if the session is gone."""
+        if future.exception() is not None:
+            return
+        session = SessionManager.get(session_id)
+        if session is None:
+            disconnect_from_circus(endpoint)
+        else:
+            session.endpoints.add(endpoint)
+            SessionManager.hold(session_id, endpoint)
+            SessionManager.save(session_id, session)
+
 
 class DisconnectHandler(BaseHandler):
 
@@ -223,10 +305,40 @@ class WatcherHandler(BaseHandler):
         controller = get_controller()
         endpoint = b64decode(endpoint)
         pids = yield gen.Task(controller.get_pids, name, endpoint)
+        yield gen.Task(controller.get_statuses, endpoint)
         self.finish(self.render_template('watcher.html', pids=pids, name=name,
                                          endpoint=endpoint))
 
 
+class WatcherAggregatesHandler(BaseHandler):
+
+    @require_logged_user
+    def get(self, endpoint, name):
+        controller = get_controller()
+        client = controller.get_client(b64decode(endpoint))
+        if client is None or not client.stats_endpoint:
+            raise tornado.web.HTTPError(404)
+
+        pid = self.get_argument('pid', None)
+        try:
+            if pid is not None:
+                pid = int(pid)
+            tier = int(self.get_argument('tier', 60))
+            since = float(self.get_argument('since', 0))
+        except ValueError:
+            raise tornado.web.HTTPError(400)
+        if tier not in controller.stats_aggregates.tiers:
+            raise tornado.web.HTTPError(400)
+
+        metrics = {}
+        for metric in self.get_arguments('metric') or ['cpu', 'mem']:
+            metrics[metric] = controller.get_aggregates(
+                client.stats_endpoint, name, metric, tier, pid, since)
+
+        self.write({'name': name, 'pid': pid, 'tier': tier,
+                    'metrics': metrics})
+
+
 class WatcherSwitchStatusHandler(BaseHandler):
 
     @require_logged_user
@@ -301,15 +413,24 @@ class SocketsHandler(BaseHandler):
         sockets = {}
 
         if endpoint:
-            endpoint = b64decode(endpoint)
-            sockets[endpoint] = yield gen.Task(controller.get_sockets,
-                                               endpoint=endpoint)
+            endpoints = [b64decode(endpoint)]
         else:
-            for endpoint in self.session.endpoints:
-                # Ignore endpoints which doesn't uses sockets
-                if controller.get_client(endpoint).use_sockets:
-                    sockets[endpoint] = yield gen.Task(controller.get_sockets,
-                                                       endpoint=endpoint)
+            # Ignore endpoints which doesn't uses sockets
+            endpoints = [endpoint for endpoint in self.session.endpoints
+                         if controller.get_client(endpoint).use_sockets]
+
+        futures = dict((endpoint, gen.Task(controller.get_sockets,
+                                           endpoint=endpoint))
+                       for endpoint in endpoints)
+        sockets, failed, pending = yield gather(
+            futures, self.settings['endpoint_deadline'])
+        for endpoint in failed:
+            self.session.messages.append(
+                "Impossible to get the sockets of %s" % endpoint)
+        for endpoint in pending:
+            self.session.messages.append(
+                "%s is slow to answer, its sockets are not displayed" %
+                endpoint)
 
         self.finish(
             self.render_template('sockets.html', sockets=sockets,
@@ -332,8 +453,16 @@ class ReloadconfigHandler(BaseHandler):
 
 
 class Application(tornado.web.Application):
+    """The web ui.
+
+    In production mode, i.e. when *debug* is False, the templates are
+    compiled once into *module_directory* and never checked for changes, the
+    fragments of the pages are cached and the scripts are served as a
+    single bundle built into *assets_path*.
+    """
 
-    def __init__(self):
+    def __init__(self, debug=True, module_directory=None, assets_path=None,
+                 **extra_settings):
         handlers = [
             URLSpec(r'/',
                     IndexHandler, name="index"),
@@ -347,6 +476,8 @@ class Application(tornado.web.Application):
                     WatcherAddHandler, name="add_watcher"),
             URLSpec(r'/([^/]+)/watcher/([^/]+)/',
                     WatcherHandler, name="watcher"),
+            URLSpec(r'/([^/]+)/watcher/([^/]+)/aggregates/',
+                    WatcherAggregatesHandler, name="aggregates"),
             URLSpec(r'/([^/]+)/watcher/([^/]+)/switch_status/',
                     WatcherSwitchStatusHandler, name="switch_status"),
             URLSpec(r'/([^/]+)/watcher/([^/]+)/process/kill/([^/]+)/',
@@ -359,26 +490,59 @@ class Application(tornado.web.Application):
                     SocketsHandler, name="all_sockets"),
             URLSpec(r'/([^/]+)/sockets/',
                     SocketsHandler, name="sockets"),
+            URLSpec(r'/assets/([^/]+)',
+                    AssetHandler, name="asset"),
+            URLSpec(r'/stats/websocket',
+                    StatsWebSocket, name="stats_websocket"),
         ]
 
-        self.loader = MakoTemplateLoader(TMPLDIR)
+        handlers += api.urls
+
+        # the encodings and filters tomako used to render the templates
+        template_options = {'input_encoding': 'utf-8',
+                            'output_encoding': 'utf-8',
+                            'default_filters': ['decode.utf8']}
+        if debug:
+            self.lookup = TemplateLookup(directories=[TMPLDIR],
+                                         **template_options)
+            self.fragments = None
+            self.assets = None
+        else:
+            self.lookup = TemplateLookup(directories=[TMPLDIR],
+                                         module_directory=module_directory,
+                                         filesystem_checks=False,
+                                         **template_options)
+            self.fragments = FragmentCache()
+            self.assets = Assets(STATIC_PATH, assets_path)
         self.router = tornadio2.TornadioRouter(SocketIOConnection)
         handlers += self.router.urls
 
         settings = {
-            'template_loader': self.loader,
             'static_path': STATIC_PATH,
-            'debug': True,
-            'cookie_secret': 'fxCIK+cbRZe6zhwX8yIQDVS54LFfB0I+nQt0pGp3IY0='
+            'debug': debug,
+            'compress_response': True,
+            'cookie_secret': 'fxCIK+cbRZe6zhwX8yIQDVS54LFfB0I+nQt0pGp3IY0=',
+            # seconds a page waits for each endpoint before rendering
+            'endpoint_deadline': 3,
         }
+        settings.update(extra_settings)
 
         tornado.web.Application.__init__(self, handlers, **settings)
 
+    def precompile(self):
+        """Compiles all the templates and builds the assets, so no request
+        has to."""
+        for name in sorted(os.listdir(TMPLDIR)):
+            if name.endswith('.html'):
+                self.lookup.get_template(name)
+        self.assets.build()
+
 
 app = Application()
 
 
 def main():
+    global app
     define("port", default=8080, type=int)
     parser = argparse.ArgumentParser(description='Run the Web Console')
 
@@ -401,6 +565,118 @@ def main():
                         default="udp://237.219.251.97:12027",
                         help="Multicast endpoint. If not specified, Circus "
                              "will use default one")
+    parser.add_argument('--options-concurrency', dest='options_concurrency',
+                        default=20, type=int,
+                        help="Maximum number of concurrent 'options' calls "
+                             "made to a circusd when refreshing its watchers")
+    parser.add_argument('--timeout', dest='timeout', default=5., type=float,
+                        help="Seconds to wait for the reply of circusd")
+    parser.add_argument('--retries', dest='retries', default=2, type=int,
+                        help="Number of times a read-only command is sent "
+                             "again after a timeout, with a backoff")
+    parser.add_argument('--breaker-threshold', dest='breaker_threshold',
+                        default=5, type=int,
+                        help="Number of failed calls in a row after which "
+                             "the calls to a circusd fail right away")
+    parser.add_argument('--breaker-timeout', dest='breaker_timeout',
+                        default=30., type=float,
+                        help="Seconds before a circusd is tried again once "
+                             "its calls fail right away")
+    parser.add_argument('--stats-history-size', dest='stats_history_size',
+                        default=120, type=int,
+                        help="Number of samples kept per process and metric")
+    parser.add_argument('--stats-history-series',
+                        dest='stats_history_series', default=5000, type=int,
+                        help="Maximum number of processes and metrics kept "
+                             "in the stats history")
+    parser.add_argument('--stats-history-replay',
+                        dest='stats_history_replay', default=300, type=int,
+                        help="Seconds of stats history sent to newly opened "
+                             "pages")
+    parser.add_argument('--stats-aggregates-size',
+                        dest='stats_aggregates_size', default=144, type=int,
+                        help="Number of 10s, 1min and 10min buckets kept per "
+                             "process and metric")
+    parser.add_argument('--stats-aggregates-series',
+                        dest='stats_aggregates_series', default=1000,
+                        type=int,
+                        help="Maximum number of processes and metrics "
+                             "aggregated")
+    parser.add_argument('--stats-on-demand', dest='stats_on_demand',
+                        action='store_true', default=False,
+                        help="Only receive the stats shown by the open "
+                             "pages, the stats history and aggregates then "
+                             "only cover those")
+    parser.add_argument('--endpoint-deadline', dest='endpoint_deadline',
+                        default=3, type=float,
+                        help="Seconds a page waits for each endpoint, the "
+                             "slower ones are reported as such")
+    parser.add_argument('--production', dest='production',
+                        action='store_true', default=False,
+                        help="Disable the debug mode and autoreload, compile "
+                             "the templates once and cache the pages "
+                             "fragments")
+    parser.add_argument('--template-cache', dest='template_cache',
+                        default=os.path.join(tempfile.gettempdir(),
+                                             'circushttpd-templates'),
+                        help="Directory of the compiled templates, in "
+                             "production mode")
+    parser.add_argument('--assets-path', dest='assets_path',
+                        default=os.path.join(tempfile.gettempdir(),
+                                             'circushttpd-assets'),
+                        help="Directory of the bundled and compressed "
+                             "scripts, in production mode")
+    parser.add_argument('--processes', dest='processes', default=1, type=int,
+                        help="Number of processes serving the web ui, 0 "
+                             "starts one per CPU. With more than one, the "
+                             "browsers need the websocket transport and the "
+                             "sessions are kept in SQLite")
+    parser.add_argument('--session-backend', dest='session_backend',
+                        default='memory', choices=['memory', 'sqlite'],
+                        help="Where to keep the sessions, 'sqlite' keeps "
+                             "them across restarts")
+    parser.add_argument('--session-file', dest='session_file',
+                        default='circushttpd-sessions.db',
+                        help="SQLite database used by the sqlite backend")
+    parser.add_argument('--session-ttl', dest='session_ttl',
+                        default=24 * 3600, type=int,
+                        help="Seconds after which an idle session expires")
+    parser.add_argument('--max-sessions', dest='max_sessions',
+                        default=10000, type=int,
+                        help="Maximum number of sessions kept, the least "
+                             "recently used ones expire first")
+    parser.add_argument('--stats-batch-window', dest='stats_batch_window',
+                        default=250, type=int,
+                        help="Milliseconds during which the stats are "
+                             "gathered before being sent to the browsers, "
+                             "0 sends each of them right away")
+    parser.add_argument('--stream-max-queue', dest='stream_max_queue',
+                        default=100, type=int,
+                        help="Number of messages waiting for a browser "
+                             "above which only the latest stats are kept")
+    parser.add_argument('--stream-slow-timeout', dest='stream_slow_timeout',
+                        default=30, type=float,
+                        help="Seconds after which a browser which can't keep "
+                             "up with its stats is disconnected")
+    parser.add_argument('--release-delay', dest='release_delay',
+                        default=30, type=float,
+                        help="Seconds during which the connections to an "
+                             "endpoint nobody uses any more are kept open")
+    parser.add_argument('--query-ttl', dest='query_ttl',
+                        default=0, type=float,
+                        help="Seconds during which the reply of circusd to "
+                             "a read-only command is reused, the identical "
+                             "commands in flight always share it")
+    parser.add_argument('--stats-burst-size', dest='stats_burst_size',
+                        default=100, type=int,
+                        help="Maximum number of stats read from a stats "
+                             "endpoint at once, keeping the latest of each "
+                             "watcher or process, 0 reads them one by one")
+    parser.add_argument('--stats-decoder', dest='stats_decoder',
+                        default='loop', choices=('loop', 'thread', 'process'),
+                        help="Where the bursts of stats are decoded, a "
+                             "worker thread or process keeps the pages "
+                             "responsive under heavy stats traffic")
 
     args = parser.parse_args()
 
@@ -411,24 +687,107 @@ def main():
     # configure the logger
     configure_logger(logger, args.loglevel, args.logoutput)
 
+    relay = None
+    if args.processes != 1:
+        if args.session_backend == 'memory':
+            logger.warning('Using the sqlite session backend, the sessions '
+                           'have to be shared by the processes')
+            args.session_backend = 'sqlite'
+
+        # a single process subscribes to the stats and pubsub endpoints and
+        # relays their messages to the others, it's started before the
+        # listening sockets are created so it doesn't keep them open
+        relay = 'ipc://%s' % os.path.join(
+            tempfile.gettempdir(), 'circushttpd-relay-%d' % os.getpid())
+        relay_pid = run_relay(relay, args.ssh,
+                              close_fds=[args.fd] if args.fd else [])
+
+    # the listening sockets are created before forking so every process
+    # accepts connections on them
+    if args.fd:
+        sock = socket.fromfd(args.fd, socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setblocking(0)
+        sockets = [sock]
+        logger.info("Starting circus web ui on fd %d" % args.fd)
+    else:
+        sockets = tornado.netutil.bind_sockets(args.port, args.host)
+        logger.info("Starting circus web ui on %s:%s" % (args.host, args.port))
+
+    if args.production:
+        app = Application(debug=False, module_directory=args.template_cache,
+                          assets_path=args.assets_path)
+        app.precompile()
+
+    if args.processes != 1:
+        # tornadio2 already created the IOLoop for the application, each
+        # process needs its own, and autoreload can't restart them all
+        tornado.ioloop.IOLoop.instance().close()
+        tornado.ioloop.IOLoop.clear_instance()
+        # the parent process only waits for the others, the relay is
+        # terminated once they exited or when it's stopped
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            tornado.process.fork_processes(args.processes)
+        except (SystemExit, KeyboardInterrupt):
+            stop_relay(relay_pid)
+            raise
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        # in production mode, the templates compiled before forking are
+        # loaded from the module directory
+        app = Application(debug=not args.production, autoreload=False,
+                          module_directory=args.template_cache,
+                          assets_path=args.assets_path)
+        if args.production:
+            app.precompile()
+
+    app.settings['endpoint_deadline'] = args.endpoint_deadline
+
     # Get the tornado ioloop singleton
     loop = tornado.ioloop.IOLoop.instance()
 
+    if args.session_backend == 'sqlite':
+        session_backend = SQLiteBackend(args.session_file)
+    else:
+        session_backend = MemoryBackend()
+    SessionManager.configure(session_backend, ttl=args.session_ttl,
+                             max_sessions=args.max_sessions)
+    SessionManager.start_expiration()
+
+    if args.stats_batch_window > 0:
+        StatsStream.batch_window = args.stats_batch_window / 1000.
+    StatsStream.max_queue = args.stream_max_queue
+    StatsStream.slow_timeout = args.stream_slow_timeout
+
+    client_options = {'options_concurrency': args.options_concurrency,
+                      'timeout': args.timeout,
+                      'retries': args.retries,
+                      'breaker_threshold': args.breaker_threshold,
+                      'breaker_timeout': args.breaker_timeout}
+    stats_options = {}
+    if args.stats_burst_size > 0:
+        stats_options = {'burst_size': args.stats_burst_size,
+                         'executor': make_executor(args.stats_decoder)}
+    set_controller(Controller(loop, ssh_server=args.ssh,
+                              client_options=client_options,
+                              stats_history_size=args.stats_history_size,
+                              stats_history_series=args.stats_history_series,
+                              stats_history_replay=args.stats_history_replay,
+                              stats_aggregates_size=args.stats_aggregates_size,
+                              stats_aggregates_series=(
+                                  args.stats_aggregates_series),
+                              relay=relay,
+                              stats_options=stats_options,
+                              release_delay=args.release_delay,
+                              query_ttl=args.query_ttl,
+                              stats_on_demand=args.stats_on_demand))
+
     if args.endpoint is not None:
         connect_to_circus(loop, args.endpoint, args.ssh)
 
     app.auto_discovery = AutoDiscovery(args.multicast, loop)
     http_server = tornado.httpserver.HTTPServer(app, xheaders=True)
-
-    if args.fd:
-        sock = socket.fromfd(args.fd, socket.AF_INET, socket.SOCK_STREAM)
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        sock.setblocking(0)
-        http_server.add_sockets([sock])
-        logger.info("Starting circus web ui on fd %d" % args.fd)
-    else:
-        http_server.listen(args.port, args.host)
-        logger.info("Starting circus web ui on %s:%s" % (args.host, args.port))
+    http_server.add_sockets(sockets)
 
     loop.start()
 
@@ -1,4 +1,6 @@
 # -*- coding: utf-8 -
+import itertools
+import time
 import uuid
 
 import zmq
@@ -10,11 +12,68 @@ from circus.py3compat import string_types
 from circus.util import get_connection
 from circus.client import CircusClient, make_message
 
-from collections import defaultdict
-
 from datetime import timedelta
 
 from tornado import gen
+from tornado.concurrent import Future
+
+
+# the versions of the state of all the clients, see touch
+_versions = itertools.count(1)
+
+# commands without side effect, which can safely be sent again
+READ_ONLY_COMMANDS = frozenset(['list', 'listsockets', 'options',
+                                'globaloptions', 'status', 'get', 'stats',
+                                'dstats', 'numprocesses', 'numwatchers'])
+
+
+class CircuitBreaker(object):
+    """Stops the calls to an endpoint which failed *threshold* times in a
+    row.
+
+    Once opened, the calls fail right away for *reset_timeout* seconds,
+    then a single call is let through to probe the endpoint: the breaker
+    closes if it succeeds and opens again otherwise.
+    """
+
+    def __init__(self, threshold=5, reset_timeout=30.):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.time() - self.opened_at < self.reset_timeout:
+            return 'open'
+        return 'half-open'
+
+    def allow(self):
+        state = self.state
+        if state == 'closed':
+            return True
+        if state == 'half-open' and not self.probing:
+            self.probing = True
+            return True
+        return False
+
+    def success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def failure(self):
+        """Records a failed call, returns True if it opened the breaker."""
+        self.failures += 1
+        self.probing = False
+        if self.failures >= self.threshold:
+            opening = self.opened_at is None
+            self.opened_at = time.time()
+            return opening
+        return False
 
 
 class AsynchronousCircusClient(CircusClient):
@@ -23,7 +82,9 @@ class AsynchronousCircusClient(CircusClient):
     IOLoop
     """
     def __init__(self, loop, endpoint, context=None, timeout=5.0,
-                 ssh_server=None, ssh_keyfile=None):
+                 ssh_server=None, ssh_keyfile=None, pool_size=1,
+                 options_concurrency=20, retries=2, retry_delay=.1,
+                 breaker_threshold=5, breaker_timeout=30.):
         self.context = context or zmq.Context.instance()
         self.ssh_server = ssh_server
         self.ssh_keyfile = ssh_keyfile
@@ -38,93 +99,205 @@ class AsynchronousCircusClient(CircusClient):
         self.check_delay = None
         self.connected = False
         self.watchers = []
+        self.watchers_options = {}
         self.plugins = []
-        self.stats = defaultdict(list)
-        self.dstats = []
+        self.pids = {}
         self.sockets = None
+        self.statuses = {}
+        self.statuses_time = 0
         self.use_sockets = False
         self.embed_httpd = False
 
+        # Maximum number of 'options' calls in flight during update_watchers
+        self.options_concurrency = max(1, options_concurrency)
+
         # Connection counter
         self.count = 0
 
-    def send_message(self, command, callback=None, **props):
-        return self.call(make_message(command, **props), callback)
+        # Changes whenever the watchers, their statuses or their pids
+        # change, so caches of this state can tell when they are stale.
+        # Taken from a counter shared by all the clients, a client created
+        # again for the same endpoint never reuses the version of the
+        # previous one
+        self.version = next(_versions)
 
-    def call(self, cmd, callback):
-        if not isinstance(cmd, string_types):
-            try:
-                cmd = json.dumps(cmd)
-            except ValueError as e:
-                raise CallError(str(e))
+        # Persistent DEALER streams shared by every call made through this
+        # client, replies are dispatched to their caller using the message id
+        self.pool_size = max(1, pool_size)
+        self._streams = []
+        self._next_stream = 0
+        self._pending = {}
+
+        # The read-only commands are sent again up to *retries* times when
+        # they time out, waiting *retry_delay* seconds, doubled each time
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.breaker = CircuitBreaker(breaker_threshold, breaker_timeout)
+
+    def send_message(self, command, **props):
+        return self.call(make_message(command, **props))
 
+    def _connect(self):
         socket = self.context.socket(zmq.DEALER)
         socket.setsockopt(zmq.IDENTITY, uuid.uuid4().hex)
         socket.setsockopt(zmq.LINGER, 0)
         get_connection(socket, self.endpoint, self.ssh_server,
                        self.ssh_keyfile)
+        return socket
 
-        if callback:
-            stream = ZMQStream(socket, self.loop)
+    def _get_stream(self):
+        """Returns one of the persistent streams, round-robin."""
+        if len(self._streams) < self.pool_size:
+            stream = ZMQStream(self._connect(), self.loop)
+            stream.on_recv(self._handle_reply)
+            self._streams.append(stream)
+            return stream
 
-            def timeout_callback():
-                stream.stop_on_recv()
-                stream.close()
-                raise CallError('Call timeout for cmd', cmd)
+        stream = self._streams[self._next_stream % len(self._streams)]
+        self._next_stream += 1
+        return stream
 
-            timeout = self.loop.add_timeout(timedelta(seconds=5),
-                                            timeout_callback)
+    def _handle_reply(self, msg):
+        res = json.loads(msg[0])
+        pending = self._pending.pop(res.get('id'), None)
+        if pending is None:
+            # the call already timed out, nobody is waiting for it anymore
+            return
+        future, timeout = pending
+        self.loop.remove_timeout(timeout)
+        future.set_result(res)
 
-            def recv_callback(msg):
-                self.loop.remove_timeout(timeout)
-                stream.stop_on_recv()
-                stream.close()
-                callback(json.loads(msg[0]))
+    def _send(self, cmd):
+        """Sends a command, returns a Future failing with a CallError if no
+        reply comes within *timeout* seconds."""
+        future = Future()
+        msg_id = cmd.get('id')
+        if msg_id is None:
+            future.set_exception(CallError('Missing message id for cmd'))
+            return future
 
-            stream.on_recv(recv_callback)
+        def timeout_callback():
+            if self._pending.pop(msg_id, None) is not None:
+                future.set_exception(CallError('Call timeout for cmd %s on %s'
+                                               % (cmd.get('command'),
+                                                  self.endpoint)))
+
+        try:
+            data = json.dumps(cmd)
+        except ValueError as e:
+            future.set_exception(CallError(str(e)))
+            return future
 
+        timeout = self.loop.add_timeout(timedelta(seconds=self._timeout),
+                                        timeout_callback)
+        self._pending[msg_id] = future, timeout
         try:
-            socket.send(cmd)
+            self._get_stream().send(data)
         except zmq.ZMQError as e:
-            raise CallError(str(e))
+            self.loop.remove_timeout(timeout)
+            del self._pending[msg_id]
+            future.set_exception(CallError(str(e)))
+        return future
 
-        if not callback:
-            return json.loads(socket.recv())
+    @gen.coroutine
+    def call(self, cmd):
+        """Sends a command to circusd and returns its reply.
+
+        The read-only commands are retried with a backoff when they time
+        out. While the circuit breaker is open, calls fail right away
+        instead of piling up behind an unreachable circusd.
+        """
+        if isinstance(cmd, string_types):
+            try:
+                cmd = json.loads(cmd)
+            except ValueError as e:
+                raise CallError(str(e))
+        if cmd.get('id') is None:
+            # the replies are dispatched to their caller by id
+            cmd = dict(cmd, id=uuid.uuid4().hex)
+
+        if not self.breaker.allow():
+            raise CallError('%s is unavailable' % self.endpoint)
+
+        retries = 0
+        if cmd.get('command') in READ_ONLY_COMMANDS:
+            retries = self.retries
+        delay = self.retry_delay
+        while True:
+            try:
+                res = yield self._send(cmd)
+            except CallError:
+                # the breaker counts the calls failed once their retries
+                # ran out, and stops retrying when others opened it
+                if not retries or self.breaker.state == 'open':
+                    if self.breaker.failure():
+                        # drop the commands queued for the dead circusd
+                        self.stop()
+                    raise
+                retries -= 1
+                yield gen.sleep(delay)
+                delay *= 2
+                cmd = dict(cmd, id=uuid.uuid4().hex)
+            else:
+                self.breaker.success()
+                raise gen.Return(res)
+
+    def stop(self):
+        """Closes the persistent streams and fails the pending calls."""
+        pending, self._pending = self._pending, {}
+        for future, timeout in pending.values():
+            self.loop.remove_timeout(timeout)
+            future.set_exception(CallError('Connection to %s closed' %
+                                           self.endpoint))
+        for stream in self._streams:
+            stream.close()
+        self._streams = []
 
     @gen.coroutine
     def update_watchers(self):
         """Calls circus and initialize the list of watchers.
 
+        The options of the watchers are fetched concurrently, with at most
+        *options_concurrency* calls in flight.
+
         If circus is not connected raises an error.
         """
-        self.watchers = []
-        self.plugins = []
-
         # trying to list the watchers
         try:
             self.connected = True
-            watchers = yield gen.Task(self.send_message, 'list')
+            watchers = yield self.send_message('list')
             watchers = watchers['watchers']
 
-            for watcher in watchers:
-                if watcher in ('circusd-stats', 'circushttpd'):
-                    if watcher == 'circushttpd':
-                        self.embed_httpd = True
-                    continue
+            if 'circushttpd' in watchers:
+                self.embed_httpd = True
+            names = [watcher for watcher in watchers
+                     if watcher not in ('circusd-stats', 'circushttpd')]
 
-                options = yield gen.Task(self.send_message, 'options',
-                                         name=watcher)
-                options = options['options']
+            all_options = {}
+            pending = iter(names)
 
-                self.watchers.append((watcher, options))
-                if watcher.startswith('plugin:'):
-                    self.plugins.append(watcher)
+            @gen.coroutine
+            def fetch_options():
+                # every worker pulls from the same iterator, so a slow reply
+                # only delays the worker waiting for it
+                for watcher in pending:
+                    options = yield self.send_message('options', name=watcher)
+                    all_options[watcher] = options['options']
 
-                if not self.use_sockets and options.get('use_sockets', False):
-                    self.use_sockets = True
+            workers = min(self.options_concurrency, len(names))
+            results = yield [self.get_global_options()] + [
+                fetch_options() for __ in range(workers)]
+            global_options = results[0]
 
-            self.watchers.sort()
-            global_options = yield gen.Task(self.get_global_options)
+            self.watchers_options = all_options
+            self.watchers = sorted(all_options.items())
+            self.plugins = [watcher for watcher in names
+                            if watcher.startswith('plugin:')]
+            self.pids = {}
+            self.touch()
+            if not self.use_sockets:
+                self.use_sockets = any(options.get('use_sockets', False)
+                                       for options in all_options.values())
 
             self.check_delay = global_options['check_delay']
 
@@ -145,10 +318,48 @@ class AsynchronousCircusClient(CircusClient):
                 self.pubsub_endpoint = self.pubsub_endpoint.replace(
                     anyaddr, ip)
         except CallError:
+            # the watchers of a disconnected circusd aren't shown
             self.connected = False
+            self.watchers = []
+            self.watchers_options = {}
+            self.plugins = []
+            self.pids = {}
+            self.touch()
             raise
 
+    @gen.coroutine
+    def update_watcher(self, name):
+        """Fetches the options of a single watcher and patches the state."""
+        res = yield self.send_message('options', name=name)
+        if res['status'] == 'ok':
+            self.set_watcher_options(name, res['options'])
+        raise gen.Return(res)
+
+    def touch(self):
+        self.version = next(_versions)
+
+    def set_status(self, name, status):
+        if self.statuses.get(name) != status:
+            self.statuses[name] = status
+            self.touch()
+
+    def set_watcher_options(self, name, options):
+        """Adds or updates a watcher without refreshing the others."""
+        self.watchers_options[name] = options
+        self.touch()
+        self.watchers = sorted(self.watchers_options.items())
+        if name.startswith('plugin:') and name not in self.plugins:
+            self.plugins.append(name)
+        if options.get('use_sockets', False):
+            self.use_sockets = True
+
+    def set_watcher_option(self, name, option, value):
+        options = self.watchers_options.get(name)
+        if options is not None and options.get(option) != value:
+            options[option] = value
+            self.touch()
+
     @gen.coroutine
     def get_global_options(self):
-        res = yield gen.Task(self.send_message, 'globaloptions')
+        res = yield self.send_message('globaloptions')
         raise gen.Return(res['options'])
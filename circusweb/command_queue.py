@@ -0,0 +1,136 @@
+"""The commands changing the watchers of an endpoint, sent one batch at a
+time.
+
+The commands asked for while a batch is in flight are merged into the
+next one: the incr and decr of a watcher into a single incr or decr of
+their sum, and its start, stop and switch_status into the last state asked
+for, two switch_status cancelling each other. The callers of commands
+cancelling each other get {'status': 'ok', 'merged': True}, nothing was
+sent to circusd.
+"""
+from collections import OrderedDict
+
+from tornado import gen
+from tornado.concurrent import Future
+
+
+# status command pending -> the one once switch_status is asked for
+SWITCHED = {None: 'switch', 'switch': None, 'start': 'stop', 'stop': 'start'}
+
+# the reply to the commands cancelling each other
+MERGED = {'status': 'ok', 'merged': True}
+
+
+class PendingCommands(object):
+    """The commands merged for a watcher and the futures of their
+    callers."""
+
+    def __init__(self):
+        # processes to add, or to remove when negative
+        self.delta = 0
+        # 'start', 'stop', 'switch' or None
+        self.status = None
+        self.futures = {'processes': [], 'status': []}
+
+    def add(self, action, future):
+        if action == 'incr':
+            self.delta += 1
+        elif action == 'decr':
+            self.delta -= 1
+        elif action == 'switch':
+            self.status = SWITCHED[self.status]
+        elif action in ('start', 'stop'):
+            self.status = action
+        else:
+            raise ValueError('Unknown action %r' % action)
+        kind = 'processes' if action in ('incr', 'decr') else 'status'
+        self.futures[kind].append(future)
+
+
+class CommandQueue(object):
+    """Sends the incr, decr, start, stop and switch_status commands of an
+    endpoint through *client*.
+
+    A command asked for while the queue is idle is sent right away. The
+    state of the client is patched with the replies, and *on_batch* is
+    called with the names of the watchers of each batch once it is done,
+    e.g. to refresh them.
+    """
+
+    def __init__(self, client, on_batch=None):
+        self.client = client
+        self.on_batch = on_batch
+        # watcher name -> PendingCommands
+        self.pending = OrderedDict()
+        self.running = False
+
+    def put(self, name, action):
+        """Queues *action* for a watcher and returns the future of the
+        circusd reply to the command it was merged into."""
+        future = Future()
+        if name not in self.pending:
+            self.pending[name] = PendingCommands()
+        self.pending[name].add(action, future)
+        if not self.running:
+            self.run()
+        return future
+
+    @gen.coroutine
+    def run(self):
+        self.running = True
+        try:
+            while self.pending:
+                batch, self.pending = self.pending, OrderedDict()
+                yield [self.send(name, commands)
+                       for name, commands in batch.items()]
+                if self.on_batch is not None:
+                    self.on_batch(list(batch))
+        finally:
+            self.running = False
+
+    @gen.coroutine
+    def send(self, name, commands):
+        yield self.resolve(commands.futures['status'], self.call_status,
+                           name, commands.status)
+        yield self.resolve(commands.futures['processes'],
+                           self.call_processes, name, commands.delta)
+
+    @gen.coroutine
+    def resolve(self, futures, call, *args):
+        """Gives the reply of *call* to the callers waiting for *futures*."""
+        if not futures:
+            return
+        try:
+            res = yield call(*args)
+        except Exception as e:
+            # the callers must not wait forever
+            for future in futures:
+                future.set_exception(e)
+        else:
+            for future in futures:
+                future.set_result(res)
+
+    @gen.coroutine
+    def call_status(self, name, status):
+        if status is None:
+            raise gen.Return(dict(MERGED))
+        if status == 'switch':
+            res = yield self.client.send_message('status', name=name)
+            status = 'stop' if res['status'] == 'active' else 'start'
+        res = yield self.client.send_message(status, name=name)
+        if res['status'] == 'ok':
+            self.client.set_status(name, 'active' if status == 'start'
+                                   else 'stopped')
+        raise gen.Return(res)
+
+    @gen.coroutine
+    def call_processes(self, name, delta):
+        if not delta:
+            raise gen.Return(dict(MERGED))
+        command = 'incr' if delta > 0 else 'decr'
+        res = yield self.client.send_message(command, name=name,
+                                             nb=abs(delta))
+        if res['status'] == 'ok':
+            self.client.set_watcher_option(name, 'numprocesses',
+                                           res['numprocesses'])
+        raise gen.Return(res)
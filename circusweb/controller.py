@@ -1,166 +1,582 @@
-from circus.commands import get_commands
+import json
+import time
+from collections import defaultdict
+from datetime import timedelta
+
+from circus.exc import CallError
+from circusweb import logger
 from circusweb.client import AsynchronousCircusClient
+from circusweb.command_queue import CommandQueue
 from circusweb.stats_client import AsynchronousStatsConsumer
-from circusweb.namespace import SocketIOConnection
+from circusweb.stats_history import StatsAggregates, StatsHistory
+from circusweb.namespace import ALL_PIDS, StatsStream
 
 from tornado import gen
 
-cmds = get_commands()
+# circusd events changing the pids of a watcher, with the key holding the pid
+PID_EVENTS = {'spawn': 'process_pid', 'reap': 'process_pid',
+              'kill': 'process_pid'}
+STATUS_EVENTS = {'start': 'active', 'stop': 'stopped'}
+
+# bulk actions -> function returning the circusd command and its properties
+BULK_ACTIONS = {
+    'incr': lambda name, args: ('incr', dict(name=name,
+                                             nb=int(args.get('nb', 1)))),
+    'decr': lambda name, args: ('decr', dict(name=name,
+                                             nb=int(args.get('nb', 1)))),
+    'start': lambda name, args: ('start', dict(name=name)),
+    'stop': lambda name, args: ('stop', dict(name=name)),
+    'restart': lambda name, args: ('restart', dict(name=name)),
+    'kill': lambda name, args: ('signal', dict(name=name,
+                                               pid=int(args['pid']),
+                                               signum=9, recursive=True)),
+}
+
+
+def get_history_key(watcher, pid, stat):
+    """Returns the (name, pid) under which a stat is kept in the history.
+
+    The stats of the circus processes are all published under the 'circus'
+    topic with their name in the message, and the stats of a single socket
+    are identified by their fd.
+    """
+    if watcher == 'circus':
+        return stat.get('name', watcher), None
+    if watcher == 'sockets':
+        return watcher, stat.get('fd')
+    return watcher, None if pid is None else int(pid)
+
+
+# circusd-stats publishes the stats of its own processes under 'circus'
+CIRCUS_PROCESSES = ('circus', 'circusd', 'circusd-stats', 'circushttpd')
+
+
+def get_stats_topics(watcher, pid=None):
+    """Returns the circusd-stats topics carrying the stats of a watcher, of
+    one of its processes or of all of them when *pid* is ALL_PIDS.
+
+    zmq filters the topics by prefix, so the topic of a watcher also
+    brings the stats of its processes.
+    """
+    if watcher == 'sockets':
+        return ['stat.sockets']
+    topics = []
+    if watcher in CIRCUS_PROCESSES:
+        topics.append('stat.circus')
+    if watcher != 'circus':
+        if pid is None:
+            topics.append('stat.%s' % watcher)
+        elif pid == ALL_PIDS:
+            topics.append('stat.%s.' % watcher)
+        else:
+            topics.append('stat.%s.%s' % (watcher, pid))
+    return topics
 
 
 class Controller(object):
-    def __init__(self, loop, ssh_server=None):
+    def __init__(self, loop, ssh_server=None, status_ttl=2.,
+                 client_options=None, refresh_delay=.5,
+                 stats_history_size=120, stats_history_series=5000,
+                 stats_history_replay=300, stats_aggregates_size=144,
+                 stats_aggregates_series=1000, relay=None,
+                 stats_options=None, release_delay=30., query_ttl=0.,
+                 stats_on_demand=False):
         self.clients = {}
+        # endpoint -> future of the client being created, see connect
+        self.connecting = {}
         self.stats_clients = {}
+        self.pubsub_clients = {}
         self.loop = loop
         self.ssh_server = ssh_server
+        self.status_ttl = status_ttl
+        # extra keyword arguments for AsynchronousCircusClient
+        self.client_options = client_options or {}
+        # (endpoint, watcher name or None) -> pending refresh timeout
+        self.refreshes = {}
+        self.refresh_delay = refresh_delay
+        self.stats_history = StatsHistory(stats_history_size,
+                                          stats_history_series)
+        # number of seconds of history sent to newly opened pages
+        self.stats_history_replay = stats_history_replay
+        self.stats_aggregates = StatsAggregates(stats_aggregates_size,
+                                                stats_aggregates_series)
+        # address of the StatsRelay shared by the circushttpd processes
+        self.relay = relay
+        # extra keyword arguments for the AsynchronousStatsConsumer of the
+        # stats endpoints
+        self.stats_options = stats_options or {}
+        # when true, the stats consumers only subscribe to the stats shown
+        # by the pages, and the history and aggregates only cover those.
+        # Otherwise they receive all the stats of the endpoints connected,
+        # see create_client
+        self.stats_on_demand = stats_on_demand
+        # seconds during which the clients and consumers of an endpoint
+        # nobody uses any more are kept, e.g. for a page being reloaded
+        self.release_delay = release_delay
+        # (kind, endpoint) -> pending release timeout, see schedule_release
+        self.releases = {}
+        # (endpoint, command, properties) -> (future, expiration timeout),
+        # see query
+        self.queries = {}
+        self.query_ttl = query_ttl
+        # endpoint -> CommandQueue
+        self.queues = {}
 
     @gen.coroutine
     def connect(self, endpoint):
+        """Takes a reference on the client of an endpoint, creating it
+        first if needed.
+
+        The connections asked for while the client is being created wait
+        for it instead of creating their own.
+        """
         endpoint = str(endpoint)
-        if endpoint not in self.clients:
-            client = AsynchronousCircusClient(self.loop, endpoint,
-                                              ssh_server=self.ssh_server)
-            yield gen.Task(client.update_watchers)
-        else:
-            client = self.get_client(endpoint)
-        client.count += 1
+        while endpoint not in self.clients:
+            future = self.connecting.get(endpoint)
+            if future is None:
+                future = self.create_client(endpoint)
+                self.connecting[endpoint] = future
+            try:
+                yield future
+            finally:
+                if self.connecting.get(endpoint) is future:
+                    del self.connecting[endpoint]
+        self.cancel_release('client', endpoint)
+        self.clients[endpoint].count += 1
+
+    @gen.coroutine
+    def create_client(self, endpoint):
+        client = AsynchronousCircusClient(self.loop, endpoint,
+                                          ssh_server=self.ssh_server,
+                                          **self.client_options)
+        try:
+            yield client.update_watchers()
+        except CallError:
+            client.stop()
+            raise
         self.clients[endpoint] = client
+        self.connect_to_pubsub_endpoint(endpoint, client.pubsub_endpoint)
+        if not self.stats_on_demand and client.stats_endpoint:
+            # keeps the history and aggregates of all the watchers for as
+            # long as the endpoint is connected
+            self.connect_to_stats_endpoint(client.stats_endpoint)
 
     def disconnect(self, endpoint):
         endpoint = str(endpoint)
-        if endpoint not in self.clients:
+        if endpoint not in self.clients or self.clients[endpoint].count <= 0:
             return
         self.clients[endpoint].count -= 1
 
         if self.clients[endpoint].count <= 0:
-            del self.clients[endpoint]
+            self.schedule_release('client', endpoint, self.release_client)
+
+    def release_client(self, endpoint):
+        self.forget_queries(endpoint)
+        self.queues.pop(endpoint, None)
+        client = self.clients.pop(endpoint)
+        client.stop()
+        if not self.stats_on_demand and client.stats_endpoint:
+            self.disconnect_stats_endpoint(client.stats_endpoint)
+        pubsub_client = self.pubsub_clients.pop(endpoint, None)
+        if pubsub_client is not None:
+            pubsub_client.stop()
+
+    def schedule_release(self, kind, endpoint, release):
+        """Calls *release* with *endpoint* after *release_delay* seconds,
+        unless the endpoint is used again in the meantime, see
+        cancel_release."""
+        key = kind, endpoint
+        if key in self.releases:
+            return
+        if self.release_delay <= 0:
+            release(endpoint)
+            return
+
+        def timeout():
+            del self.releases[key]
+            release(endpoint)
+
+        self.releases[key] = self.loop.add_timeout(
+            timedelta(seconds=self.release_delay), timeout)
+
+    def cancel_release(self, kind, endpoint):
+        timeout = self.releases.pop((kind, endpoint), None)
+        if timeout is not None:
+            self.loop.remove_timeout(timeout)
+
+    def get_counters(self):
+        """Returns the number of clients and consumers alive, and of the
+        references to them."""
+        return {
+            'clients': len(self.clients),
+            'client_references': sum(client.count for client in
+                                     self.clients.values()),
+            'pubsub_consumers': len(self.pubsub_clients),
+            'stats_consumers': len(self.stats_clients),
+            'stats_references': sum(stats_client.count for stats_client in
+                                    self.stats_clients.values()),
+            'pending_releases': len(self.releases)}
+
+    def connect_to_pubsub_endpoint(self, endpoint, pubsub_endpoint):
+        if endpoint in self.pubsub_clients or not pubsub_endpoint:
+            return
+
+        def callback(name, action, msg, __):
+            self.on_watcher_event(endpoint, name, action, msg)
+
+        self.pubsub_clients[endpoint] = AsynchronousStatsConsumer(
+            ['watcher.'], self.loop, callback, endpoint=str(pubsub_endpoint),
+            ssh_server=self.ssh_server, relay=self.relay)
+
+    def on_watcher_event(self, endpoint, name, action, msg):
+        """Called for every event published by circusd on its pubsub
+        endpoint, patches the state of the client in place."""
+        client = self.get_client(endpoint)
+        if client is None or name in ('circusd-stats', 'circushttpd'):
+            return
+        self.forget_queries(endpoint)
+
+        if name not in client.watchers_options:
+            # a watcher we don't know about yet, e.g. added by circusctl
+            self.schedule_refresh(endpoint)
+            return
+
+        if action in STATUS_EVENTS:
+            client.set_status(name, STATUS_EVENTS[action])
+        elif action in PID_EVENTS:
+            pid = msg.get(PID_EVENTS[action])
+            pids = client.pids.get(name)
+            if pids is not None and pid is not None:
+                if action == 'spawn':
+                    pids.add(int(pid))
+                else:
+                    pids.discard(int(pid))
+                client.touch()
+                numprocesses = client.watchers_options[name].get(
+                    'numprocesses')
+                if action != 'kill' and len(pids) != numprocesses:
+                    # numprocesses changed behind our back, a process is
+                    # being respawned or we missed an event: the options
+                    # are checked later and the pids listed again
+                    del client.pids[name]
+                    self.schedule_refresh(endpoint, name)
+        else:
+            self.schedule_refresh(endpoint, name)
+
+    def schedule_refresh(self, endpoint, name=None):
+        """Refreshes the options of a watcher, or of all the watchers when
+        *name* is None, after *refresh_delay* seconds.
+
+        Refreshes asked for while one is pending are merged into it.
+        """
+        key = endpoint, name
+        if key in self.refreshes or (endpoint, None) in self.refreshes:
+            return
+
+        @gen.coroutine
+        def refresh():
+            del self.refreshes[key]
+            client = self.get_client(endpoint)
+            if client is None:
+                return
+            if name is None:
+                yield client.update_watchers()
+            else:
+                yield client.update_watcher(name)
+
+        self.refreshes[key] = self.loop.add_timeout(
+            timedelta(seconds=self.refresh_delay), refresh)
 
     def connect_to_stats_endpoint(self, stats_endpoint):
         stats_endpoint = str(stats_endpoint)
         if stats_endpoint in self.stats_clients:
+            self.cancel_release('stats', stats_endpoint)
+            self.stats_clients[stats_endpoint].count += 1
             return
 
+        # subscribed to all the stats, or only to the topics asked for by
+        # the pages, see subscribe_stats
+        topics = [] if self.stats_on_demand else ['stat.']
         stats_client = AsynchronousStatsConsumer(
-            ['stat.'], self.loop,
-            SocketIOConnection.consume_stats, endpoint=stats_endpoint,
-            ssh_server=self.ssh_server)
+            topics, self.loop,
+            self.consume_stats, endpoint=stats_endpoint,
+            ssh_server=self.ssh_server, relay=self.relay,
+            **self.stats_options)
 
         stats_client.count += 1
         self.stats_clients[stats_endpoint] = stats_client
+        for key in list(StatsStream.subscriptions):
+            if key[0] == stats_endpoint:
+                self.subscribe_stats(*key)
 
     def disconnect_stats_endpoint(self, stats_endpoint):
         stats_endpoint = str(stats_endpoint)
-        if stats_endpoint not in self.stats_clients:
+        stats_client = self.stats_clients.get(stats_endpoint)
+        if stats_client is None or stats_client.count <= 0:
             return
-        self.stats_clients[stats_endpoint].count -= 1
+        stats_client.count -= 1
+
+        if stats_client.count <= 0:
+            self.schedule_release('stats', stats_endpoint,
+                                  self.release_stats_endpoint)
 
-        if self.stats_clients[stats_endpoint].count <= 0:
-            del self.stats_clients[stats_endpoint]
+    def release_stats_endpoint(self, stats_endpoint):
+        self.stats_clients.pop(stats_endpoint).stop()
+
+    def subscribe_stats(self, stats_endpoint, watcher, pid=None):
+        """Starts receiving the stats of a watcher or of its processes from
+        a stats endpoint."""
+        stats_client = self.stats_clients.get(str(stats_endpoint))
+        if stats_client is not None:
+            for topic in get_stats_topics(watcher, pid):
+                stats_client.subscribe(topic)
+
+    def unsubscribe_stats(self, stats_endpoint, watcher, pid=None):
+        stats_client = self.stats_clients.get(str(stats_endpoint))
+        if stats_client is not None:
+            for topic in get_stats_topics(watcher, pid):
+                stats_client.unsubscribe(topic)
 
     def get_client(self, endpoint):
         return self.clients.get(endpoint)
 
+    def query(self, endpoint, command, fresh=False, **props):
+        """Sends a read-only command to an endpoint and returns the future
+        of its reply.
+
+        The identical commands sent while it is in flight, and during the
+        *query_ttl* seconds following its reply, share this future instead
+        of sending their own. When *fresh* is true, e.g. right after a
+        change, a new command is sent and shared instead.
+        """
+        key = endpoint, command, json.dumps(props, sort_keys=True)
+        if key in self.queries and not fresh:
+            return self.queries[key][0]
+        self.forget_query(key)
+
+        future = self.get_client(endpoint).send_message(command, **props)
+        self.queries[key] = future, None
+
+        def done(future):
+            if self.queries.get(key, (None,))[0] is not future:
+                return
+            if future.exception() is not None or self.query_ttl <= 0:
+                del self.queries[key]
+                return
+            timeout = self.loop.add_timeout(
+                timedelta(seconds=self.query_ttl),
+                lambda: self.forget_query(key))
+            self.queries[key] = future, timeout
+
+        future.add_done_callback(done)
+        return future
+
+    def forget_query(self, key):
+        future, timeout = self.queries.pop(key, (None, None))
+        if timeout is not None:
+            self.loop.remove_timeout(timeout)
+
+    def forget_queries(self, endpoint):
+        """Forgets the queries of an endpoint, e.g. once its state changed.
+
+        The callers already waiting for a query in flight still get its
+        reply, the next ones send a new command.
+        """
+        for key in list(self.queries):
+            if key[0] == endpoint:
+                self.forget_query(key)
+
     @gen.coroutine
     def killproc(self, name, pid, endpoint):
         client = self.get_client(endpoint)
-        res = yield gen.Task(client.send_message, 'signal', name=name,
-                             pid=int(pid), signum=9, recursive=True)
-        yield gen.Task(client.update_watchers)  # will do better later
+        res = yield client.send_message('signal', name=name, pid=int(pid),
+                                        signum=9, recursive=True)
+        # the pids are updated by the kill/reap/spawn events
         raise gen.Return(res)
 
     def get_option(self, name, option, endpoint):
         client = self.get_client(endpoint)
-        watchers = dict(client.watchers)
-        return watchers[name][option]
+        return client.watchers_options[name][option]
 
     @gen.coroutine
     def get_global_options(self, endpoint):
-        client = self.get_client(endpoint)
-        res = yield gen.Task(client.send_message, 'globaloptions')
+        res = yield self.query(endpoint, 'globaloptions')
         raise gen.Return(res['options'])
 
     def get_options(self, name, endpoint):
         client = self.get_client(endpoint)
-        watchers = dict(client.watchers)
-        return watchers[name].items()
+        return client.watchers_options[name].items()
+
+    def get_queue(self, endpoint):
+        """Returns the CommandQueue of an endpoint, the watchers of each of
+        its batches are refreshed once it is done."""
+        client = self.get_client(endpoint)
+        queue = self.queues.get(endpoint)
+        if queue is None or queue.client is not client:
+            def on_batch(names):
+                for name in names:
+                    self.schedule_refresh(endpoint, name)
+
+            queue = CommandQueue(client, on_batch)
+            self.queues[endpoint] = queue
+        return queue
 
     @gen.coroutine
     def incrproc(self, name, endpoint):
-        client = self.get_client(endpoint)
-        res = yield gen.Task(client.send_message, 'incr', name=name)
-        yield gen.Task(client.update_watchers)  # will do better later
+        res = yield self.get_queue(endpoint).put(name, 'incr')
         raise gen.Return(res)
 
     @gen.coroutine
     def decrproc(self, name, endpoint):
-        client = self.get_client(endpoint)
-        res = yield gen.Task(client.send_message, 'decr', name=name)
-        yield gen.Task(client.update_watchers)  # will do better later
+        res = yield self.get_queue(endpoint).put(name, 'decr')
         raise gen.Return(res)
 
-    def get_stats(self, name, start=0, end=-1):
-        return self.stats[name][start:end]
+    def consume_stats(self, watcher, pid, stat, stats_endpoint):
+        """Keeps the stats in the history and sends them to the browsers."""
+        name, key = get_history_key(watcher, pid, stat)
+        self.stats_history.add(stats_endpoint, name, key, stat)
+        self.stats_aggregates.add(stats_endpoint, name, key, stat)
+        StatsStream.consume_stats(watcher, pid, stat, stats_endpoint)
+
+    def get_stats(self, stats_endpoint, name, pid=None, since=None):
+        """Returns the stats kept for a process, or for the aggregation of
+        a watcher when *pid* is None.
 
-    def get_dstats(self, field, start=0, end=-1):
-        stats = self.dstats[start:end]
-        res = []
-        for stat in stats:
-            res.append(stat[field])
-        return res
+        By default, only the last *stats_history_replay* seconds are
+        returned.
+        """
+        if since is None:
+            since = time.time() - self.stats_history_replay
+        return self.stats_history.get_samples(str(stats_endpoint), name, pid,
+                                              since)
+
+    def get_aggregates(self, stats_endpoint, name, metric, tier, pid=None,
+                       since=0.):
+        """Returns the min/max/avg of a metric over buckets of *tier*
+        seconds, for a process or for a watcher when *pid* is None."""
+        return self.stats_aggregates.get(str(stats_endpoint), name, pid,
+                                         metric, tier, since)
 
     @gen.coroutine
     def get_pids(self, name, endpoint):
         client = self.get_client(endpoint)
-        res = yield gen.Task(client.send_message, 'list', name=name)
-        raise gen.Return(res['pids'])
+        if name in client.pids and endpoint in self.pubsub_clients:
+            # kept up to date by the pubsub events
+            raise gen.Return(sorted(client.pids[name]))
+        res = yield self.query(endpoint, 'list', name=name)
+        pids = set(int(pid) for pid in res['pids'])
+        if pids != client.pids.get(name):
+            client.pids[name] = pids
+            client.touch()
+        # the reply is shared by the callers, see query
+        raise gen.Return(list(res['pids']))
 
     @gen.coroutine
     def get_sockets(self, endpoint, force_reload=False):
         client = self.get_client(endpoint)
         if not client.sockets or force_reload:
-            res = yield gen.Task(client.send_message, 'listsockets')
-            client.sockets = res['sockets']
+            res = yield self.query(endpoint, 'listsockets',
+                                   fresh=force_reload)
+            if res['sockets'] != client.sockets:
+                client.sockets = list(res['sockets'])
+                client.touch()
         raise gen.Return(client.sockets)
 
+    @gen.coroutine
+    def get_statuses(self, endpoint, force_reload=False):
+        """Fetches the status of all the watchers of an endpoint at once.
+
+        The result is cached for *status_ttl* seconds, or until circusd
+        publishes an event about one of the watchers.
+        """
+        client = self.get_client(endpoint)
+        expired = time.time() - client.statuses_time > self.status_ttl
+        if expired or force_reload:
+            res = yield self.query(endpoint, 'status', fresh=force_reload)
+            if res['statuses'] != client.statuses:
+                # the reply is shared by the callers, see query
+                client.statuses = dict(res['statuses'])
+                client.touch()
+            client.statuses_time = time.time()
+        raise gen.Return(client.statuses)
+
     def get_status(self, name, endpoint):
+        """Returns the cached status of a watcher, see get_statuses."""
         client = self.get_client(endpoint)
-        res = client.send_message('status', name=name)
-        return res['status']
+        return client.statuses.get(name, 'unknown')
 
     @gen.coroutine
     def switch_status(self, name, endpoint):
-        msg = cmds['status'].make_message(name=name)
-        client = self.get_client(endpoint)
-        res = yield gen.Task(client.call, msg)
-        status = res['status']
-        if status == 'active':
-            # stopping the watcher
-            msg = cmds['stop'].make_message(name=name)
-        else:
-            msg = cmds['start'].make_message(name=name)
-        res = yield gen.Task(client.call, msg)
-
+        res = yield self.get_queue(endpoint).put(name, 'switch')
         raise gen.Return(res)
 
+    @gen.coroutine
+    def bulk(self, operations):
+        """Runs a list of (endpoint, watcher, action, args) operations.
+
+        All the operations are sent at once, and the watchers of each
+        endpoint are refreshed once they all got their reply, the others
+        are left as they are. Returns the circusd response of each
+        operation, in order.
+        """
+        results = [None] * len(operations)
+        by_endpoint = defaultdict(list)
+        for index, (endpoint, name, action, args) in enumerate(operations):
+            by_endpoint[str(endpoint)].append((index, name, action, args))
+
+        @gen.coroutine
+        def run(client, index, name, action, args):
+            try:
+                command, props = BULK_ACTIONS[action](name, args or {})
+                results[index] = yield client.send_message(command, **props)
+            except KeyError as e:
+                results[index] = {'status': 'error',
+                                  'reason': 'Missing or unknown %s' % e}
+            except (CallError, TypeError, ValueError) as e:
+                results[index] = {'status': 'error', 'reason': str(e)}
+
+        @gen.coroutine
+        def run_endpoint(endpoint, operations):
+            client = self.get_client(endpoint)
+            if client is None:
+                for index, __, __, __ in operations:
+                    results[index] = {'status': 'error',
+                                      'reason': 'Not connected to %s' %
+                                      endpoint}
+                return
+            yield [run(client, *operation) for operation in operations]
+            client.statuses_time = 0
+            self.forget_queries(endpoint)
+            names = set(name for __, name, __, __ in operations
+                        if name in client.watchers_options)
+            try:
+                yield [client.update_watcher(name) for name in names]
+            except CallError as e:
+                logger.error('Could not refresh %s: %s' % (endpoint, e))
+
+        yield [run_endpoint(endpoint, endpoint_operations)
+               for endpoint, endpoint_operations in by_endpoint.items()]
+        raise gen.Return(results)
+
     @gen.coroutine
     def reloadconfig(self, endpoint):
         client = self.get_client(endpoint)
-        res = yield gen.Task(client.send_message, 'reloadconfig')
-        yield gen.Task(client.update_watchers)
+        res = yield client.send_message('reloadconfig')
+        client.statuses_time = 0
+        yield client.update_watchers()
         raise gen.Return(res)
 
     @gen.coroutine
     def add_watcher(self, name, endpoint, cmd, **kw):
         client = self.get_client(endpoint)
-        res = yield gen.Task(client.send_message, 'add', name=name, cmd=cmd)
+        res = yield client.send_message('add', name=name, cmd=cmd)
         if res['status'] == 'ok':
             # now configuring the options
             options = {}
             options['numprocesses'] = int(kw.get('numprocesses', '5'))
             options['working_dir'] = kw.get('working_dir')
             options['shell'] = kw.get('shell', 'off') == 'on'
-            res = yield gen.Task(client.send_message, 'set',
-                                 name=name, options=options)
-            yield gen.Task(client.update_watchers)
+            res = yield client.send_message('set', name=name, options=options)
+            client.statuses_time = 0
+            yield client.update_watcher(name)
         raise gen.Return(res)
@@ -0,0 +1,31 @@
+from collections import OrderedDict
+
+
+class FragmentCache(object):
+    """Keeps rendered template fragments, such as the watchers table of an
+    endpoint, until the state they were rendered from changes.
+
+    Each fragment is stored under a key along with the version of the state
+    it was rendered from, a different version renders it again. At most
+    *max_size* fragments are kept, the least recently used are dropped.
+    """
+
+    def __init__(self, max_size=100):
+        self.max_size = max_size
+        self.fragments = OrderedDict()
+
+    def get(self, key, version, render):
+        """Returns the fragment cached for *key* and *version*, calling
+        *render* if there is none."""
+        cached = self.fragments.pop(key, None)
+        if cached is not None and cached[0] == version:
+            content = cached[1]
+        else:
+            content = render()
+        self.fragments[key] = version, content
+        while len(self.fragments) > self.max_size:
+            self.fragments.popitem(last=False)
+        return content
+
+    def clear(self):
+        self.fragments.clear()
@@ -29,7 +29,7 @@ function hookGraph(socket, watcher, graph_id, metrics, prefix, capValues, config
                   timeBase: new Date().getTime() / 1000 })
     });
 
-    socket.on(prefix + graph_id, function(received) {
+    function addSample(received) {
         var data = {};
 
         // cap to 100
@@ -55,8 +55,167 @@ function hookGraph(socket, watcher, graph_id, metrics, prefix, capValues, config
         }
 
         graph.series.addData(data);
+    }
+
+    function addSamples(samples) {
+        samples.forEach(addSample);
+        graph.render();
+    }
+
+    socket.on(prefix + graph_id, function(received) {
+        addSample(received);
         graph.render();
     });
+
+    // the stats kept by the server, sent once when the page is opened
+    socket.on('history-' + prefix + graph_id, function(received) {
+        addSamples(received.samples);
+    });
+
+    // the stats sent in batches, see hookBatches
+    socket.statsHandlers[prefix + graph_id] = addSamples;
+}
+
+
+function hookBatches(socket) {
+    // the server may gather the stats of all the graphs in a single
+    // message, render each graph once per message.
+    socket.statsHandlers = {};
+    function dispatch(frames) {
+        for (var channel in frames) {
+            var handler = socket.statsHandlers[channel];
+            if (handler != undefined) {
+                handler(frames[channel]);
+            }
+        }
+    }
+
+    socket.on('stats-batch', function(received) {
+        dispatch(received.frames);
+    });
+
+    // the compact format: the channels get an id the first time their
+    // stats are sent, then each sample is [id, cpu, mem, age] in a flat
+    // array.
+    var channels = {};
+    socket.on('stats-channels', function(received) {
+        for (var name in received.channels) {
+            channels[received.channels[name]] = name;
+        }
+    });
+
+    socket.on('stats-compact', function(received) {
+        var data = received.data;
+        var frames = {};
+        for (var i = 0; i < data.length; i += 4) {
+            var channel = channels[data[i]];
+            if (!frames.hasOwnProperty(channel)) { frames[channel] = []; }
+            frames[channel].push({ cpu: data[i + 1], mem: data[i + 2],
+                                   age: data[i + 3] });
+        }
+        dispatch(frames);
+    });
+}
+
+
+function hookLazyGraphs(socket, watcher, stats_endpoint, pids, config) {
+    // the graph of a process is created, and its stats streamed, only once
+    // it gets close to the viewport. The stats stop when it leaves it.
+    var hooked = {};
+    var changes = {};
+    var timer = null;
+
+    function flush() {
+        var subscribe = [], unsubscribe = [], history = [];
+        for (var pid in changes) {
+            if (!changes[pid]) {
+                unsubscribe.push(pid);
+                continue;
+            }
+            subscribe.push(pid);
+            if (!hooked[pid]) {
+                // the stats kept by the server are only sent once
+                hookGraph(socket, watcher + '-' + pid,
+                          watcher + '-' + pid + '-' + stats_endpoint,
+                          ['cpu', 'mem'], 'stats-', false, config);
+                hooked[pid] = true;
+                history.push(pid);
+            }
+        }
+        changes = {};
+        timer = null;
+
+        if (subscribe.length) {
+            socket.emit('subscribe_pids', { watcher: watcher,
+                                            stats_endpoint: stats_endpoint,
+                                            pids: subscribe,
+                                            history: history });
+        }
+        if (unsubscribe.length) {
+            socket.emit('unsubscribe_pids', { watcher: watcher,
+                                              stats_endpoint: stats_endpoint,
+                                              pids: unsubscribe });
+        }
+    }
+
+    // gather the changes of a scroll in a single message
+    var observer = new IntersectionObserver(function(entries) {
+        entries.forEach(function(entry) {
+            changes[entry.target.getAttribute('data-pid')] = entry.isIntersecting;
+        });
+        if (timer == null) { timer = setTimeout(flush, 200); }
+    }, { rootMargin: '200px' });
+
+    pids.forEach(function(pid) {
+        var node = document.getElementById(watcher + '-' + pid + '-' + stats_endpoint);
+        if (node != null) {
+            node.setAttribute('data-pid', pid);
+            observer.observe(node);
+        }
+    });
+}
+
+
+function StatsSocket(url) {
+    // the socket.io events over a plain WebSocket, see circusweb/websocket.py
+    var self = this;
+    this.handlers = {};
+    this.queue = [];
+    this.ws = new WebSocket(url);
+    this.ws.onopen = function() {
+        self.queue.forEach(function(message) { self.ws.send(message); });
+        self.queue = [];
+    };
+    this.ws.onmessage = function(message) {
+        var event = JSON.parse(message.data);
+        var handlers = self.handlers[event.name] || [];
+        handlers.forEach(function(handler) {
+            handler.apply(self, event.args);
+        });
+    };
+}
+
+StatsSocket.prototype.on = function(name, handler) {
+    if (!this.handlers.hasOwnProperty(name)) { this.handlers[name] = []; }
+    this.handlers[name].push(handler);
+};
+
+StatsSocket.prototype.emit = function(name, data) {
+    var message = JSON.stringify({ name: name, args: [data] });
+    if (this.ws.readyState == WebSocket.OPEN) {
+        this.ws.send(message);
+    } else {
+        this.queue.push(message);
+    }
+};
+
+
+function connectStats(server) {
+    // a WebSocket when the browser has them, socket.io otherwise
+    if (window.WebSocket === undefined) {
+        return io.connect(server);
+    }
+    return new StatsSocket(server.replace(/^http/, 'ws') + 'stats/websocket');
 }
 
 
@@ -64,7 +223,9 @@ function supervise(socket, watchers, watchersWithPids, endpoints, stats_endpoint
 
     if (watchersWithPids == undefined) { watchersWithPids = []; }
     if (config == undefined) { config = DEFAULT_CONFIG; }
+    var lazy = window.IntersectionObserver !== undefined;
 
+    hookBatches(socket);
     watchers_to_send = [];
 
     watchers.forEach(function(watcher_tuple) {
@@ -99,6 +260,11 @@ function supervise(socket, watchers, watchersWithPids, endpoints, stats_endpoint
         } else {
             // get the list of processes for this watcher from the server
             socket.on('stats-' + watcher + '-pids-' + watcher_endpoint, function(data) {
+                if (lazy) {
+                    hookLazyGraphs(socket, watcher, watcher_stats_endpoint,
+                                   data.pids, config);
+                    return;
+                }
                 data.pids.forEach(function(pid) {
                     var id = watcher + '-' + pid;
                     var graph_id = watcher + '-' + pid + '-' + watcher_stats_endpoint;
@@ -118,7 +284,9 @@ function supervise(socket, watchers, watchersWithPids, endpoints, stats_endpoint
     socket.emit('get_stats', { watchers: watchers_to_send,
                                watchersWithPids: watchers_with_pid_to_send,
                                endpoints: endpoints,
-                               stats_endpoints: stats_endpoints});
+                               stats_endpoints: stats_endpoints,
+                               lazy: lazy,
+                               compact: true});
 }
 
 $(document).ready(function() {
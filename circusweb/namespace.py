@@ -1,30 +1,109 @@
+import time
+from collections import OrderedDict
+
 import tornadio2
+from tornadio2 import proto
 from tornado import gen
+from tornado.ioloop import PeriodicCallback
 from collections import defaultdict
 from base64 import b64encode, b64decode
 
 
-class SocketIOConnection(tornadio2.SocketConnection):
+# the 'circus' graph shows the stats published for the circusd process
+HISTORY_NAMES = {'circus': 'circusd'}
+
+# subscription to the stats of every process of a watcher
+ALL_PIDS = '*'
+
+# metrics of the samples sent in the compact format, in order
+COMPACT_METRICS = ('cpu', 'mem', 'age')
+
+_encoded_endpoints = {}
+
+
+def encode_endpoint(endpoint):
+    """Memoized b64encode, endpoints are part of every channel name."""
+    encoded = _encoded_endpoints.get(endpoint)
+    if encoded is None:
+        encoded = _encoded_endpoints[endpoint] = b64encode(endpoint)
+    return encoded
+
+
+class StatsStream(object):
+    """The stats stream of a page, whatever its transport.
+
+    The subscriptions and batches are shared by all the streams. The
+    transports implement emit(name, **kwargs), encode(name, kwargs) and
+    send_encoded(name, message) to send an encoded event, is_closed,
+    close(), queue_size() returning the number of messages not sent yet,
+    and an *encoding* attribute naming the messages which encode() returns
+    for the same arguments, so broadcast() encodes them once.
+
+    A page with more than *max_queue* messages waiting is slow: only the
+    latest stats of each of its channels are kept until it catches up, and
+    it is disconnected if it stays slow for *slow_timeout* seconds.
+    """
 
     participants = defaultdict(set)
+    # (stats endpoint, watcher, pid) -> connections, pid is None for the
+    # aggregated stats of a watcher
+    subscriptions = defaultdict(set)
 
-    def __init__(self, *args, **kwargs):
-        super(SocketIOConnection, self).__init__(*args, **kwargs)
+    # when set, the stats are sent every *batch_window* seconds in a single
+    # 'stats-batch' event per connection
+    batch_window = None
+    batched = set()
+    _flush_callback = None
+
+    max_queue = 100
+    slow_timeout = 30.
+
+    streams = set()
+    metrics = {'dropped': 0, 'evicted': 0}
+
+    def init_stream(self):
         self.stats_endpoints = []
+        self.watchers = []
+        self.watchersWithPids = []
+        self.subscription_keys = set()
+        self.pending_stats = {}
+        # compact format, channel name -> id known by the page
+        self.compact = False
+        self.channel_ids = {}
+        # channel -> latest encoded stats, while the page is slow
+        self.coalesced = OrderedDict()
+        self.slow_since = None
+        self.dropped = 0
+        StatsStream.streams.add(self)
 
-    def on_close(self):
+    def close_stream(self):
         from circusweb.session import get_controller  # Circular import
         controller = get_controller()
+        self.unsubscribe_all()
+        StatsStream.streams.discard(self)
+        StatsStream.batched.discard(self)
+        self.coalesced.clear()
         for endpoint in self.stats_endpoints:
             self.participants[endpoint].discard(self)
             controller.disconnect_stats_endpoint(endpoint)
 
-    @tornadio2.event
     @gen.coroutine
     def get_stats(self, watchers=[], watchersWithPids=[],
-                  endpoints=[], stats_endpoints=[]):
+                  endpoints=[], stats_endpoints=[], lazy=False,
+                  compact=False):
+        """Starts streaming the stats of *watchers* and of the processes of
+        *watchersWithPids*.
+
+        When *lazy* is true, the stats of the processes are only sent once
+        asked for with subscribe_pids, e.g. when their graph is visible.
+
+        When *compact* is true, the cpu, mem and age samples are sent as
+        flat arrays in 'stats-compact' events, see send_compact.
+        """
         from circusweb.session import get_controller  # Circular import
         controller = get_controller()
+        history = []
+        lists = []
 
         for watcher_tuple in watchersWithPids:
             watcher, encoded_endpoint = watcher_tuple
@@ -33,62 +112,365 @@ class SocketIOConnection(tornadio2.SocketConnection):
                 sockets = yield gen.Task(controller.get_sockets,
                                          endpoint=endpoint)
                 fds = [s['fd'] for s in sockets]
-                self.emit('socket-stats-fds-{endpoint}'.format(
-                    endpoint=encoded_endpoint), fds=fds)
+                lists.append(('socket-stats-fds-{endpoint}'.format(
+                    endpoint=encoded_endpoint), {'fds': fds}))
+                history.append((watcher, fds, endpoint))
             else:
                 pids = yield gen.Task(controller.get_pids, watcher, endpoint)
                 pids = [int(pid) for pid in pids]
                 channel = 'stats-{watcher}-pids-{endpoint}'.format(
                     watcher=watcher, endpoint=encoded_endpoint)
-                self.emit(channel, pids=pids)
+                lists.append((channel, {'pids': pids}))
+                if not lazy:
+                    history.append((watcher, pids, endpoint))
+
+        if self.is_closed:
+            # closed while listing the pids, close_stream already ran and
+            # would not release the references taken now
+            return
 
         self.watchers = watchers
+        self.compact = compact
 
         # Dirty fix
         self.watchersWithPids = [x[0] for x in watchersWithPids]
+        previous_endpoints = self.stats_endpoints
         self.stats_endpoints = stats_endpoints
 
+        self.unsubscribe_all()
         for endpoint in stats_endpoints:
             controller.connect_to_stats_endpoint(endpoint)
             self.participants[endpoint].add(self)
+            for watcher in self.watchers:
+                self.subscribe(endpoint, watcher)
+            for watcher in self.watchersWithPids:
+                if watcher != 'sockets':
+                    self.subscribe(endpoint, watcher)
+                if watcher == 'sockets' or not lazy:
+                    self.subscribe(endpoint, watcher, ALL_PIDS)
+        # the references of a previous get_stats of this page
+        for endpoint in previous_endpoints:
+            if endpoint not in stats_endpoints:
+                self.participants[endpoint].discard(self)
+            controller.disconnect_stats_endpoint(endpoint)
 
-    @classmethod
-    def consume_stats(cls, watcher, pid, stat, stat_endpoint):
+        # sent once subscribed, the pages may ask for the stats of some of
+        # the processes as soon as they get their list
+        for channel, data in lists:
+            self.emit(channel, **data)
+        self.emit_history(controller, history)
+
+    def subscribe_pids(self, watcher, stats_endpoint, pids, history=[]):
+        """Starts sending the stats of some processes of a watcher, and the
+        stats kept for the ones in *history*."""
+        from circusweb.session import get_controller  # Circular import
+        stat_endpoint = b64decode(stats_endpoint)
+        if stat_endpoint not in self.stats_endpoints:
+            return
+        for pid in pids:
+            # the pids of the stats are read from the zmq topics
+            self.subscribe(stat_endpoint, watcher, str(pid))
+        self.emit_pids_history(get_controller(), watcher,
+                               [int(pid) for pid in history], stat_endpoint)
+
+    def unsubscribe_pids(self, watcher, stats_endpoint, pids):
+        stat_endpoint = b64decode(stats_endpoint)
+        for pid in pids:
+            self.unsubscribe(stat_endpoint, watcher, str(pid))
+
+    def emit_history(self, controller, watchers_pids):
+        """Sends the stats kept by the controller, so the graphs of a newly
+        opened page don't start empty."""
+        def emit(channel, samples):
+            if samples:
+                self.emit('history-' + channel, samples=samples)
+
+        for stat_endpoint in self.stats_endpoints:
+            stat_endpoint_b64 = b64encode(stat_endpoint)
+            for watcher in self.watchers:
+                if watcher == 'sockets':
+                    emit('socket-stats-{endpoint}'.format(
+                        endpoint=stat_endpoint_b64),
+                        controller.get_stats(stat_endpoint, 'sockets'))
+                else:
+                    emit('stats-{watcher}-{endpoint}'.format(
+                        watcher=watcher, endpoint=stat_endpoint_b64),
+                        controller.get_stats(stat_endpoint,
+                                             HISTORY_NAMES.get(watcher,
+                                                               watcher)))
+
+        for watcher, pids, endpoint in watchers_pids:
+            client = controller.get_client(endpoint)
+            if client is None:
+                # released while the pids were fetched
+                continue
+            self.emit_pids_history(controller, watcher, pids,
+                                   client.stats_endpoint)
+
+    def emit_pids_history(self, controller, watcher, pids, stat_endpoint):
+        # pids are fds for the sockets
         stat_endpoint_b64 = b64encode(stat_endpoint)
-        for p in cls.participants[stat_endpoint]:
+        for pid in pids:
             if watcher == 'sockets':
-                # if we get information about sockets and we explicitely
-                # requested them, send back the information.
-                if 'sockets' in p.watchersWithPids and 'fd' in stat:
-                    p.emit('socket-stats-{fd}-{endpoint}'.format(
-                        fd=stat['fd'], endpoint=stat_endpoint_b64),
-                        **stat)
-                elif 'sockets' in p.watchers and 'addresses' in stat:
-                    p.emit('socket-stats-{endpoint}'.format(
-                        endpoint=stat_endpoint_b64), reads=stat['reads'],
-                        adresses=stat['addresses'])
+                channel = 'socket-stats-{fd}-{endpoint}'
             else:
-                available_watchers = p.watchers + p.watchersWithPids + \
-                    ['circus']
-                # these are not sockets but normal watchers
-                if watcher in available_watchers:
-                    if (watcher == 'circus' and
-                            stat.get('name', None) in available_watchers):
-                        p.emit('stats-{watcher}-{endpoint}'.format(
-                            watcher=stat['name'], endpoint=stat_endpoint_b64),
-                            mem=stat['mem'], cpu=stat['cpu'], age=stat['age'])
-                    else:
-                        if pid is None:  # means that it's the aggregation
-                            p.emit('stats-{watcher}-{endpoint}'.format(
-                                watcher=watcher, endpoint=stat_endpoint_b64),
-                                mem=stat['mem'], cpu=stat['cpu'],
-                                age=stat['age'])
-                        else:
-                            if watcher in p.watchersWithPids:
-                                p.emit(
-                                    'stats-{watcher}-{pid}-{endpoint}'.format(
-                                        watcher=watcher, pid=pid,
-                                        endpoint=stat_endpoint_b64),
-                                    mem=stat['mem'],
-                                    cpu=stat['cpu'],
-                                    age=stat['age'])
+                channel = 'stats-{watcher}-{fd}-{endpoint}'
+            samples = controller.get_stats(stat_endpoint, watcher, pid)
+            if samples:
+                self.emit('history-' + channel.format(
+                    watcher=watcher, fd=pid, endpoint=stat_endpoint_b64),
+                    samples=samples)
+
+    def subscribe(self, stat_endpoint, watcher, pid=None):
+        from circusweb.session import get_controller  # Circular import
+        key = stat_endpoint, watcher, pid
+        subscribers = self.subscriptions[key]
+        if not subscribers:
+            # the first page asking for these stats
+            get_controller().subscribe_stats(stat_endpoint, watcher, pid)
+        subscribers.add(self)
+        self.subscription_keys.add(key)
+
+    def unsubscribe(self, stat_endpoint, watcher, pid=None):
+        key = stat_endpoint, watcher, pid
+        if key not in self.subscription_keys:
+            return
+        self.subscription_keys.discard(key)
+        self.discard_subscriber(key)
+
+    def unsubscribe_all(self):
+        for key in self.subscription_keys:
+            self.discard_subscriber(key)
+        self.subscription_keys = set()
+
+    def discard_subscriber(self, key):
+        from circusweb.session import get_controller  # Circular import
+        subscribers = self.subscriptions[key]
+        subscribers.discard(self)
+        if not subscribers:
+            del self.subscriptions[key]
+            get_controller().unsubscribe_stats(*key)
+
+    @classmethod
+    def broadcast(cls, connections, name, **kwargs):
+        """Emits the same event to several connections, the message is only
+        encoded once per socket.io endpoint."""
+        if StatsStream.batch_window:
+            for p in connections:
+                p.queue_stats(name, kwargs)
+            return
+
+        compact = set(COMPACT_METRICS) == set(kwargs)
+        messages = {}
+        for p in connections:
+            if p.is_closed:
+                continue
+            if compact and p.compact:
+                p.send_compact([(name, [kwargs])], name)
+                continue
+            msg = messages.get(p.encoding)
+            if msg is None:
+                msg = messages[p.encoding] = p.encode(name, kwargs)
+            p.deliver(name, msg)
+
+    def check_backpressure(self):
+        """Returns True if the page is slow, disconnects it if it has been
+        for too long."""
+        if self.queue_size() < self.max_queue:
+            self.slow_since = None
+            return False
+        now = time.time()
+        if self.slow_since is None:
+            self.slow_since = now
+        elif now - self.slow_since > self.slow_timeout:
+            StatsStream.metrics['evicted'] += 1
+            self.close()
+        return True
+
+    def deliver(self, channel, message):
+        """Sends the encoded stats of a channel, or keeps them in place of
+        the previous ones of the channel while the page is slow."""
+        if self.is_closed:
+            return
+        if self.coalesced:
+            self.drain()
+        if self.coalesced or self.check_backpressure():
+            if self.is_closed:
+                return
+            if self.coalesced.pop(channel, None) is not None:
+                self.dropped += 1
+                StatsStream.metrics['dropped'] += 1
+            self.coalesced[channel] = message
+            return
+        self.send_encoded(channel, message)
+
+    def drain(self):
+        while self.coalesced and not self.check_backpressure():
+            channel, message = self.coalesced.popitem(last=False)
+            self.send_encoded(channel, message)
+
+    def queue_stats(self, channel, data):
+        if self.slow_since is not None and channel in self.pending_stats:
+            # only the latest samples are sent to the slow pages
+            self.dropped += len(self.pending_stats[channel])
+            StatsStream.metrics['dropped'] += len(self.pending_stats[channel])
+            self.pending_stats[channel] = [data]
+        else:
+            self.pending_stats.setdefault(channel, []).append(data)
+        StatsStream.batched.add(self)
+        if StatsStream._flush_callback is None:
+            StatsStream._flush_callback = PeriodicCallback(
+                StatsStream.flush_stats, StatsStream.batch_window * 1000)
+            StatsStream._flush_callback.start()
+
+    @classmethod
+    def flush_stats(cls):
+        """Sends the stats queued since the last flush, one event per
+        connection with all the samples of all its channels."""
+        batched, StatsStream.batched = StatsStream.batched, set()
+        for p in batched:
+            if p.is_closed:
+                continue
+            if p.check_backpressure():
+                # kept, and coalesced, until the page catches up
+                if not p.is_closed:
+                    StatsStream.batched.add(p)
+                continue
+            frames, p.pending_stats = p.pending_stats, {}
+            if p.compact:
+                packed = [(channel, samples)
+                          for channel, samples in frames.items()
+                          if set(COMPACT_METRICS) == set(samples[0])]
+                if packed:
+                    p.send_compact(packed)
+                    for channel, __ in packed:
+                        del frames[channel]
+            if frames:
+                p.send_encoded('stats-batch',
+                               p.encode('stats-batch', {'frames': frames}))
+        callback = StatsStream._flush_callback
+        if callback is not None and not (StatsStream.batched or
+                                         StatsStream.streams):
+            # no page left, started again by queue_stats
+            callback.stop()
+            StatsStream._flush_callback = None
+
+    def send_compact(self, frames, channel=None):
+        """Sends a list of (channel, samples) as a single flat array of
+        [channel id, cpu, mem, age, ...].
+
+        The id of each channel is assigned the first time its stats are
+        sent, and told to the page in a 'stats-channels' event. A single
+        *channel* is coalesced like the other stats.
+        """
+        data = []
+        new = {}
+        for channel, samples in frames:
+            channel_id = self.channel_ids.get(channel)
+            if channel_id is None:
+                channel_id = new[channel] = self.channel_ids[channel] = \
+                    len(self.channel_ids)
+            for sample in samples:
+                data.extend((channel_id, round(sample['cpu'], 1),
+                             round(sample['mem'], 1), int(sample['age'])))
+        if new:
+            self.emit('stats-channels', channels=new)
+        message = self.encode('stats-compact', {'data': data})
+        if channel is None:
+            self.send_encoded('stats-compact', message)
+        else:
+            self.deliver(channel, message)
+
+    @classmethod
+    def consume_stats(cls, watcher, pid, stat, stat_endpoint):
+        subscriptions = cls.subscriptions
+        stat_endpoint_b64 = encode_endpoint(stat_endpoint)
+
+        if watcher == 'sockets':
+            # if we get information about sockets and we explicitely
+            # requested them, send back the information.
+            if 'fd' in stat:
+                subscribers = subscriptions.get(
+                    (stat_endpoint, watcher, ALL_PIDS))
+                if subscribers:
+                    cls.broadcast(subscribers,
+                                  'socket-stats-{fd}-{endpoint}'.format(
+                                      fd=stat['fd'],
+                                      endpoint=stat_endpoint_b64), **stat)
+            elif 'addresses' in stat:
+                subscribers = subscriptions.get(
+                    (stat_endpoint, watcher, None))
+                if subscribers:
+                    cls.broadcast(subscribers,
+                                  'socket-stats-{endpoint}'.format(
+                                      endpoint=stat_endpoint_b64),
+                                  reads=stat['reads'],
+                                  adresses=stat['addresses'])
+            return
+
+        data = dict(mem=stat['mem'], cpu=stat['cpu'], age=stat['age'])
+
+        if pid is not None:
+            subscribers = subscriptions.get((stat_endpoint, watcher, pid),
+                                            set()) | \
+                subscriptions.get((stat_endpoint, watcher, ALL_PIDS), set())
+            if subscribers:
+                cls.broadcast(subscribers,
+                              'stats-{watcher}-{pid}-{endpoint}'.format(
+                                  watcher=watcher, pid=pid,
+                                  endpoint=stat_endpoint_b64), **data)
+            return
+
+        subscribers = subscriptions.get((stat_endpoint, watcher, None),
+                                        set())
+        if watcher == 'circus':
+            # the stats of the circus processes are sent under their own
+            # name to the pages asking for it, and as 'circus' to the others
+            name = stat.get('name', None)
+            named = subscriptions.get((stat_endpoint, name, None), set())
+            if named:
+                cls.broadcast(named, 'stats-{watcher}-{endpoint}'.format(
+                    watcher=name, endpoint=stat_endpoint_b64), **data)
+            subscribers = cls.participants[stat_endpoint] - named
+
+        if subscribers:
+            cls.broadcast(subscribers, 'stats-{watcher}-{endpoint}'.format(
+                watcher=watcher, endpoint=stat_endpoint_b64), **data)
+
+
+class SocketIOConnection(StatsStream, tornadio2.SocketConnection):
+    """The stats stream over socket.io, through tornadio2."""
+
+    def __init__(self, *args, **kwargs):
+        super(SocketIOConnection, self).__init__(*args, **kwargs)
+        self.init_stream()
+
+    def on_close(self):
+        self.close_stream()
+
+    @tornadio2.event
+    def get_stats(self, **kwargs):
+        return super(SocketIOConnection, self).get_stats(**kwargs)
+
+    @tornadio2.event
+    def subscribe_pids(self, **kwargs):
+        super(SocketIOConnection, self).subscribe_pids(**kwargs)
+
+    @tornadio2.event
+    def unsubscribe_pids(self, **kwargs):
+        super(SocketIOConnection, self).unsubscribe_pids(**kwargs)
+
+    @property
+    def encoding(self):
+        # the socket.io endpoint is part of the messages
+        return self.endpoint
+
+    def encode(self, name, kwargs):
+        return proto.event(self.endpoint, name, None, **kwargs)
+
+    def send_encoded(self, name, message):
+        self.session.send_message(message)
+
+    def queue_size(self):
+        # the messages wait there for the next poll or until written
+        return len(self.session.send_queue)
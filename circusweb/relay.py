@@ -0,0 +1,131 @@
+"""Lets several circushttpd processes share their subscriptions to the
+circusd-stats and circusd pubsub endpoints.
+
+The relay runs in its own process and binds a XPUB socket. The workers
+connect to it with a SUB socket and subscribe to '<endpoint> <topic>'. As
+XPUB only reports the first subscription and the last unsubscription to a
+given topic, the relay subscribes once to each upstream topic whatever the
+number of workers asking for it.
+"""
+import errno
+import os
+import signal
+from functools import partial
+
+import zmq
+from zmq.eventloop import ioloop
+from zmq.eventloop.zmqstream import ZMQStream
+
+from circus.util import get_connection
+
+from circusweb import logger
+
+# endpoints never contain spaces
+SEPARATOR = ' '
+
+
+def make_topic(endpoint, topic):
+    return endpoint + SEPARATOR + topic
+
+
+class StatsRelay(object):
+
+    def __init__(self, address, loop, context=None, ssh_server=None):
+        self.address = address
+        self.loop = loop
+        self.ssh_server = ssh_server
+        self.context = context or zmq.Context()
+        self.xpub = self.context.socket(zmq.XPUB)
+        self.xpub.bind(address)
+        self.stream = ZMQStream(self.xpub, loop)
+        self.stream.on_recv(self.handle_subscription)
+        # endpoint -> (stream, topics)
+        self.upstreams = {}
+
+    def handle_subscription(self, msg):
+        data = msg[0]
+        # the first byte is 1 for a subscription and 0 for the last
+        # unsubscription
+        subscribe, topic = ord(data[0:1]) == 1, data[1:]
+        try:
+            endpoint, topic = topic.split(SEPARATOR, 1)
+        except ValueError:
+            return
+
+        if subscribe:
+            if endpoint not in self.upstreams:
+                self.connect(endpoint)
+            stream, topics = self.upstreams[endpoint]
+            stream.socket.setsockopt(zmq.SUBSCRIBE, topic)
+            topics.add(topic)
+        elif endpoint in self.upstreams:
+            stream, topics = self.upstreams[endpoint]
+            stream.socket.setsockopt(zmq.UNSUBSCRIBE, topic)
+            topics.discard(topic)
+            if not topics:
+                logger.debug('Relay disconnecting from %s' % endpoint)
+                del self.upstreams[endpoint]
+                stream.close()
+
+    def connect(self, endpoint):
+        logger.debug('Relay connecting to %s' % endpoint)
+        socket = self.context.socket(zmq.SUB)
+        socket.setsockopt(zmq.LINGER, 0)
+        get_connection(socket, endpoint, self.ssh_server)
+        stream = ZMQStream(socket, self.loop)
+        stream.on_recv(partial(self.forward, endpoint))
+        self.upstreams[endpoint] = stream, set()
+
+    def forward(self, endpoint, msg):
+        topic, payload = msg
+        self.stream.send_multipart([make_topic(endpoint, topic), payload])
+
+    def stop(self):
+        for stream, __ in self.upstreams.values():
+            stream.close()
+        self.upstreams = {}
+        self.stream.close()
+        try:
+            self.context.destroy(0)
+        except zmq.ZMQError as e:
+            if e.errno != errno.EINTR:
+                raise
+
+
+def run_relay(address, ssh_server=None, close_fds=()):
+    """Runs a relay in a new process, returns its pid.
+
+    The process closes the file descriptors of *close_fds* it inherits,
+    e.g. a listening socket it must not keep open.
+    """
+    pid = os.fork()
+    if pid:
+        return pid
+
+    for fd in close_fds:
+        try:
+            os.close(fd)
+        except OSError:
+            pass
+    loop = ioloop.IOLoop()
+    relay = StatsRelay(address, loop, ssh_server=ssh_server)
+
+    def stop(signum, frame):
+        loop.add_callback_from_signal(loop.stop)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    try:
+        loop.start()
+    finally:
+        relay.stop()
+        os._exit(0)
+
+
+def stop_relay(pid):
+    """Terminates the process started by run_relay."""
+    try:
+        os.kill(pid, signal.SIGTERM)
+    except OSError as e:
+        if e.errno != errno.ESRCH:
+            raise
@@ -1,5 +1,12 @@
+import pickle
+import sqlite3
+import time
+from collections import OrderedDict
+
+from circusweb import logger
 from circusweb.controller import Controller
 from tornado import gen
+from tornado.ioloop import PeriodicCallback
 
 _CONTROLLER = None
 
@@ -38,26 +45,208 @@ class Session(object):
         self.messages = []
         self.endpoints = set()
         self.stats_endpoints = set()
+        self.accessed = time.time()
 
     @property
     def connected(self):
         return bool(self.endpoints)
 
+    @property
+    def empty(self):
+        return not (self.messages or self.endpoints or self.stats_endpoints)
+
+
+class SessionBackend(object):
+    """Where the sessions are stored, see MemoryBackend and SQLiteBackend.
+    """
+
+    def load(self, session_id):
+        """Returns the session or None."""
+        raise NotImplementedError()
+
+    def save(self, session_id, session):
+        raise NotImplementedError()
+
+    def delete(self, session_id):
+        raise NotImplementedError()
+
+    def expire(self, accessed_before, max_sessions):
+        """Removes the sessions not accessed since *accessed_before*, and
+        the least recently accessed ones past *max_sessions*.
+
+        Returns the (session_id, session) removed.
+        """
+        raise NotImplementedError()
+
+    def __len__(self):
+        raise NotImplementedError()
+
+
+class MemoryBackend(SessionBackend):
+    """Keeps the sessions in a dict ordered by last access."""
+
+    def __init__(self):
+        self.sessions = OrderedDict()
+
+    def load(self, session_id):
+        return self.sessions.get(session_id)
+
+    def save(self, session_id, session):
+        self.sessions.pop(session_id, None)
+        self.sessions[session_id] = session
+
+    def delete(self, session_id):
+        self.sessions.pop(session_id, None)
+
+    def expire(self, accessed_before, max_sessions):
+        expired = []
+        while self.sessions:
+            session_id, session = next(iter(self.sessions.items()))
+            if (session.accessed >= accessed_before and
+                    len(self.sessions) <= max_sessions):
+                break
+            del self.sessions[session_id]
+            expired.append((session_id, session))
+        return expired
+
+    def __len__(self):
+        return len(self.sessions)
+
+
+class SQLiteBackend(SessionBackend):
+    """Keeps the sessions in a SQLite database, so they survive restarts
+    and can be shared by several processes."""
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path, isolation_level=None)
+        self.db.execute('CREATE TABLE IF NOT EXISTS sessions ('
+                        'id TEXT PRIMARY KEY, accessed REAL, data BLOB)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS sessions_accessed '
+                        'ON sessions (accessed)')
+
+    def load(self, session_id):
+        row = self.db.execute('SELECT data FROM sessions WHERE id = ?',
+                              (session_id,)).fetchone()
+        if row is None:
+            return None
+        return pickle.loads(bytes(row[0]))
+
+    def save(self, session_id, session):
+        data = pickle.dumps(session, pickle.HIGHEST_PROTOCOL)
+        self.db.execute('INSERT OR REPLACE INTO sessions VALUES (?, ?, ?)',
+                        (session_id, session.accessed, sqlite3.Binary(data)))
+
+    def delete(self, session_id):
+        self.db.execute('DELETE FROM sessions WHERE id = ?', (session_id,))
+
+    def expire(self, accessed_before, max_sessions):
+        overflow = max(0, len(self) - max_sessions)
+        rows = self.db.execute(
+            'SELECT id, data FROM sessions WHERE accessed < ? UNION '
+            'SELECT id, data FROM (SELECT id, data FROM sessions '
+            'ORDER BY accessed LIMIT ?)',
+            (accessed_before, overflow)).fetchall()
+        expired = [(session_id, pickle.loads(bytes(data)))
+                   for session_id, data in rows]
+        self.db.executemany('DELETE FROM sessions WHERE id = ?',
+                            [(session_id,) for session_id, __ in expired])
+        return expired
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM sessions').fetchone()[0]
+
 
 class SessionManager(object):
 
-    sessions = {}
+    backend = MemoryBackend()
+    # seconds after which an idle session is removed
+    ttl = 24 * 3600
+    max_sessions = 10000
+    _expire_callback = None
+    # session id -> endpoints this process took a reference on for the
+    # session, see hold
+    references = {}
+
+    @classmethod
+    def configure(cls, backend, ttl=None, max_sessions=None):
+        cls.backend = backend
+        if ttl is not None:
+            cls.ttl = ttl
+        if max_sessions is not None:
+            cls.max_sessions = max_sessions
 
     @classmethod
     def get(cls, session_id):
-        return cls.sessions.get(session_id, None)
+        return cls.backend.load(session_id)
 
     @classmethod
     def new(cls, session_id):
-        session = Session()
-        cls.sessions[session_id] = session
-        return session
+        """Creates a session, it's only stored once saved."""
+        return Session()
+
+    @classmethod
+    def save(cls, session_id, session):
+        session.accessed = time.time()
+        cls.backend.save(session_id, session)
 
     @classmethod
     def delete(cls, session_id):
-        del cls.sessions[session_id]
+        cls.backend.delete(session_id)
+
+    @classmethod
+    def expire(cls):
+        """Removes the idle sessions and releases their endpoints.
+
+        The sessions shared by several processes are only removed by one
+        of them, the others release the references they hold for sessions
+        which are gone.
+        """
+        expired = cls.backend.expire(time.time() - cls.ttl, cls.max_sessions)
+        for session_id, __ in expired:
+            cls.release(session_id)
+        for session_id in list(cls.references):
+            if cls.backend.load(session_id) is None:
+                cls.release(session_id)
+        if expired:
+            logger.debug('%d sessions expired' % len(expired))
+        return expired
+
+    @classmethod
+    def hold(cls, session_id, endpoint):
+        """Records that a reference on *endpoint* is taken for a session,
+        returns False if the session already holds one in this process.
+
+        The sessions of a persistent backend outlive the references, e.g.
+        after a restart, so they are taken again by the requests of the
+        sessions, see BaseHandler.prepare.
+        """
+        endpoints = cls.references.setdefault(session_id, set())
+        if endpoint in endpoints:
+            return False
+        endpoints.add(endpoint)
+        return True
+
+    @classmethod
+    def release(cls, session_id, endpoint=None):
+        """Releases the references held for a session, or only the one on
+        *endpoint*."""
+        endpoints = cls.references.get(session_id, set())
+        if endpoint is None:
+            released = list(endpoints)
+        elif endpoint in endpoints:
+            released = [endpoint]
+        else:
+            released = []
+        for endpoint in released:
+            endpoints.discard(endpoint)
+            disconnect_from_circus(endpoint)
+        if not endpoints:
+            cls.references.pop(session_id, None)
+
+    @classmethod
+    def start_expiration(cls, interval=60):
+        if cls._expire_callback is None:
+            cls._expire_callback = PeriodicCallback(cls.expire,
+                                                    interval * 1000)
+            cls._expire_callback.start()
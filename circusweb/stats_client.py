@@ -1,27 +1,114 @@
-import errno
 import json
 import zmq
+from collections import OrderedDict
 
 from zmq.eventloop.zmqstream import ZMQStream
 
 from circus.util import DEFAULT_ENDPOINT_SUB, get_connection
+from circusweb import logger
+from circusweb.relay import make_topic
+
+try:
+    from concurrent import futures
+except ImportError:
+    futures = None
+
+
+# topics carrying the stats of several processes or sockets, the name or fd
+# being in the message
+MULTIPLEXED_TOPICS = ('stat.circus', 'stat.sockets')
+
+
+def decode_messages(messages, prefix_size=0):
+    """Returns the (watcher, subtopic, stat) of each (topic, message) of
+    *messages*, the topics starting with *prefix_size* characters to skip.
+
+    Called in a worker thread or process when the consumer has an executor.
+    """
+    decoded = []
+    for topic, stat in messages:
+        topic = topic[prefix_size:].split('.')
+        if len(topic) == 3:
+            __, watcher, subtopic = topic
+        elif len(topic) == 2:
+            __, watcher = topic
+            subtopic = None
+        else:
+            continue
+        decoded.append((watcher, subtopic, json.loads(stat)))
+    return decoded
+
+
+def make_executor(decoder):
+    """Returns the executor decoding the stats for *decoder*, 'thread' or
+    'process', or None to decode them in the IOLoop.
+
+    A single worker keeps the bursts in order.
+    """
+    if decoder not in ('thread', 'process'):
+        return None
+    if futures is None:
+        logger.warning('concurrent.futures is not installed, decoding the '
+                       'stats in the IOLoop')
+        return None
+    if decoder == 'thread':
+        return futures.ThreadPoolExecutor(max_workers=1)
+    return futures.ProcessPoolExecutor(max_workers=1)
 
 
 class AsynchronousStatsConsumer(object):
+    """Subscribes to *topics* on *endpoint* and calls *callback* for each
+    message.
+
+    When *relay* is given, the messages are received through the StatsRelay
+    bound to this address instead of straight from the endpoint.
+
+    When *burst_size* is given, the messages waiting on the socket are read
+    in bursts of at most *burst_size* and only the latest message of each
+    topic is kept, which suits the stats but not the circusd events. The
+    bursts are decoded by *executor*, e.g. a single worker
+    concurrent.futures executor keeping them in order, when one is given.
+    A single burst is decoded at a time, the messages read meanwhile are
+    merged into the next one.
+    """
     def __init__(self, topics, loop, callback, context=None,
-                 endpoint=DEFAULT_ENDPOINT_SUB, ssh_server=None, timeout=1.):
+                 endpoint=DEFAULT_ENDPOINT_SUB, ssh_server=None, timeout=1.,
+                 relay=None, burst_size=None, executor=None):
         self.topics = topics
-        self.keep_context = context is not None
-        self.context = context or zmq.Context()
+        # a single context, and its io thread, for all the consumers
+        self.context = context or zmq.Context.instance()
         self.endpoint = endpoint
+        self.relay = relay
         self.pubsub_socket = self.context.socket(zmq.SUB)
-        get_connection(self.pubsub_socket, self.endpoint, ssh_server)
+        if relay is None:
+            self.prefix = ''
+            get_connection(self.pubsub_socket, self.endpoint, ssh_server)
+        else:
+            self.prefix = make_topic(self.endpoint, '')
+            self.pubsub_socket.connect(relay)
+        # topic -> number of subscriptions, see subscribe
+        self.topic_counts = {}
         for topic in self.topics:
-            self.pubsub_socket.setsockopt(zmq.SUBSCRIBE, topic)
+            self.pubsub_socket.setsockopt(zmq.SUBSCRIBE, self.prefix + topic)
+        self.loop = loop
         self.stream = ZMQStream(self.pubsub_socket, loop)
-        self.stream.on_recv(self.process_message)
+        self.burst_size = burst_size
+        self.executor = executor
+        if burst_size:
+            self.stream.on_recv(self.process_burst)
+        else:
+            self.stream.on_recv(self.process_message)
         self.callback = callback
         self.timeout = timeout
+        # number of messages received, and of the ones dropped because a
+        # later message of the same topic was in the same burst, or came
+        # while a burst was decoded
+        self.received = 0
+        self.skipped = 0
+        # whether a burst is being decoded by the executor, and the latest
+        # messages of each topic read meanwhile
+        self.decoding = False
+        self.waiting = OrderedDict()
 
         # Connection counter
         self.count = 0
@@ -30,28 +117,98 @@ class AsynchronousStatsConsumer(object):
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
-        """ On context manager exit, destroy the zmq context """
+        """ On context manager exit, close the socket """
         self.stop()
 
+    def subscribe(self, topic):
+        """Adds a subscription to *topic*, the socket only subscribes to it
+        on the first one."""
+        count = self.topic_counts.get(topic, 0)
+        if not count:
+            self.pubsub_socket.setsockopt(zmq.SUBSCRIBE, self.prefix + topic)
+        self.topic_counts[topic] = count + 1
+
+    def unsubscribe(self, topic):
+        """Removes a subscription to *topic*, the socket unsubscribes from
+        it with the last one."""
+        count = self.topic_counts.get(topic, 0)
+        if count > 1:
+            self.topic_counts[topic] = count - 1
+        elif count:
+            del self.topic_counts[topic]
+            self.pubsub_socket.setsockopt(zmq.UNSUBSCRIBE,
+                                          self.prefix + topic)
+
     def process_message(self, msg):
-        topic, stat = msg
+        self.received += 1
+        self.dispatch(decode_messages([msg], len(self.prefix)))
 
-        topic = topic.split('.')
-        if len(topic) == 3:
-            __, watcher, subtopic = topic
-            self.callback(watcher, subtopic, json.loads(stat), self.endpoint)
-        elif len(topic) == 2:
-            __, watcher = topic
-            self.callback(watcher, None, json.loads(stat), self.endpoint)
+    def process_burst(self, msg):
+        """Reads the messages already waiting behind *msg*, up to
+        *burst_size*, and dispatches the latest one of each topic."""
+        latest = OrderedDict()
+        multiplexed = [self.prefix + topic for topic in MULTIPLEXED_TOPICS]
+        count = 0
+        while True:
+            topic = msg[0]
+            if topic in multiplexed:
+                latest[topic, count] = msg
+            else:
+                # keeps the topics in the order of their latest message
+                latest.pop(topic, None)
+                latest[topic] = msg
+            count += 1
+            if count >= self.burst_size:
+                break
+            try:
+                msg = self.pubsub_socket.recv_multipart(zmq.NOBLOCK)
+            except zmq.Again:
+                break
 
-    def stop(self):
-        self.stream.stop_on_recv()
-        if self.keep_context:
+        self.received += count
+        self.skipped += count - len(latest)
+        if self.executor is None:
+            self.dispatch(decode_messages(list(latest.values()),
+                                          len(self.prefix)))
+        elif self.decoding:
+            # the executor's queue would grow as long as the messages come
+            # faster than they are decoded
+            for key, msg in latest.items():
+                if self.waiting.pop(key, None) is not None:
+                    self.skipped += 1
+                self.waiting[key] = msg
+        else:
+            self.decode(latest)
+
+    def decode(self, latest):
+        self.decoding = True
+        future = self.executor.submit(decode_messages, list(latest.values()),
+                                      len(self.prefix))
+        self.loop.add_future(future, self.on_decoded)
+
+    def on_decoded(self, future):
+        self.decoding = False
+        if not self.stream.receiving():
+            # stopped while the burst was decoded
             return
         try:
-            self.context.destroy(0)
-        except zmq.ZMQError as e:
-            if e.errno == errno.EINTR:
-                pass
-            else:
-                raise
+            decoded = future.result()
+        except Exception:
+            logger.exception('Could not decode the stats of %s' %
+                             self.endpoint)
+        else:
+            self.dispatch(decoded)
+        if self.waiting:
+            waiting, self.waiting = self.waiting, OrderedDict()
+            self.decode(waiting)
+
+    def dispatch(self, decoded):
+        for watcher, subtopic, stat in decoded:
+            self.callback(watcher, subtopic, stat, self.endpoint)
+
+    def stop(self):
+        """Closes the socket, the shared context is left open."""
+        if self.stream.closed():
+            return
+        self.stream.stop_on_recv()
+        self.stream.close(linger=0)
@@ -0,0 +1,222 @@
+import time
+from array import array
+from collections import OrderedDict
+
+
+# metrics kept from the messages published by circusd-stats
+METRICS = ('cpu', 'mem', 'age', 'reads')
+
+
+class RingBuffer(object):
+    """Fixed size buffer of (timestamp, value) samples.
+
+    Once full, every new sample overwrites the oldest one, so the memory
+    used never grows past *size* samples.
+    """
+    __slots__ = ('size', 'times', 'values', 'index', 'length')
+
+    def __init__(self, size):
+        self.size = size
+        self.times = array('d', [0.]) * size
+        self.values = array('f', [0.]) * size
+        self.index = 0
+        self.length = 0
+
+    def __len__(self):
+        return self.length
+
+    def append(self, timestamp, value):
+        self.times[self.index] = timestamp
+        self.values[self.index] = value
+        self.index = (self.index + 1) % self.size
+        if self.length < self.size:
+            self.length += 1
+
+    @property
+    def last_time(self):
+        if not self.length:
+            return 0.
+        return self.times[self.index - 1]
+
+    def since(self, timestamp=0.):
+        """Returns the (timestamp, value) samples newer than *timestamp*,
+        oldest first."""
+        start = self.index - self.length
+        samples = []
+        for i in range(start, self.index):
+            if self.times[i] > timestamp:
+                samples.append((self.times[i], self.values[i]))
+        return samples
+
+
+class StatsHistory(object):
+    """Keeps the last samples of each (stats_endpoint, watcher, pid, metric).
+
+    At most *max_series* series of *size* samples are kept, when a new
+    series is needed while full, the one which was updated the longest ago
+    (usually a dead process) is dropped.
+    """
+
+    def __init__(self, size=120, max_series=5000):
+        self.size = size
+        self.max_series = max_series
+        # ordered from the least recently updated series
+        self.series = OrderedDict()
+
+    def add(self, stats_endpoint, watcher, pid, stat, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        for metric in METRICS:
+            value = stat.get(metric)
+            if value is None:
+                continue
+            key = stats_endpoint, watcher, pid, metric
+            buf = self.series.pop(key, None)
+            if buf is None:
+                if len(self.series) >= self.max_series:
+                    self.evict()
+                buf = RingBuffer(self.size)
+            # moved to the end
+            self.series[key] = buf
+            buf.append(timestamp, value)
+
+    def evict(self):
+        self.series.popitem(last=False)
+
+    def get(self, stats_endpoint, watcher, pid, metric, since=0.):
+        buf = self.series.get((stats_endpoint, watcher, pid, metric))
+        if buf is None:
+            return []
+        return buf.since(since)
+
+    def get_samples(self, stats_endpoint, watcher, pid, since=0.):
+        """Returns the samples of a process or of a watcher aggregation as a
+        list of {'time': ..., metric: value} mappings, oldest first."""
+        samples = {}
+        for metric in METRICS:
+            for timestamp, value in self.get(stats_endpoint, watcher, pid,
+                                             metric, since):
+                sample = samples.setdefault(timestamp, {'time': timestamp})
+                sample[metric] = value
+        return [samples[timestamp] for timestamp in sorted(samples)]
+
+    def memory_usage(self):
+        """Rough number of bytes used by the buffers."""
+        return len(self.series) * self.size * 12
+
+
+# durations, in seconds, of the buckets of the aggregated stats
+TIERS = (10, 60, 600)
+
+# metrics worth aggregating, the age only grows
+AGGREGATED_METRICS = ('cpu', 'mem', 'reads')
+
+
+class Aggregates(object):
+    """Min, max and average of a metric over fixed duration buckets.
+
+    The bucket being filled is updated in place and written to a ring of
+    *size* buckets once a sample falls into the next one, so adding a
+    sample is O(1).
+    """
+    __slots__ = ('duration', 'size', 'starts', 'mins', 'maxs', 'avgs',
+                 'index', 'length', 'start', 'min', 'max', 'sum', 'count')
+
+    def __init__(self, duration, size):
+        self.duration = duration
+        self.size = size
+        self.starts = array('d', [0.]) * size
+        self.mins = array('f', [0.]) * size
+        self.maxs = array('f', [0.]) * size
+        self.avgs = array('f', [0.]) * size
+        self.index = 0
+        self.length = 0
+        self.start = None
+        self.count = 0
+
+    def add(self, timestamp, value):
+        start = timestamp - timestamp % self.duration
+        if start != self.start:
+            if self.count:
+                self.close()
+            self.start = start
+            self.min = self.max = self.sum = value
+            self.count = 1
+            return
+        if value < self.min:
+            self.min = value
+        elif value > self.max:
+            self.max = value
+        self.sum += value
+        self.count += 1
+
+    def close(self):
+        i = self.index
+        self.starts[i] = self.start
+        self.mins[i] = self.min
+        self.maxs[i] = self.max
+        self.avgs[i] = self.sum / self.count
+        self.index = (i + 1) % self.size
+        if self.length < self.size:
+            self.length += 1
+
+    @property
+    def last_time(self):
+        return self.start or 0.
+
+    def buckets(self, since=0.):
+        """Returns the buckets starting after *since*, oldest first,
+        including the one being filled."""
+        buckets = []
+        for i in range(self.index - self.length, self.index):
+            if self.starts[i] > since:
+                buckets.append({'time': self.starts[i], 'min': self.mins[i],
+                                'max': self.maxs[i], 'avg': self.avgs[i]})
+        if self.count and self.start > since:
+            buckets.append({'time': self.start, 'min': self.min,
+                            'max': self.max, 'avg': self.sum / self.count})
+        return buckets
+
+
+class StatsAggregates(object):
+    """Keeps the aggregates of each (stats_endpoint, watcher, pid, metric)
+    for every duration of *tiers*.
+
+    Like StatsHistory, at most *max_series* series are kept and the stalest
+    one is dropped when a new one is needed.
+    """
+
+    def __init__(self, size=144, max_series=1000, tiers=TIERS):
+        self.size = size
+        self.max_series = max_series
+        self.tiers = tiers
+        # ordered from the least recently updated series
+        self.series = OrderedDict()
+
+    def add(self, stats_endpoint, watcher, pid, stat, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        for metric in AGGREGATED_METRICS:
+            value = stat.get(metric)
+            if value is None:
+                continue
+            key = stats_endpoint, watcher, pid, metric
+            tiers = self.series.pop(key, None)
+            if tiers is None:
+                if len(self.series) >= self.max_series:
+                    self.evict()
+                tiers = [Aggregates(duration, self.size)
+                         for duration in self.tiers]
+            self.series[key] = tiers
+            for aggregates in tiers:
+                aggregates.add(timestamp, value)
+
+    def evict(self):
+        self.series.popitem(last=False)
+
+    def get(self, stats_endpoint, watcher, pid, metric, tier, since=0.):
+        """Returns the buckets of the given *tier* duration."""
+        tiers = self.series.get((stats_endpoint, watcher, pid, metric))
+        if tiers is None:
+            return []
+        return tiers[self.tiers.index(tier)].buckets(since)
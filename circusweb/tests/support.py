@@ -0,0 +1,131 @@
+"""Fakes of the circusd clients and stats consumers, for the tests of the
+controller and of the handlers."""
+from tornado import gen
+from tornado.concurrent import Future
+
+from circus.exc import CallError
+from circusweb.client import _versions
+
+
+ENDPOINT = 'tcp://127.0.0.1:5555'
+STATS_ENDPOINT = 'tcp://127.0.0.1:5557'
+
+
+def resolved(result=None):
+    future = Future()
+    future.set_result(result)
+    return future
+
+
+def failed(exception):
+    future = Future()
+    future.set_exception(exception)
+    return future
+
+
+class FakeClient(object):
+    """Answers the commands from *replies*, a {command: reply} dict, the
+    other commands fail with a CallError. When *hold* is true, the commands
+    wait for the test to answer them instead, through their future in
+    *futures* or with reply.
+
+    update_watchers returns *update* when it's set, e.g. a future the test
+    resolves itself.
+    """
+
+    def __init__(self, loop=None, endpoint=ENDPOINT, **kwargs):
+        self.endpoint = endpoint
+        self.watchers_options = {'sleeper': {'numprocesses': 1}}
+        self.watchers = sorted(self.watchers_options.items())
+        self.statuses = {}
+        self.statuses_time = 0
+        self.pids = {}
+        self.sockets = []
+        self.stats_endpoint = STATS_ENDPOINT
+        self.pubsub_endpoint = None
+        self.check_delay = 5
+        self.use_sockets = False
+        self.version = next(_versions)
+        self.count = 0
+        self.stopped = False
+        self.replies = {
+            'status': {'status': 'ok', 'statuses': {'sleeper': 'active'}},
+            'list': {'status': 'ok', 'pids': [12]},
+            'listsockets': {'status': 'ok', 'sockets': []},
+        }
+        self.sent = []
+        self.hold = False
+        self.futures = []
+        self.update = None
+        self.updated = []
+
+    def send_message(self, command, **props):
+        self.sent.append((command, props))
+        if self.hold:
+            future = Future()
+            self.futures.append(future)
+            return future
+        reply = self.replies.get(command)
+        if reply is None:
+            return failed(CallError('Timed out'))
+        if isinstance(reply, Exception):
+            return failed(reply)
+        return resolved(dict(reply))
+
+    @gen.coroutine
+    def reply(self, res):
+        """Answers the last command held with *res*."""
+        self.futures[-1].set_result(res)
+        # lets the callers handle the reply
+        for __ in range(5):
+            yield gen.moment
+
+    def update_watchers(self):
+        self.updated.append(None)
+        if self.update is not None:
+            return self.update
+        return resolved()
+
+    def update_watcher(self, name):
+        self.updated.append(name)
+        return resolved()
+
+    def touch(self):
+        self.version = next(_versions)
+
+    def set_status(self, name, status):
+        if self.statuses.get(name) != status:
+            self.statuses[name] = status
+            self.touch()
+
+    def set_watcher_option(self, name, option, value):
+        options = self.watchers_options.get(name)
+        if options is not None and options.get(option) != value:
+            options[option] = value
+            self.touch()
+
+    def stop(self):
+        self.stopped = True
+
+
+class FakeConsumer(object):
+    """Counts the subscriptions to each topic like
+    AsynchronousStatsConsumer."""
+
+    def __init__(self, topics, loop, callback, **kwargs):
+        self.topic_counts = dict((topic, 1) for topic in topics)
+        self.count = 0
+        self.stopped = False
+
+    def subscribe(self, topic):
+        self.topic_counts[topic] = self.topic_counts.get(topic, 0) + 1
+
+    def unsubscribe(self, topic):
+        count = self.topic_counts.get(topic, 0)
+        if count > 1:
+            self.topic_counts[topic] = count - 1
+        elif count:
+            del self.topic_counts[topic]
+
+    def stop(self):
+        self.stopped = True
@@ -0,0 +1,168 @@
+import json
+from base64 import b64encode
+
+from tornado import testing
+
+from circus.exc import CallError
+from circusweb import controller
+from circusweb.api import APIHandler
+from circusweb.circushttpd import Application
+from circusweb.controller import Controller
+from circusweb.session import get_controller, set_controller
+from circusweb.tests.support import ENDPOINT, FakeClient, FakeConsumer, failed
+
+
+ENCODED = b64encode(ENDPOINT)
+
+
+class APITestCase(testing.AsyncHTTPTestCase):
+
+    def get_app(self):
+        return Application(autoreload=False)
+
+    def setUp(self):
+        super(APITestCase, self).setUp()
+        self.clients = {}
+        self.client_class = controller.AsynchronousCircusClient
+        self.consumer_class = controller.AsynchronousStatsConsumer
+        controller.AsynchronousCircusClient = self.make_client
+        controller.AsynchronousStatsConsumer = FakeConsumer
+        set_controller(Controller(self.io_loop, release_delay=0))
+
+    def tearDown(self):
+        for endpoint in list(APIHandler.leases):
+            APIHandler.release(endpoint)
+        controller.AsynchronousCircusClient = self.client_class
+        controller.AsynchronousStatsConsumer = self.consumer_class
+        set_controller(None)
+        super(APITestCase, self).tearDown()
+
+    def make_client(self, loop, endpoint, **kwargs):
+        client = FakeClient(loop, endpoint)
+        if endpoint != ENDPOINT:
+            client.update = failed(CallError('Timed out'))
+        self.clients[endpoint] = client
+        return client
+
+    def request(self, url, method='GET', body=None, headers=None):
+        if body is None and method == 'POST':
+            body = ''
+        elif body is not None:
+            body = json.dumps(body)
+        response = self.fetch('/api/v1/' + url, method=method, body=body,
+                              headers=headers)
+        data = None
+        if response.headers.get('Content-Type', '').startswith(
+                'application/json'):
+            data = json.loads(response.body)
+        return response, data
+
+
+class TestAPI(APITestCase):
+
+    def test_watchers(self):
+        response, data = self.request('%s/watchers/' % ENCODED)
+        self.assertEqual(response.code, 200)
+        self.assertEqual(data['watchers']['sleeper']['status'], 'active')
+
+        etag = response.headers['Etag']
+        response, __ = self.request('%s/watchers/' % ENCODED,
+                                    headers={'If-None-Match': etag})
+        self.assertEqual(response.code, 304)
+
+        # the state changed
+        self.clients[ENDPOINT].touch()
+        response, __ = self.request('%s/watchers/' % ENCODED,
+                                    headers={'If-None-Match': etag})
+        self.assertEqual(response.code, 200)
+        self.assertNotEqual(response.headers['Etag'], etag)
+
+    def test_watcher(self):
+        response, data = self.request('%s/watchers/sleeper/' % ENCODED)
+        self.assertEqual(response.code, 200)
+        self.assertEqual(data['watcher']['pids'], [12])
+
+        response, data = self.request('%s/watchers/unknown/' % ENCODED)
+        self.assertEqual(response.code, 404)
+        self.assertEqual(data, {'status': 'error',
+                                'reason': 'Unknown watcher unknown'})
+
+    def test_commands(self):
+        self.request('%s/watchers/' % ENCODED)
+        client = self.clients[ENDPOINT]
+        client.replies['incr'] = {'status': 'ok', 'numprocesses': 2}
+        client.replies['decr'] = {'status': 'error', 'reason': 'Nope'}
+
+        response, data = self.request('%s/watchers/sleeper/incr/' % ENCODED,
+                                      method='POST')
+        self.assertEqual(response.code, 200)
+        self.assertEqual(data['numprocesses'], 2)
+
+        # errors reported by circusd
+        response, data = self.request('%s/watchers/sleeper/decr/' % ENCODED,
+                                      method='POST')
+        self.assertEqual(response.code, 400)
+        self.assertEqual(data['reason'], 'Nope')
+
+        # no reply from circusd
+        response, data = self.request(
+            '%s/watchers/sleeper/processes/12/kill/' % ENCODED, method='POST')
+        self.assertEqual(response.code, 502)
+        self.assertEqual(data, {'status': 'error', 'reason': 'Timed out'})
+
+        response, __ = self.request(
+            '%s/watchers/sleeper/explode/' % ENCODED, method='POST')
+        self.assertEqual(response.code, 404)
+
+    def test_etag_of_a_new_client(self):
+        response, __ = self.request('%s/watchers/' % ENCODED)
+        etag = response.headers['Etag']
+        APIHandler.release(ENDPOINT)
+
+        # the client created again has the same state changes behind it
+        response, __ = self.request('%s/watchers/' % ENCODED,
+                                    headers={'If-None-Match': etag})
+        self.assertEqual(response.code, 200)
+        self.assertNotEqual(response.headers['Etag'], etag)
+
+    def test_bulk(self):
+        self.request('%s/watchers/' % ENCODED)
+        self.clients[ENDPOINT].replies['stop'] = {'status': 'ok'}
+        response, data = self.request('bulk/', method='POST', body={
+            'operations': [{'endpoint': ENCODED, 'watcher': 'sleeper',
+                            'action': 'stop'}]})
+        self.assertEqual(response.code, 200)
+        self.assertEqual(data['results'], [{'status': 'ok'}])
+
+        response, data = self.request('bulk/', method='POST', body={
+            'operations': [{'endpoint': 'tcp://127.0.0.1:5555',
+                            'watcher': 'sleeper', 'action': 'stop'}]})
+        self.assertEqual(response.code, 400)
+        self.assertEqual(data['reason'], 'Invalid endpoint')
+
+    def test_endpoints(self):
+        response, data = self.request(
+            '%s/watchers/' % b64encode('tcp://127.0.0.1:5556'))
+        self.assertEqual(response.code, 502)
+        self.assertEqual(data['reason'], 'Timed out')
+
+        response, data = self.request('abc/watchers/')
+        self.assertEqual(response.code, 400)
+        self.assertEqual(data['reason'], 'Invalid endpoint')
+
+        self.request('%s/watchers/' % ENCODED)
+        response, data = self.request('endpoints/')
+        self.assertEqual(list(data['endpoints']), [ENDPOINT])
+        response, data = self.request('watchers/')
+        self.assertEqual(list(data['endpoints']), [ENDPOINT])
+
+    def test_lease(self):
+        for __ in range(3):
+            self.request('%s/watchers/' % ENCODED)
+        client = self.clients[ENDPOINT]
+        self.assertEqual(client.count, 1)
+        self.assertEqual(list(APIHandler.leases), [ENDPOINT])
+
+        APIHandler.release(ENDPOINT)
+        self.assertTrue(client.stopped)
+        self.assertIsNone(get_controller().get_client(ENDPOINT))
@@ -0,0 +1,53 @@
+import gzip
+import io
+import os
+import shutil
+import tempfile
+import unittest
+from collections import OrderedDict
+
+from circusweb.assets import Assets, accepted_encodings
+
+
+class TestAssets(unittest.TestCase):
+
+    def setUp(self):
+        self.static_path = tempfile.mkdtemp()
+        self.build_path = os.path.join(self.static_path, 'build')
+        for name, content in (('a.js', b'var a = 1'), ('b.js', b'var b = 2')):
+            with open(os.path.join(self.static_path, name), 'wb') as f:
+                f.write(content)
+
+    def tearDown(self):
+        shutil.rmtree(self.static_path)
+
+    def build(self):
+        assets = Assets(self.static_path, self.build_path,
+                        OrderedDict([('all.js', ['a.js', 'b.js'])]))
+        assets.build()
+        return assets
+
+    def test_build(self):
+        assets = self.build()
+        filename = assets.names['all.js']
+        self.assertTrue(filename.startswith('all-'))
+        self.assertEqual(assets.url('all.js'), '/assets/' + filename)
+
+        content_type, variants = assets.files[filename]
+        self.assertEqual(variants['identity'], b'var a = 1;\nvar b = 2')
+        with gzip.GzipFile(fileobj=io.BytesIO(variants['gzip'])) as f:
+            self.assertEqual(f.read(), variants['identity'])
+        self.assertTrue(os.path.exists(
+            os.path.join(self.build_path, filename + '.gz')))
+
+    def test_name_changes_with_the_content(self):
+        filename = self.build().names['all.js']
+        self.assertEqual(self.build().names['all.js'], filename)
+        with open(os.path.join(self.static_path, 'b.js'), 'wb') as f:
+            f.write(b'var b = 3')
+        self.assertNotEqual(self.build().names['all.js'], filename)
+
+    def test_accepted_encodings(self):
+        self.assertEqual(accepted_encodings('gzip, deflate, br;q=0'),
+                         set(['gzip', 'deflate']))
+        self.assertEqual(accepted_encodings(''), set())
@@ -0,0 +1,182 @@
+import json
+import time
+import unittest
+
+from tornado import gen, testing
+
+from circus.exc import CallError
+from circusweb.client import AsynchronousCircusClient, CircuitBreaker
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+    def test_opens_after_threshold(self):
+        breaker = CircuitBreaker(threshold=3, reset_timeout=60)
+        self.assertFalse(breaker.failure())
+        self.assertFalse(breaker.failure())
+        self.assertTrue(breaker.allow())
+        self.assertTrue(breaker.failure())
+        self.assertEqual(breaker.state, 'open')
+        self.assertFalse(breaker.allow())
+        # already open
+        self.assertFalse(breaker.failure())
+
+    def test_success_resets_the_failures(self):
+        breaker = CircuitBreaker(threshold=2, reset_timeout=60)
+        breaker.failure()
+        breaker.success()
+        self.assertFalse(breaker.failure())
+        self.assertEqual(breaker.state, 'closed')
+
+    def test_half_open_lets_a_single_probe_through(self):
+        breaker = CircuitBreaker(threshold=1, reset_timeout=0)
+        breaker.failure()
+        self.assertEqual(breaker.state, 'half-open')
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+
+        # the probe failed, it takes another reset_timeout to probe again
+        breaker.failure()
+        self.assertTrue(breaker.allow())
+        breaker.success()
+        self.assertEqual(breaker.state, 'closed')
+        self.assertTrue(breaker.allow())
+        self.assertTrue(breaker.allow())
+
+
+class FakeStream(object):
+
+    def __init__(self):
+        self.sent = []
+        self.times = []
+
+    def send(self, data):
+        self.sent.append(json.loads(data))
+        self.times.append(time.time())
+
+
+class ClientTestCase(testing.AsyncTestCase):
+
+    def setUp(self):
+        super(ClientTestCase, self).setUp()
+        self.client = self.make_client()
+
+    def make_client(self, **kwargs):
+        client = AsynchronousCircusClient(self.io_loop,
+                                          'tcp://127.0.0.1:5555', **kwargs)
+        self.stream = FakeStream()
+        client._get_stream = lambda: self.stream
+        return client
+
+    def reply(self, cmd, **res):
+        res.setdefault('status', 'ok')
+        self.client._handle_reply([json.dumps(dict(res, id=cmd['id']))])
+
+
+class TestAsynchronousCircusClient(ClientTestCase):
+
+    @testing.gen_test
+    def test_send_message(self):
+        future = self.client.send_message('list', name='sleeper')
+        cmd, = self.stream.sent
+        self.assertEqual(cmd['command'], 'list')
+        self.assertEqual(cmd['properties'], {'name': 'sleeper'})
+        self.assertTrue(cmd['id'])
+
+        self.reply(cmd, pids=[12])
+        res = yield future
+        self.assertEqual(res['pids'], [12])
+
+    @testing.gen_test
+    def test_timeout(self):
+        client = self.client = self.make_client(timeout=.01)
+        future = client._send({'command': 'stop', 'id': '1'})
+        with self.assertRaises(CallError):
+            yield future
+        self.assertEqual(client._pending, {})
+
+        # the late reply is dropped
+        self.reply(self.stream.sent[0])
+        self.assertEqual(client._pending, {})
+
+    @testing.gen_test
+    def test_read_only_commands_retried(self):
+        client = self.client = self.make_client(timeout=.01, retries=2,
+                                                retry_delay=.02)
+        with self.assertRaises(CallError):
+            yield client.send_message('status')
+        self.assertEqual(len(self.stream.sent), 3)
+        self.assertEqual(len(set(cmd['id'] for cmd in self.stream.sent)), 3)
+        # the delay doubles between the attempts
+        first, second = [b - a for a, b in zip(self.stream.times,
+                                               self.stream.times[1:])]
+        self.assertGreaterEqual(first, .03)
+        self.assertGreater(second, first)
+        # a single failed call for the breaker
+        self.assertEqual(client.breaker.failures, 1)
+
+    @testing.gen_test
+    def test_retry_succeeds(self):
+        client = self.client = self.make_client(timeout=.01, retries=2,
+                                                retry_delay=0)
+        future = client.send_message('list')
+        while len(self.stream.sent) < 2:
+            yield gen.sleep(.005)
+        self.reply(self.stream.sent[1], pids=[12])
+        res = yield future
+        self.assertEqual(res['pids'], [12])
+        self.assertEqual(client.breaker.failures, 0)
+
+    @testing.gen_test
+    def test_mutating_commands_not_resent(self):
+        client = self.client = self.make_client(timeout=.01, retries=2,
+                                                retry_delay=0)
+        with self.assertRaises(CallError):
+            yield client.send_message('incr', name='sleeper')
+        self.assertEqual(len(self.stream.sent), 1)
+
+    @testing.gen_test
+    def test_breaker(self):
+        client = self.client = self.make_client(timeout=.01, retries=1,
+                                                retry_delay=0,
+                                                breaker_threshold=2)
+        for __ in range(2):
+            with self.assertRaises(CallError):
+                yield client.send_message('status')
+        self.assertEqual(len(self.stream.sent), 4)
+        self.assertEqual(client.breaker.state, 'open')
+
+        # fails without reaching circusd
+        with self.assertRaises(CallError):
+            yield client.send_message('status')
+        self.assertEqual(len(self.stream.sent), 4)
+
+    @testing.gen_test
+    def test_update_watchers_failure(self):
+        client = self.client = self.make_client(timeout=.01)
+        client.watchers_options = {'sleeper': {'numprocesses': 1}}
+        client.watchers = sorted(client.watchers_options.items())
+        client.pids = {'sleeper': [12]}
+        version = client.version
+        with self.assertRaises(CallError):
+            yield client.update_watchers()
+        self.assertFalse(client.connected)
+        self.assertEqual(client.watchers, [])
+        self.assertEqual(client.watchers_options, {})
+        self.assertEqual(client.pids, {})
+        self.assertGreater(client.version, version)
+
+    def test_version(self):
+        version = self.client.version
+        self.client.touch()
+        self.assertGreater(self.client.version, version)
+
+        # a client created again for the same endpoint doesn't go through
+        # the versions of the previous one
+        versions = set()
+        for __ in range(2):
+            client = self.make_client()
+            versions.update([client.version])
+            client.touch()
+            versions.update([client.version])
+        self.assertEqual(len(versions), 4)
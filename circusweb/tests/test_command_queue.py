@@ -0,0 +1,73 @@
+from tornado import gen, testing
+
+from circusweb.command_queue import CommandQueue
+from circusweb.tests.support import FakeClient
+
+
+class TestCommandQueue(testing.AsyncTestCase):
+
+    def setUp(self):
+        super(TestCommandQueue, self).setUp()
+        self.client = FakeClient()
+        self.client.hold = True
+        self.batches = []
+        self.queue = CommandQueue(self.client, self.batches.append)
+
+    @testing.gen_test
+    def test_incr_decr_merged(self):
+        first = self.queue.put('sleeper', 'incr')
+        self.assertEqual(self.client.sent[0],
+                         ('incr', {'name': 'sleeper', 'nb': 1}))
+        # queued while the first incr is in flight
+        merged = [self.queue.put('sleeper', action)
+                  for action in ('incr', 'incr', 'decr', 'incr')]
+
+        yield self.client.reply({'status': 'ok', 'numprocesses': 2})
+        self.assertEqual(first.result()['numprocesses'], 2)
+        self.assertEqual(self.client.sent[1],
+                         ('incr', {'name': 'sleeper', 'nb': 2}))
+
+        yield self.client.reply({'status': 'ok', 'numprocesses': 4})
+        self.assertEqual([f.result()['numprocesses'] for f in merged],
+                         [4] * 4)
+        self.assertEqual(
+            self.client.watchers_options['sleeper']['numprocesses'], 4)
+        self.assertEqual(len(self.client.sent), 2)
+        self.assertEqual(self.batches, [['sleeper']] * 2)
+
+    @testing.gen_test
+    def test_toggles_collapsed(self):
+        self.queue.put('sleeper', 'stop')
+        switches = [self.queue.put('sleeper', 'switch') for __ in range(2)]
+        switches += [self.queue.put('other', action)
+                     for action in ('incr', 'decr')]
+
+        yield self.client.reply({'status': 'ok'})
+        # the switches cancelled each other, as did the incr and decr
+        self.assertEqual(len(self.client.sent), 1)
+        self.assertEqual([f.result() for f in switches],
+                         [{'status': 'ok', 'merged': True}] * 4)
+        self.assertEqual(self.client.statuses, {'sleeper': 'stopped'})
+        self.assertEqual(self.batches, [['sleeper'], ['sleeper', 'other']])
+
+    @testing.gen_test
+    def test_switch(self):
+        future = self.queue.put('sleeper', 'switch')
+        yield self.client.reply({'status': 'active'})
+        self.assertEqual(self.client.sent[1],
+                         ('stop', {'name': 'sleeper'}))
+        yield self.client.reply({'status': 'ok'})
+        self.assertEqual(future.result(), {'status': 'ok'})
+        self.assertEqual(self.client.statuses, {'sleeper': 'stopped'})
+
+    @testing.gen_test
+    def test_errors(self):
+        future = self.queue.put('sleeper', 'start')
+        self.client.futures[0].set_exception(ValueError('closed'))
+        with self.assertRaises(ValueError):
+            yield future
+        # the queue goes on with the next command
+        self.queue.put('sleeper', 'start')
+        for __ in range(5):
+            yield gen.moment
+        self.assertEqual(len(self.client.sent), 2)
@@ -0,0 +1,353 @@
+import unittest
+
+from tornado import gen, testing
+from tornado.concurrent import Future
+
+from circus.exc import CallError
+from circusweb import controller
+from circusweb.controller import Controller, get_stats_topics
+from circusweb.namespace import ALL_PIDS
+from circusweb.tests.support import (ENDPOINT, STATS_ENDPOINT, FakeClient,
+                                     FakeConsumer)
+
+
+class FakeLoop(object):
+
+    def __init__(self):
+        self.timeouts = []
+
+    def add_timeout(self, deadline, callback):
+        self.timeouts.append(callback)
+        return callback
+
+    def remove_timeout(self, timeout):
+        if timeout in self.timeouts:
+            self.timeouts.remove(timeout)
+
+    def run_timeouts(self):
+        timeouts, self.timeouts = self.timeouts, []
+        for callback in timeouts:
+            callback()
+
+
+class TestStatsTopics(unittest.TestCase):
+
+    def test_watcher(self):
+        self.assertEqual(get_stats_topics('sleeper'), ['stat.sleeper'])
+        self.assertEqual(get_stats_topics('sleeper', '12'),
+                         ['stat.sleeper.12'])
+        self.assertEqual(get_stats_topics('sleeper', ALL_PIDS),
+                         ['stat.sleeper.'])
+
+    def test_circus_processes(self):
+        self.assertEqual(get_stats_topics('circus'), ['stat.circus'])
+        self.assertEqual(get_stats_topics('circusd-stats'),
+                         ['stat.circus', 'stat.circusd-stats'])
+
+    def test_sockets(self):
+        self.assertEqual(get_stats_topics('sockets'), ['stat.sockets'])
+        self.assertEqual(get_stats_topics('sockets', ALL_PIDS),
+                         ['stat.sockets'])
+
+
+class TestStatsConsumerLifecycle(unittest.TestCase):
+
+    def setUp(self):
+        self.consumer_class = controller.AsynchronousStatsConsumer
+        controller.AsynchronousStatsConsumer = FakeConsumer
+        self.loop = FakeLoop()
+        self.controller = Controller(self.loop, release_delay=10)
+
+    def tearDown(self):
+        controller.AsynchronousStatsConsumer = self.consumer_class
+
+    def test_reference_count(self):
+        self.controller.connect_to_stats_endpoint('tcp://127.0.0.1:5557')
+        self.controller.connect_to_stats_endpoint('tcp://127.0.0.1:5557')
+        consumer = self.controller.stats_clients['tcp://127.0.0.1:5557']
+        self.assertEqual(consumer.count, 2)
+
+        self.controller.disconnect_stats_endpoint('tcp://127.0.0.1:5557')
+        self.assertEqual(self.loop.timeouts, [])
+        self.controller.disconnect_stats_endpoint('tcp://127.0.0.1:5557')
+        self.controller.disconnect_stats_endpoint('tcp://127.0.0.1:5557')
+        self.assertEqual(consumer.count, 0)
+        self.assertEqual(self.controller.get_counters()['pending_releases'],
+                         1)
+
+        self.loop.run_timeouts()
+        self.assertTrue(consumer.stopped)
+        self.assertEqual(self.controller.get_counters()['stats_consumers'],
+                         0)
+
+    def test_reconnect_during_grace_period(self):
+        self.controller.connect_to_stats_endpoint('tcp://127.0.0.1:5557')
+        consumer = self.controller.stats_clients['tcp://127.0.0.1:5557']
+        self.controller.disconnect_stats_endpoint('tcp://127.0.0.1:5557')
+        self.controller.connect_to_stats_endpoint('tcp://127.0.0.1:5557')
+
+        self.assertEqual(self.loop.timeouts, [])
+        self.assertIs(self.controller.stats_clients['tcp://127.0.0.1:5557'],
+                      consumer)
+        self.assertEqual(consumer.count, 1)
+        self.assertFalse(consumer.stopped)
+
+
+class ControllerTestCase(testing.AsyncTestCase):
+
+    def setUp(self):
+        super(ControllerTestCase, self).setUp()
+        self.client_class = controller.AsynchronousCircusClient
+        self.consumer_class = controller.AsynchronousStatsConsumer
+        controller.AsynchronousCircusClient = self.make_client
+        controller.AsynchronousStatsConsumer = FakeConsumer
+        self.controller = Controller(self.io_loop, release_delay=0,
+                                     refresh_delay=0)
+
+    def tearDown(self):
+        controller.AsynchronousCircusClient = self.client_class
+        controller.AsynchronousStatsConsumer = self.consumer_class
+        super(ControllerTestCase, self).tearDown()
+
+    def make_client(self, loop, endpoint, **kwargs):
+        return FakeClient(loop, endpoint)
+
+
+class TestConnect(ControllerTestCase):
+
+    def setUp(self):
+        super(TestConnect, self).setUp()
+        self.clients = []
+        self.update = Future()
+
+    def make_client(self, loop, endpoint, **kwargs):
+        client = FakeClient(loop, endpoint)
+        client.update = self.update
+        self.clients.append(client)
+        return client
+
+    @testing.gen_test
+    def test_concurrent_connections(self):
+        connections = [self.controller.connect(ENDPOINT) for __ in range(2)]
+        self.update.set_result(None)
+        yield connections
+        self.assertEqual(len(self.clients), 1)
+        self.assertEqual(self.clients[0].count, 2)
+        self.assertEqual(self.controller.connecting, {})
+
+    @testing.gen_test
+    def test_failed_connection(self):
+        connections = [self.controller.connect(ENDPOINT) for __ in range(2)]
+        self.update.set_exception(CallError('Timed out'))
+        for connection in connections:
+            with self.assertRaises(CallError):
+                yield connection
+        self.assertEqual(len(self.clients), 1)
+        self.assertTrue(self.clients[0].stopped)
+        self.assertEqual(self.controller.clients, {})
+        self.assertEqual(self.controller.connecting, {})
+
+    @testing.gen_test
+    def test_stats_consumer(self):
+        self.update.set_result(None)
+        yield self.controller.connect(ENDPOINT)
+        # all the stats are kept in the history while the endpoint is
+        # connected
+        consumer = self.controller.stats_clients[STATS_ENDPOINT]
+        self.assertEqual(consumer.topic_counts, {'stat.': 1})
+        self.assertEqual(consumer.count, 1)
+
+        self.controller.disconnect(ENDPOINT)
+        self.assertTrue(consumer.stopped)
+        self.assertEqual(self.controller.stats_clients, {})
+
+    @testing.gen_test
+    def test_stats_on_demand(self):
+        self.controller.stats_on_demand = True
+        self.update.set_result(None)
+        yield self.controller.connect(ENDPOINT)
+        self.assertEqual(self.controller.stats_clients, {})
+
+        self.controller.connect_to_stats_endpoint(STATS_ENDPOINT)
+        consumer = self.controller.stats_clients[STATS_ENDPOINT]
+        self.assertEqual(consumer.topic_counts, {})
+
+
+class TestBulk(ControllerTestCase):
+
+    @testing.gen_test
+    def test_results(self):
+        yield self.controller.connect(ENDPOINT)
+        client = self.controller.get_client(ENDPOINT)
+        client.pids = {'sleeper': set([12])}
+        client.updated = []
+        client.replies['incr'] = {'status': 'ok', 'numprocesses': 3}
+        client.replies['start'] = {'status': 'error', 'reason': 'Nope'}
+
+        results = yield self.controller.bulk([
+            (ENDPOINT, 'sleeper', 'incr', {'nb': 2}),
+            (ENDPOINT, 'sleeper', 'start', None),
+            (ENDPOINT, 'sleeper', 'stop', None),
+            (ENDPOINT, 'sleeper', 'kill', {}),
+            (ENDPOINT, 'sleeper', 'kill', {'pid': 'abc'}),
+            (ENDPOINT, 'sleeper', 'explode', None),
+            ('tcp://127.0.0.1:5556', 'sleeper', 'stop', None)])
+        self.assertEqual(results, [
+            {'status': 'ok', 'numprocesses': 3},
+            {'status': 'error', 'reason': 'Nope'},
+            {'status': 'error', 'reason': 'Timed out'},
+            {'status': 'error', 'reason': "Missing or unknown 'pid'"},
+            {'status': 'error',
+             'reason': "invalid literal for int() with base 10: 'abc'"},
+            {'status': 'error', 'reason': "Missing or unknown 'explode'"},
+            {'status': 'error', 'reason': 'Not connected to '
+             'tcp://127.0.0.1:5556'}])
+        self.assertEqual(client.sent, [
+            ('incr', {'name': 'sleeper', 'nb': 2}),
+            ('start', {'name': 'sleeper'}),
+            ('stop', {'name': 'sleeper'})])
+
+        # only the watchers of the operations are refreshed
+        self.assertEqual(client.updated, ['sleeper'])
+        self.assertEqual(client.pids, {'sleeper': set([12])})
+        self.assertEqual(client.statuses_time, 0)
+
+
+class TestWatcherEvents(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = FakeLoop()
+        self.controller = Controller(self.loop)
+        self.client = FakeClient()
+        self.client.watchers_options['sleeper']['numprocesses'] = 2
+        self.client.pids = {'sleeper': set([12, 13])}
+        self.controller.clients[ENDPOINT] = self.client
+
+    def event(self, name, action, **msg):
+        self.controller.on_watcher_event(ENDPOINT, name, action, msg)
+
+    def test_status(self):
+        self.event('sleeper', 'stop')
+        self.assertEqual(self.client.statuses, {'sleeper': 'stopped'})
+        self.event('sleeper', 'start')
+        self.assertEqual(self.client.statuses, {'sleeper': 'active'})
+        self.assertEqual(self.loop.timeouts, [])
+
+    def test_pids(self):
+        version = self.client.version
+        self.event('sleeper', 'kill', process_pid=12)
+        self.assertEqual(self.client.pids, {'sleeper': set([13])})
+        self.event('sleeper', 'spawn', process_pid='14')
+        self.assertEqual(self.client.pids, {'sleeper': set([13, 14])})
+        self.assertGreater(self.client.version, version)
+        self.assertEqual(self.loop.timeouts, [])
+
+    def test_count_mismatch(self):
+        self.controller.query(ENDPOINT, 'list', name='sleeper')
+        self.event('sleeper', 'reap', process_pid=12)
+        # listed again by the next get_pids
+        self.assertNotIn('sleeper', self.client.pids)
+        self.assertEqual(self.controller.queries, {})
+        self.assertEqual(list(self.controller.refreshes),
+                         [(ENDPOINT, 'sleeper')])
+        self.loop.run_timeouts()
+        self.assertEqual(self.client.updated, ['sleeper'])
+        self.assertEqual(self.controller.refreshes, {})
+
+        # the next events of the watcher wait for the listing
+        self.event('sleeper', 'spawn', process_pid=16)
+        self.assertNotIn('sleeper', self.client.pids)
+
+    def test_unknown_watcher(self):
+        self.event('other', 'start')
+        self.assertEqual(list(self.controller.refreshes), [(ENDPOINT, None)])
+        # merged into the pending refresh of all the watchers
+        self.event('sleeper', 'updated')
+        self.assertEqual(len(self.loop.timeouts), 1)
+        self.loop.run_timeouts()
+        self.assertEqual(self.client.updated, [None])
+
+    def test_ignored(self):
+        self.event('circushttpd', 'start')
+        self.controller.on_watcher_event('tcp://127.0.0.1:5556', 'sleeper',
+                                         'stop', {})
+        self.assertEqual(self.client.statuses, {})
+        self.assertEqual(self.loop.timeouts, [])
+
+
+class TestCommands(ControllerTestCase):
+
+    @testing.gen_test
+    def test_refresh_after_batch(self):
+        yield self.controller.connect(ENDPOINT)
+        client = self.controller.get_client(ENDPOINT)
+        client.pids = {'sleeper': set([12])}
+        client.updated = []
+        client.replies['incr'] = {'status': 'ok', 'numprocesses': 2}
+
+        res = yield self.controller.incrproc('sleeper', ENDPOINT)
+        self.assertEqual(res['numprocesses'], 2)
+        yield gen.sleep(.01)
+        # only the watcher of the batch is refreshed, the pids are kept
+        self.assertEqual(client.updated, ['sleeper'])
+        self.assertEqual(client.pids, {'sleeper': set([12])})
+
+
+class TestQuery(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = FakeLoop()
+        self.controller = Controller(self.loop, query_ttl=5)
+        self.client = FakeClient()
+        self.client.hold = True
+        self.controller.clients['tcp://127.0.0.1:5555'] = self.client
+
+    def query(self, *args, **kwargs):
+        return self.controller.query('tcp://127.0.0.1:5555', *args, **kwargs)
+
+    def test_shared_in_flight(self):
+        first = self.query('list', name='sleeper')
+        self.assertIs(self.query('list', name='sleeper'), first)
+        self.assertIsNot(self.query('list', name='other'), first)
+        self.assertEqual(len(self.client.sent), 2)
+
+        self.client.futures[0].set_result({'pids': [1]})
+        # kept for query_ttl seconds
+        self.assertIs(self.query('list', name='sleeper'), first)
+        self.loop.run_timeouts()
+        self.assertIsNot(self.query('list', name='sleeper'), first)
+        self.assertEqual(len(self.client.sent), 3)
+
+    def test_fresh(self):
+        first = self.query('status')
+        second = self.query('status', fresh=True)
+        self.assertIsNot(second, first)
+        self.assertIs(self.query('status'), second)
+
+    def test_errors_are_not_kept(self):
+        first = self.query('status')
+        self.client.futures[0].set_exception(ValueError())
+        self.assertIsNot(self.query('status'), first)
+        self.assertEqual(self.loop.timeouts, [])
+
+    def test_forget_queries(self):
+        in_flight = self.query('list', name='sleeper')
+        done = self.query('status')
+        self.client.futures[1].set_result({'statuses': {}})
+        self.controller.forget_queries('tcp://127.0.0.1:5555')
+        self.assertEqual(self.controller.queries, {})
+        self.assertEqual(self.loop.timeouts, [])
+
+        # the reply of the forgotten query isn't kept
+        in_flight.set_result({'pids': [1]})
+        self.assertEqual(self.controller.queries, {})
+        self.assertIsNot(self.query('list', name='sleeper'), in_flight)
+        self.assertIsNot(self.query('status'), done)
+
+    def test_cached_replies_not_shared(self):
+        client = FakeClient()
+        self.controller.clients[ENDPOINT] = client
+        self.controller.get_statuses(ENDPOINT)
+        client.set_status('sleeper', 'stopped')
+        self.assertEqual(self.query('status').result()['statuses'],
+                         {'sleeper': 'active'})
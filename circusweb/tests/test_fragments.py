@@ -0,0 +1,30 @@
+import unittest
+
+from circusweb.fragments import FragmentCache
+
+
+class TestFragmentCache(unittest.TestCase):
+
+    def setUp(self):
+        self.renders = []
+
+    def render(self, content):
+        def render():
+            self.renders.append(content)
+            return content
+        return render
+
+    def test_rendered_again_when_the_version_changes(self):
+        cache = FragmentCache()
+        self.assertEqual(cache.get('ep', 1, self.render('a')), 'a')
+        self.assertEqual(cache.get('ep', 1, self.render('b')), 'a')
+        self.assertEqual(cache.get('ep', 2, self.render('c')), 'c')
+        self.assertEqual(self.renders, ['a', 'c'])
+
+    def test_max_size(self):
+        cache = FragmentCache(max_size=2)
+        cache.get('ep1', 1, self.render('a'))
+        cache.get('ep2', 1, self.render('b'))
+        cache.get('ep1', 1, self.render('a'))
+        cache.get('ep3', 1, self.render('c'))
+        self.assertEqual(list(cache.fragments), ['ep1', 'ep3'])
@@ -0,0 +1,101 @@
+import logging
+
+from tornado import gen, testing
+from tornado.concurrent import Future
+from tornado.web import create_signed_value
+
+from circusweb.circushttpd import Application
+from circusweb.session import MemoryBackend, Session, SessionManager
+from circusweb.tests.support import ENDPOINT
+from circusweb.tests.test_api import ENCODED, APITestCase
+
+
+class TestBaseHandler(APITestCase):
+
+    def setUp(self):
+        super(TestBaseHandler, self).setUp()
+        self.backend = SessionManager.backend
+        SessionManager.configure(MemoryBackend())
+        self.update = Future()
+
+    def tearDown(self):
+        SessionManager.release('a')
+        SessionManager.configure(self.backend)
+        super(TestBaseHandler, self).tearDown()
+
+    def make_client(self, loop, endpoint, **kwargs):
+        client = super(TestBaseHandler, self).make_client(loop, endpoint,
+                                                          **kwargs)
+        client.update = self.update
+        return client
+
+    def fetch_json(self, session_id):
+        cookie = create_signed_value(self._app.settings['cookie_secret'],
+                                     'session_id', session_id)
+        return self.http_client.fetch(
+            self.get_url('/%s/watcher/sleeper/aggregates/' % ENCODED),
+            follow_redirects=False,
+            headers={'Cookie': 'session_id=%s' % cookie.decode('ascii')})
+
+    @testing.gen_test
+    def test_restored_session(self):
+        # e.g. kept by a SQLiteBackend across a restart
+        session = Session()
+        session.endpoints.add(ENDPOINT)
+        SessionManager.save('a', session)
+
+        requests = [self.fetch_json('a') for __ in range(2)]
+        while not self.clients:
+            yield gen.moment
+        self.update.set_result(None)
+        responses = yield requests
+        # both waited for the client
+        self.assertEqual([response.code for response in responses],
+                         [200, 200])
+
+        # a single client, referenced once for the session
+        self.assertEqual(list(self.clients), [ENDPOINT])
+        self.assertEqual(self.clients[ENDPOINT].count, 1)
+        self.assertEqual(SessionManager.references, {'a': set([ENDPOINT])})
+
+        yield self.fetch_json('a')
+        self.assertEqual(self.clients[ENDPOINT].count, 1)
+
+        SessionManager.release('a')
+        self.assertTrue(self.clients[ENDPOINT].stopped)
+        self.assertEqual(SessionManager.references, {})
+
+    def test_session_not_loaded(self):
+        def load(session_id):
+            raise IOError('database is locked')
+
+        SessionManager.backend.load = load
+        errors = []
+        handler = logging.Handler()
+        handler.emit = errors.append
+        app_log = logging.getLogger('tornado.application')
+        app_log.addHandler(handler)
+        app_log.propagate = False
+        try:
+            response = self.fetch('/', headers={
+                'Cookie': 'session_id=%s' % create_signed_value(
+                    self._app.settings['cookie_secret'], 'session_id',
+                    'a').decode('ascii')})
+        finally:
+            app_log.removeHandler(handler)
+            app_log.propagate = True
+        self.assertEqual(response.code, 500)
+        # the error of the backend, and none of on_finish
+        self.assertEqual([record.exc_info[0] for record in errors],
+                         [IOError])
+
+
+class TestApplication(testing.AsyncTestCase):
+
+    def test_templates_encoding(self):
+        for debug in (True, False):
+            lookup = Application(debug=debug, autoreload=False).lookup
+            template = lookup.get_template('connect.html')
+            # the filters and encodings tomako used
+            self.assertEqual(template.default_filters, ['decode.utf8'])
+            self.assertEqual(template.output_encoding, 'utf-8')
@@ -0,0 +1,290 @@
+import functools
+import unittest
+from base64 import b64encode
+
+from tornado import testing
+
+from circusweb import controller
+from circusweb.controller import Controller
+from circusweb.namespace import StatsStream
+from circusweb.session import get_controller, set_controller
+from circusweb.tests.support import (ENDPOINT, STATS_ENDPOINT, FakeClient,
+                                     FakeConsumer)
+
+
+ENCODED = b64encode(ENDPOINT)
+ENCODED_STATS = b64encode(STATS_ENDPOINT)
+
+
+class FakeStream(StatsStream):
+
+    encoding = 'fake'
+    max_queue = 2
+    slow_timeout = 60.
+
+    def __init__(self):
+        self.init_stream()
+        self.queue = []
+        self.events = []
+        self.is_closed = False
+
+    def emit(self, name, **kwargs):
+        self.events.append((name, kwargs))
+
+    def encode(self, name, kwargs):
+        return name, kwargs
+
+    def send_encoded(self, name, message):
+        self.queue.append(message)
+
+    def queue_size(self):
+        return len(self.queue)
+
+    def close(self):
+        self.is_closed = True
+
+
+class TestBackpressure(unittest.TestCase):
+
+    def setUp(self):
+        self.stream = FakeStream()
+
+    def tearDown(self):
+        StatsStream.streams.discard(self.stream)
+
+    def test_coalesces_while_slow(self):
+        stream = self.stream
+        for i in range(4):
+            stream.deliver('a', i)
+        stream.deliver('b', 0)
+        self.assertEqual(stream.queue, [0, 1])
+        self.assertEqual(list(stream.coalesced.items()), [('a', 3), ('b', 0)])
+        self.assertEqual(stream.dropped, 1)
+        self.assertIsNotNone(stream.slow_since)
+
+        # the page caught up
+        stream.queue = []
+        stream.deliver('a', 4)
+        self.assertEqual(stream.queue, [3, 0])
+        self.assertEqual(list(stream.coalesced.items()), [('a', 4)])
+
+        stream.queue = []
+        stream.drain()
+        self.assertEqual(stream.queue, [4])
+        self.assertIsNone(stream.slow_since)
+
+    def test_evicts_the_pages_staying_slow(self):
+        stream = self.stream
+        stream.queue = [0, 1]
+        stream.deliver('a', 2)
+        self.assertFalse(stream.is_closed)
+
+        stream.slow_since -= 61
+        evicted = StatsStream.metrics['evicted']
+        stream.deliver('a', 3)
+        self.assertTrue(stream.is_closed)
+        self.assertEqual(StatsStream.metrics['evicted'], evicted + 1)
+
+
+class TestLazyStats(testing.AsyncTestCase):
+
+    def setUp(self):
+        super(TestLazyStats, self).setUp()
+        self.client_class = controller.AsynchronousCircusClient
+        self.consumer_class = controller.AsynchronousStatsConsumer
+        controller.AsynchronousCircusClient = FakeClient
+        controller.AsynchronousStatsConsumer = FakeConsumer
+        set_controller(Controller(self.io_loop, release_delay=0,
+                                  stats_on_demand=True))
+        self.streams = []
+
+    def tearDown(self):
+        for stream in self.streams:
+            stream.close_stream()
+        controller.AsynchronousCircusClient = self.client_class
+        controller.AsynchronousStatsConsumer = self.consumer_class
+        set_controller(None)
+        super(TestLazyStats, self).tearDown()
+
+    def open_page(self):
+        self.io_loop.run_sync(lambda: get_controller().connect(ENDPOINT))
+        stream = FakeStream()
+        stream.max_queue = 100
+        self.streams.append(stream)
+        self.io_loop.run_sync(functools.partial(
+            stream.get_stats, watchers=['sleeper'],
+            watchersWithPids=[['sleeper', ENCODED]], endpoints=[ENCODED],
+            stats_endpoints=[STATS_ENDPOINT], lazy=True))
+        return stream
+
+    def publish(self, pid):
+        StatsStream.consume_stats('sleeper', pid,
+                                  {'cpu': 1., 'mem': 2., 'age': 3.},
+                                  STATS_ENDPOINT)
+
+    @property
+    def topic_counts(self):
+        return get_controller().stats_clients[STATS_ENDPOINT].topic_counts
+
+    def test_lazy_page(self):
+        stream = self.open_page()
+        self.assertEqual(stream.events, [
+            ('stats-sleeper-pids-%s' % ENCODED, {'pids': [12]})])
+        self.assertEqual(self.topic_counts, {'stat.sleeper': 1})
+
+        self.publish('12')
+        self.publish(None)
+        self.assertEqual([name for name, __ in stream.queue],
+                         ['stats-sleeper-%s' % ENCODED_STATS])
+
+    def test_subscribe_pids(self):
+        stream = self.open_page()
+        stream.subscribe_pids('sleeper', ENCODED_STATS, [12])
+        self.assertEqual(self.topic_counts,
+                         {'stat.sleeper': 1, 'stat.sleeper.12': 1})
+        self.publish('12')
+        self.assertEqual(stream.queue, [
+            ('stats-sleeper-12-%s' % ENCODED_STATS,
+             {'cpu': 1., 'mem': 2., 'age': 3.})])
+
+        stream.queue = []
+        stream.unsubscribe_pids('sleeper', ENCODED_STATS, [12])
+        self.assertEqual(self.topic_counts, {'stat.sleeper': 1})
+        self.publish('12')
+        self.assertEqual(stream.queue, [])
+
+    def test_subscriptions_shared(self):
+        first, second = self.open_page(), self.open_page()
+        for stream in (first, second):
+            stream.subscribe_pids('sleeper', ENCODED_STATS, [12])
+        # subscribed once for both pages
+        self.assertEqual(self.topic_counts['stat.sleeper.12'], 1)
+
+        first.unsubscribe_pids('sleeper', ENCODED_STATS, [12])
+        self.assertEqual(self.topic_counts['stat.sleeper.12'], 1)
+        self.publish('12')
+        self.assertEqual(len(first.queue), 0)
+        self.assertEqual(len(second.queue), 1)
+
+        second.unsubscribe_pids('sleeper', ENCODED_STATS, [12])
+        self.assertNotIn('stat.sleeper.12', self.topic_counts)
+
+    def test_history(self):
+        get_controller().consume_stats('sleeper', '12', sample(),
+                                       STATS_ENDPOINT)
+        stream = self.open_page()
+        stream.events = []
+        stream.emit_history(get_controller(), [
+            ('sleeper', [12], ENDPOINT),
+            ('sleeper', [12], 'tcp://127.0.0.1:5556')])
+        self.assertEqual([name for name, __ in stream.events],
+                         ['history-stats-sleeper-12-%s' % ENCODED_STATS])
+
+    def test_closed_while_listing(self):
+        self.io_loop.run_sync(lambda: get_controller().connect(ENDPOINT))
+        listings = []
+        get_controller().get_pids = (
+            lambda name, endpoint, callback: listings.append(callback))
+        stream = FakeStream()
+        future = stream.get_stats(
+            watchers=['sleeper'], watchersWithPids=[['sleeper', ENCODED]],
+            endpoints=[ENCODED], stats_endpoints=[STATS_ENDPOINT])
+        stream.close()
+        stream.close_stream()
+        listings[0]([12])
+        self.io_loop.run_sync(lambda: future)
+
+        # no reference left behind by the closed page
+        self.assertEqual(get_controller().stats_clients, {})
+        self.assertNotIn(stream, StatsStream.participants[STATS_ENDPOINT])
+        self.assertEqual(stream.events, [])
+
+    def test_unknown_stats_endpoint(self):
+        stream = self.open_page()
+        stream.subscribe_pids('sleeper', b64encode('tcp://127.0.0.1:1'), [12])
+        self.assertEqual(self.topic_counts, {'stat.sleeper': 1})
+
+
+def sample(cpu=1., mem=2., age=3.):
+    return {'cpu': cpu, 'mem': mem, 'age': age}
+
+
+class TestCompact(unittest.TestCase):
+
+    def setUp(self):
+        self.stream = FakeStream()
+        self.stream.compact = True
+        self.stream.max_queue = 100
+        self.other = FakeStream()
+        self.other.max_queue = 100
+
+    def tearDown(self):
+        for stream in (self.stream, self.other):
+            StatsStream.streams.discard(stream)
+        if StatsStream._flush_callback is not None:
+            StatsStream._flush_callback.stop()
+            StatsStream._flush_callback = None
+        StatsStream.batch_window = None
+        StatsStream.batched = set()
+
+    def test_channel_ids(self):
+        stream = self.stream
+        stream.send_compact([('a', [sample()]), ('b', [sample()])])
+        stream.send_compact([('b', [sample()]), ('c', [sample()])])
+        stream.send_compact([('a', [sample()])])
+        # each channel is told once to the page
+        self.assertEqual(stream.events, [
+            ('stats-channels', {'channels': {'a': 0, 'b': 1}}),
+            ('stats-channels', {'channels': {'c': 2}})])
+        self.assertEqual([data['data'][::4] for __, data in stream.queue],
+                         [[0, 1], [1, 2], [0]])
+
+    def test_layout(self):
+        self.stream.send_compact([
+            ('a', [sample(12.345, 1.06, 10.9), sample(0., 0.04, 11.)])])
+        self.assertEqual(self.stream.queue, [
+            ('stats-compact', {'data': [0, 12.3, 1.1, 10, 0, 0., 0., 11]})])
+
+    def test_broadcast(self):
+        streams = set([self.stream, self.other])
+        StatsStream.broadcast(streams, 'stats-a', **sample())
+        # not cpu, mem and age
+        StatsStream.broadcast(streams, 'socket-stats-a', reads=1)
+        self.assertEqual(self.stream.queue, [
+            ('stats-compact', {'data': [0, 1., 2., 3]}),
+            ('socket-stats-a', {'reads': 1})])
+        self.assertEqual(self.other.queue, [('stats-a', sample()),
+                                            ('socket-stats-a', {'reads': 1})])
+
+    def test_batched(self):
+        StatsStream.batch_window = 1.
+        streams = set([self.stream, self.other])
+        StatsStream.broadcast(streams, 'stats-a', **sample(1.))
+        StatsStream.broadcast(streams, 'stats-a', **sample(2.))
+        StatsStream.broadcast(streams, 'socket-stats-a', reads=1)
+        self.assertEqual(self.stream.queue, [])
+
+        StatsStream.flush_stats()
+        self.assertEqual(self.stream.queue, [
+            ('stats-compact', {'data': [0, 1., 2., 3, 0, 2., 2., 3]}),
+            ('stats-batch', {'frames': {'socket-stats-a': [{'reads': 1}]}})])
+        self.assertEqual(self.other.queue, [
+            ('stats-batch', {'frames': {
+                'stats-a': [sample(1.), sample(2.)],
+                'socket-stats-a': [{'reads': 1}]}})])
+
+    def test_flush_callback_stopped(self):
+        StatsStream.batch_window = 1.
+        StatsStream.broadcast(set([self.stream]), 'stats-a', **sample())
+        callback = StatsStream._flush_callback
+        self.assertTrue(callback.is_running())
+
+        StatsStream.flush_stats()
+        self.assertIs(StatsStream._flush_callback, callback)
+
+        # the page is gone
+        StatsStream.streams.discard(self.stream)
+        StatsStream.streams.discard(self.other)
+        StatsStream.flush_stats()
+        self.assertFalse(callback.is_running())
+        self.assertIsNone(StatsStream._flush_callback)
@@ -0,0 +1,88 @@
+import unittest
+
+import zmq
+
+from circusweb.relay import StatsRelay, make_topic
+from circusweb.tests.support import STATS_ENDPOINT
+
+
+class FakeSocket(object):
+
+    def __init__(self):
+        self.options = []
+
+    def setsockopt(self, option, value):
+        self.options.append((option, value))
+
+
+class FakeStream(object):
+
+    def __init__(self):
+        self.socket = FakeSocket()
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def make_relay():
+    relay = StatsRelay.__new__(StatsRelay)
+    relay.upstreams = {}
+    relay.connected = []
+
+    def connect(endpoint):
+        relay.connected.append(endpoint)
+        relay.upstreams[endpoint] = FakeStream(), set()
+
+    relay.connect = connect
+    return relay
+
+
+def subscription(topic, endpoint=STATS_ENDPOINT, subscribe=True):
+    """Returns the message of the XPUB socket for a SUB socket subscribing
+    to *topic* of *endpoint* through the relay."""
+    return [('\x01' if subscribe else '\x00') + make_topic(endpoint, topic)]
+
+
+class TestStatsRelay(unittest.TestCase):
+
+    def setUp(self):
+        self.relay = make_relay()
+
+    def test_subscribe(self):
+        self.relay.handle_subscription(subscription('stat.sleeper'))
+        self.relay.handle_subscription(subscription('stat.other'))
+        # connected once to the endpoint
+        self.assertEqual(self.relay.connected, [STATS_ENDPOINT])
+        stream, topics = self.relay.upstreams[STATS_ENDPOINT]
+        self.assertEqual(topics, set(['stat.sleeper', 'stat.other']))
+        self.assertEqual(stream.socket.options,
+                         [(zmq.SUBSCRIBE, 'stat.sleeper'),
+                          (zmq.SUBSCRIBE, 'stat.other')])
+
+    def test_unsubscribe(self):
+        for topic in ('stat.sleeper', 'stat.other'):
+            self.relay.handle_subscription(subscription(topic))
+        stream, topics = self.relay.upstreams[STATS_ENDPOINT]
+
+        self.relay.handle_subscription(subscription('stat.sleeper',
+                                                    subscribe=False))
+        self.assertEqual(topics, set(['stat.other']))
+        self.assertEqual(stream.socket.options[-1],
+                         (zmq.UNSUBSCRIBE, 'stat.sleeper'))
+        self.assertFalse(stream.closed)
+
+        # closed with the last topic
+        self.relay.handle_subscription(subscription('stat.other',
+                                                    subscribe=False))
+        self.assertTrue(stream.closed)
+        self.assertEqual(self.relay.upstreams, {})
+
+    def test_unknown(self):
+        # an endpoint the relay isn't connected to
+        self.relay.handle_subscription(subscription('stat.sleeper',
+                                                    subscribe=False))
+        # no endpoint in the topic
+        self.relay.handle_subscription(['\x01stat.sleeper'])
+        self.assertEqual(self.relay.connected, [])
+        self.assertEqual(self.relay.upstreams, {})
@@ -0,0 +1,111 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from circusweb.session import (MemoryBackend, SQLiteBackend, Session,
+                               SessionManager, set_controller)
+
+
+class FakeController(object):
+
+    def __init__(self):
+        self.disconnected = []
+
+    def disconnect(self, endpoint):
+        self.disconnected.append(endpoint)
+
+
+class BackendTestMixin(object):
+
+    def make_session(self, accessed, endpoints=()):
+        session = Session()
+        session.accessed = accessed
+        session.endpoints.update(endpoints)
+        return session
+
+    def test_load_save(self):
+        self.assertIsNone(self.backend.load('unknown'))
+        self.backend.save('a', self.make_session(1., ['tcp://127.0.0.1:5555']))
+        session = self.backend.load('a')
+        self.assertEqual(session.endpoints, set(['tcp://127.0.0.1:5555']))
+        self.assertEqual(len(self.backend), 1)
+
+        self.backend.delete('a')
+        self.assertIsNone(self.backend.load('a'))
+        self.assertEqual(len(self.backend), 0)
+
+    def test_expire_idle(self):
+        self.backend.save('old', self.make_session(1.))
+        self.backend.save('new', self.make_session(10.))
+
+        expired = self.backend.expire(5., 100)
+        self.assertEqual([session_id for session_id, __ in expired], ['old'])
+        self.assertIsNone(self.backend.load('old'))
+        self.assertIsNotNone(self.backend.load('new'))
+
+    def test_expire_least_recently_used(self):
+        for i in range(5):
+            self.backend.save(str(i), self.make_session(float(i)))
+
+        expired = self.backend.expire(0., 3)
+        self.assertEqual(sorted(session_id for session_id, __ in expired),
+                         ['0', '1'])
+        self.assertEqual(len(self.backend), 3)
+
+
+class TestMemoryBackend(BackendTestMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.backend = MemoryBackend()
+
+
+class TestSQLiteBackend(BackendTestMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.backend = SQLiteBackend(os.path.join(self.dir, 'sessions.db'))
+
+    def tearDown(self):
+        self.backend.db.close()
+        shutil.rmtree(self.dir)
+
+    def test_survives_restarts(self):
+        self.backend.save('a', self.make_session(1., ['tcp://127.0.0.1:5555']))
+        backend = SQLiteBackend(self.backend.path)
+        self.assertEqual(backend.load('a').endpoints,
+                         set(['tcp://127.0.0.1:5555']))
+
+
+class TestSessionManager(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = SessionManager.backend
+        SessionManager.configure(MemoryBackend())
+        self.controller = FakeController()
+        set_controller(self.controller)
+
+    def tearDown(self):
+        SessionManager.references = {}
+        set_controller(None)
+        SessionManager.configure(self.backend)
+
+    def test_new_sessions_are_stored_once_saved(self):
+        session = SessionManager.new('a')
+        self.assertIsNone(SessionManager.get('a'))
+        SessionManager.save('a', session)
+        self.assertIs(SessionManager.get('a'), session)
+
+    def test_expire_releases_the_references(self):
+        for session_id in ('a', 'b', 'c'):
+            SessionManager.save(session_id, Session())
+            SessionManager.hold(session_id, 'tcp://127.0.0.1:5555')
+        SessionManager.backend.sessions['a'].accessed = 0.
+        # removed by another process sharing the sessions
+        SessionManager.delete('b')
+
+        SessionManager.expire()
+        self.assertEqual(self.controller.disconnected,
+                         ['tcp://127.0.0.1:5555'] * 2)
+        self.assertEqual(SessionManager.references,
+                         {'c': set(['tcp://127.0.0.1:5555'])})
@@ -0,0 +1,119 @@
+import json
+import unittest
+from collections import OrderedDict
+
+import zmq
+from tornado.concurrent import Future
+
+from circusweb.stats_client import AsynchronousStatsConsumer, decode_messages
+
+
+class FakeSocket(object):
+
+    def __init__(self, messages):
+        self.messages = list(messages)
+
+    def recv_multipart(self, flags=0):
+        if not self.messages:
+            raise zmq.Again()
+        return self.messages.pop(0)
+
+
+class FakeExecutor(object):
+    """Runs the calls submitted when asked to, see run."""
+
+    def __init__(self):
+        self.calls = []
+
+    def submit(self, fn, *args):
+        future = Future()
+        self.calls.append((future, fn, args))
+        return future
+
+    def run(self):
+        future, fn, args = self.calls.pop(0)
+        future.set_result(fn(*args))
+
+
+class FakeLoop(object):
+
+    def add_future(self, future, callback):
+        future.add_done_callback(callback)
+
+
+class FakeStream(object):
+
+    def receiving(self):
+        return True
+
+
+def make_consumer(messages, burst_size, executor=None):
+    consumer = AsynchronousStatsConsumer.__new__(AsynchronousStatsConsumer)
+    consumer.pubsub_socket = FakeSocket(messages)
+    consumer.prefix = ''
+    consumer.endpoint = 'tcp://127.0.0.1:5557'
+    consumer.burst_size = burst_size
+    consumer.executor = executor
+    consumer.loop = FakeLoop()
+    consumer.stream = FakeStream()
+    consumer.decoding = False
+    consumer.waiting = OrderedDict()
+    consumer.received = consumer.skipped = 0
+    consumer.stats = []
+    consumer.callback = lambda *args: consumer.stats.append(args[:3])
+    return consumer
+
+
+def stat(topic, **kwargs):
+    return [topic, json.dumps(kwargs)]
+
+
+class TestStatsConsumer(unittest.TestCase):
+
+    def test_decode_messages(self):
+        messages = [stat('xstat.sleeper.12', cpu=1),
+                    stat('xstat.sleeper', cpu=2),
+                    stat('xstat', cpu=3)]
+        self.assertEqual(decode_messages(messages, 1),
+                         [('sleeper', '12', {'cpu': 1}),
+                          ('sleeper', None, {'cpu': 2})])
+
+    def test_burst_keeps_latest(self):
+        consumer = make_consumer([stat('stat.sleeper.12', cpu=2),
+                                  stat('stat.circus', name='circusd'),
+                                  stat('stat.circus', name='circusd-stats'),
+                                  stat('stat.sleeper.12', cpu=3),
+                                  stat('stat.sleeper', cpu=4)], 10)
+        consumer.process_burst(stat('stat.sleeper.12', cpu=1))
+        self.assertEqual(consumer.stats,
+                         [('circus', None, {'name': 'circusd'}),
+                          ('circus', None, {'name': 'circusd-stats'}),
+                          ('sleeper', '12', {'cpu': 3}),
+                          ('sleeper', None, {'cpu': 4})])
+        self.assertEqual((consumer.received, consumer.skipped), (6, 2))
+
+    def test_burst_size(self):
+        consumer = make_consumer([stat('stat.sleeper.12', cpu=2),
+                                  stat('stat.sleeper.12', cpu=3)], 2)
+        consumer.process_burst(stat('stat.sleeper.12', cpu=1))
+        self.assertEqual(consumer.stats, [('sleeper', '12', {'cpu': 2})])
+        self.assertEqual(len(consumer.pubsub_socket.messages), 1)
+
+    def test_single_burst_decoded(self):
+        executor = FakeExecutor()
+        consumer = make_consumer([], 10, executor)
+        for cpu in range(1, 4):
+            consumer.process_burst(stat('stat.sleeper.12', cpu=cpu))
+        consumer.process_burst(stat('stat.sleeper', cpu=4))
+        self.assertEqual(len(executor.calls), 1)
+
+        executor.run()
+        self.assertEqual(consumer.stats, [('sleeper', '12', {'cpu': 1})])
+        # the bursts read meanwhile, merged
+        self.assertEqual(len(executor.calls), 1)
+        executor.run()
+        self.assertEqual(consumer.stats[1:], [('sleeper', '12', {'cpu': 3}),
+                                              ('sleeper', None, {'cpu': 4})])
+        self.assertEqual((consumer.received, consumer.skipped), (4, 1))
+        self.assertFalse(consumer.decoding)
+        self.assertEqual(executor.calls, [])
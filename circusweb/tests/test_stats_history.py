@@ -0,0 +1,96 @@
+import unittest
+
+from circusweb.stats_history import RingBuffer, StatsAggregates, StatsHistory
+
+
+class TestRingBuffer(unittest.TestCase):
+
+    def test_keeps_the_last_samples(self):
+        buf = RingBuffer(3)
+        for i in range(5):
+            buf.append(float(i), i * 10)
+
+        self.assertEqual(len(buf), 3)
+        self.assertEqual(buf.since(), [(2., 20.), (3., 30.), (4., 40.)])
+        self.assertEqual(buf.since(3.), [(4., 40.)])
+        self.assertEqual(buf.last_time, 4.)
+
+    def test_empty(self):
+        buf = RingBuffer(3)
+        self.assertEqual(buf.since(), [])
+        self.assertEqual(buf.last_time, 0.)
+
+
+class TestStatsHistory(unittest.TestCase):
+
+    def test_get_samples(self):
+        history = StatsHistory(size=10)
+        history.add('ep', 'sleeper', 12, {'cpu': 1., 'mem': 2.}, 1.)
+        history.add('ep', 'sleeper', 12, {'cpu': 3., 'mem': 4.}, 2.)
+        history.add('ep', 'sleeper', None, {'cpu': 5., 'mem': 6.}, 2.)
+
+        self.assertEqual(history.get_samples('ep', 'sleeper', 12),
+                         [{'time': 1., 'cpu': 1., 'mem': 2.},
+                          {'time': 2., 'cpu': 3., 'mem': 4.}])
+        self.assertEqual(history.get_samples('ep', 'sleeper', 12, since=1.),
+                         [{'time': 2., 'cpu': 3., 'mem': 4.}])
+        self.assertEqual(history.get('ep', 'sleeper', None, 'cpu'),
+                         [(2., 5.)])
+        self.assertEqual(history.get_samples('ep', 'other', None), [])
+
+    def test_max_series(self):
+        history = StatsHistory(size=10, max_series=2)
+        history.add('ep', 'sleeper', 1, {'cpu': 1.}, 1.)
+        history.add('ep', 'sleeper', 2, {'cpu': 1.}, 3.)
+        history.add('ep', 'sleeper', 3, {'cpu': 1.}, 4.)
+
+        # the process which sent its stats the longest ago is dropped
+        self.assertEqual(len(history.series), 2)
+        self.assertEqual(history.get('ep', 'sleeper', 1, 'cpu'), [])
+        self.assertEqual(history.get('ep', 'sleeper', 3, 'cpu'), [(4., 1.)])
+
+    def test_evicts_the_least_recently_updated(self):
+        history = StatsHistory(size=10, max_series=2)
+        history.add('ep', 'sleeper', 1, {'cpu': 1.}, 1.)
+        history.add('ep', 'sleeper', 2, {'cpu': 1.}, 2.)
+        history.add('ep', 'sleeper', 1, {'cpu': 2.}, 3.)
+        history.add('ep', 'sleeper', 3, {'cpu': 1.}, 4.)
+
+        self.assertEqual(history.get('ep', 'sleeper', 1, 'cpu'),
+                         [(1., 1.), (3., 2.)])
+        self.assertEqual(history.get('ep', 'sleeper', 2, 'cpu'), [])
+
+
+class TestStatsAggregates(unittest.TestCase):
+
+    def test_buckets(self):
+        aggregates = StatsAggregates(size=2, tiers=(10, 60))
+        for timestamp, cpu in ((600., 1.), (605., 3.), (612., 8.),
+                               (625., 2.), (661., 4.)):
+            aggregates.add('ep', 'sleeper', None, {'cpu': cpu}, timestamp)
+
+        # only the last two closed buckets are kept, plus the current one
+        self.assertEqual(
+            aggregates.get('ep', 'sleeper', None, 'cpu', 10),
+            [{'time': 610., 'min': 8., 'max': 8., 'avg': 8.},
+             {'time': 620., 'min': 2., 'max': 2., 'avg': 2.},
+             {'time': 660., 'min': 4., 'max': 4., 'avg': 4.}])
+        self.assertEqual(
+            aggregates.get('ep', 'sleeper', None, 'cpu', 60),
+            [{'time': 600., 'min': 1., 'max': 8., 'avg': 3.5},
+             {'time': 660., 'min': 4., 'max': 4., 'avg': 4.}])
+        self.assertEqual(
+            aggregates.get('ep', 'sleeper', None, 'cpu', 60, since=600.),
+            [{'time': 660., 'min': 4., 'max': 4., 'avg': 4.}])
+        self.assertEqual(aggregates.get('ep', 'sleeper', None, 'mem', 60),
+                         [])
+
+    def test_max_series(self):
+        aggregates = StatsAggregates(size=2, max_series=2, tiers=(10,))
+        aggregates.add('ep', 'sleeper', 1, {'cpu': 1.}, 1.)
+        aggregates.add('ep', 'sleeper', 2, {'cpu': 1.}, 2.)
+        aggregates.add('ep', 'sleeper', 1, {'cpu': 2.}, 3.)
+        aggregates.add('ep', 'sleeper', 3, {'cpu': 1.}, 4.)
+
+        self.assertEqual(list(aggregates.series), [
+            ('ep', 'sleeper', 1, 'cpu'), ('ep', 'sleeper', 3, 'cpu')])
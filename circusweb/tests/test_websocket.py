@@ -0,0 +1,130 @@
+import json
+from base64 import b64encode
+
+from tornado import gen, testing
+from tornado.websocket import websocket_connect
+
+from circusweb.controller import Controller
+from circusweb.namespace import StatsStream
+from circusweb.session import get_controller, set_controller
+from circusweb.tests.support import ENDPOINT, STATS_ENDPOINT
+from circusweb.tests.test_api import ENCODED, APITestCase
+
+
+GET_STATS = json.dumps({'name': 'get_stats', 'args': [{
+    'watchers': ['sleeper'], 'watchersWithPids': [['sleeper', ENCODED]],
+    'endpoints': [ENCODED], 'stats_endpoints': [STATS_ENDPOINT]}]})
+STATS_CHANNEL = 'stats-sleeper-%s' % b64encode(STATS_ENDPOINT)
+
+
+def publish(cpu):
+    StatsStream.consume_stats('sleeper', None,
+                              {'cpu': cpu, 'mem': 1., 'age': 10.},
+                              STATS_ENDPOINT)
+
+
+class TestStatsWebSocket(APITestCase):
+
+    def setUp(self):
+        super(TestStatsWebSocket, self).setUp()
+        set_controller(Controller(self.io_loop, release_delay=0,
+                                  stats_on_demand=True))
+
+    def tearDown(self):
+        # the streams of a failed test
+        for stream in list(StatsStream.streams):
+            stream.close_stream()
+        super(TestStatsWebSocket, self).tearDown()
+
+    @gen.coroutine
+    def connect(self):
+        """Returns the websocket of a page and its stream in the server."""
+        yield get_controller().connect(ENDPOINT)
+        url = self.get_url('/stats/websocket').replace('http', 'ws', 1)
+        ws = yield websocket_connect(url, io_loop=self.io_loop)
+        while not StatsStream.streams:
+            yield gen.sleep(.001)
+        stream, = StatsStream.streams
+        raise gen.Return((ws, stream))
+
+    @gen.coroutine
+    def disconnect(self, ws):
+        ws.close()
+        while StatsStream.streams:
+            yield gen.sleep(.001)
+
+    @gen.coroutine
+    def read(self, ws):
+        message = yield ws.read_message()
+        raise gen.Return(json.loads(message))
+
+    @gen.coroutine
+    def get_stats(self, ws):
+        ws.write_message(GET_STATS)
+        event = yield self.read(ws)
+        self.assertEqual(event, {'name': 'stats-sleeper-pids-%s' % ENCODED,
+                                 'args': [{'pids': [12]}]})
+
+    @testing.gen_test
+    def test_get_stats(self):
+        ws, stream = yield self.connect()
+        yield self.get_stats(ws)
+        consumer = get_controller().stats_clients[STATS_ENDPOINT]
+        self.assertEqual(consumer.topic_counts,
+                         {'stat.sleeper': 1, 'stat.sleeper.': 1})
+
+        publish(.5)
+        event = yield self.read(ws)
+        self.assertEqual(event, {'name': STATS_CHANNEL, 'args': [
+            {'cpu': .5, 'mem': 1., 'age': 10.}]})
+
+        yield self.disconnect(ws)
+        self.assertEqual(consumer.topic_counts, {})
+
+    @testing.gen_test
+    def test_invalid_messages(self):
+        ws, stream = yield self.connect()
+        for message in ['garbage', '[]', '{"args": [{}]}',
+                        '{"name": "close_stream"}',
+                        '{"name": "get_stats", "args": [[1]]}',
+                        '{"name": "subscribe_pids", "args": [{"a": 1}]}']:
+            ws.write_message(message)
+        with testing.ExpectLog('circus-web', 'The get_stats event failed'):
+            ws.write_message('{"name": "get_stats", "args": [{"a": 1}]}')
+            # the messages are handled in order
+            yield self.get_stats(ws)
+        self.assertFalse(stream.is_closed)
+        self.assertEqual(stream.stats_endpoints, [STATS_ENDPOINT])
+        yield self.disconnect(ws)
+
+    @testing.gen_test
+    def test_coalesces_while_writing(self):
+        ws, stream = yield self.connect()
+        yield self.get_stats(ws)
+
+        # the page doesn't read its messages fast enough
+        stream.in_flight = stream.max_queue
+        for cpu in (1., 2., 3.):
+            publish(cpu)
+        self.assertEqual(stream.dropped, 2)
+        self.assertEqual(list(stream.coalesced), [STATS_CHANNEL])
+
+        # one of the writes completed
+        stream.on_written(None)
+        self.assertEqual(stream.coalesced, {})
+        event = yield self.read(ws)
+        self.assertEqual(event['args'][0]['cpu'], 3.)
+        yield self.disconnect(ws)
+
+    @testing.gen_test
+    def test_heartbeat(self):
+        ws, stream = yield self.connect()
+        stream.check_heartbeat()
+        self.assertFalse(stream.is_closed)
+
+        stream.last_pong -= stream.heartbeat_timeout + 1
+        stream.check_heartbeat()
+        message = yield ws.read_message()
+        self.assertIsNone(message)
+        while StatsStream.streams:
+            yield gen.sleep(.001)
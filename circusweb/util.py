@@ -1,6 +1,7 @@
 import json
 import socket
 import sys
+from datetime import timedelta
 
 from six.moves.urllib.parse import urlparse
 from tornado import ioloop
@@ -44,6 +45,30 @@ def run_command(command, message, endpoint, redirect_url,
     raise gen.Return(redirect_url)
 
 
+@gen.coroutine
+def gather(futures, deadline):
+    """Waits for a {key: future} mapping, at most *deadline* seconds for
+    each future.
+
+    Returns three dicts: the results, the errors and the futures still
+    pending once the deadline expired, each by key.
+    """
+    results, errors, pending = {}, {}, {}
+
+    @gen.coroutine
+    def wait(key, future):
+        try:
+            results[key] = yield gen.with_timeout(
+                timedelta(seconds=deadline), future)
+        except gen.TimeoutError:
+            pending[key] = future
+        except Exception as e:
+            errors[key] = e
+
+    yield [wait(key, future) for key, future in futures.items()]
+    raise gen.Return((results, errors, pending))
+
+
 class AutoDiscovery(object):
 
     def __init__(self, multicast_endpoint, loop, rediscover_timeout=10):
@@ -0,0 +1,111 @@
+"""The stats stream over a plain WebSocket.
+
+The events are the ones of the socket.io stream, each message is a JSON
+object such as {"name": "get_stats", "args": [{...}]} in both directions.
+The connection is pinged every *heartbeat_interval* seconds and closed
+when it stops answering. The messages not written yet count as the queue
+of the page, see StatsStream for what happens when it grows.
+"""
+import functools
+import json
+import time
+
+from tornado.ioloop import PeriodicCallback
+from tornado.websocket import WebSocketClosedError, WebSocketHandler
+
+from circusweb import logger
+from circusweb.namespace import StatsStream
+
+
+class StatsWebSocket(StatsStream, WebSocketHandler):
+
+    # events the pages may send
+    events = ('get_stats', 'subscribe_pids', 'unsubscribe_pids')
+    encoding = 'websocket'
+
+    heartbeat_interval = 15.
+    # seconds without pong after which the connection is closed
+    heartbeat_timeout = 45.
+
+    def open(self):
+        self.init_stream()
+        # messages given to the stream and not written yet
+        self.in_flight = 0
+        self.last_pong = time.time()
+        self.heartbeat = PeriodicCallback(self.check_heartbeat,
+                                          self.heartbeat_interval * 1000)
+        self.heartbeat.start()
+
+    def on_close(self):
+        self.heartbeat.stop()
+        self.close_stream()
+
+    def check_heartbeat(self):
+        if time.time() - self.last_pong > self.heartbeat_timeout:
+            logger.debug('Closing an unresponsive stats websocket')
+            self.close()
+            return
+        try:
+            self.ping(b'')
+        except WebSocketClosedError:
+            pass
+
+    def on_pong(self, data):
+        self.last_pong = time.time()
+
+    def on_message(self, message):
+        try:
+            event = json.loads(message)
+            name = event['name']
+            kwargs = (event.get('args') or [{}])[0]
+        except (ValueError, KeyError, IndexError, TypeError):
+            logger.debug('Invalid stats websocket message %r' % message)
+            return
+        if name not in self.events or not isinstance(kwargs, dict):
+            return
+        try:
+            future = getattr(self, name)(**kwargs)
+        except TypeError as e:
+            logger.debug('Invalid %s event: %s' % (name, e))
+            return
+        if future is not None:
+            # e.g. get_stats, nobody else waits for it
+            future.add_done_callback(functools.partial(self.on_event_done,
+                                                       name))
+
+    def on_event_done(self, name, future):
+        if future.exception() is not None:
+            logger.error('The %s event failed: %s' % (name,
+                                                      future.exception()))
+
+    @property
+    def is_closed(self):
+        return self.ws_connection is None
+
+    def encode(self, name, kwargs):
+        return json.dumps({'name': name, 'args': [kwargs]})
+
+    def emit(self, name, **kwargs):
+        self.write_frame(self.encode(name, kwargs))
+
+    def send_encoded(self, name, message):
+        self.write_frame(message)
+
+    def queue_size(self):
+        return self.in_flight
+
+    def write_frame(self, message):
+        if self.is_closed:
+            return
+        try:
+            future = self.write_message(message)
+        except WebSocketClosedError:
+            return
+        if future is not None:
+            self.in_flight += 1
+            future.add_done_callback(self.on_written)
+
+    def on_written(self, future):
+        self.in_flight -= 1
+        if self.coalesced and not self.is_closed:
+            self.drain()
@@ -2,17 +2,12 @@ import sys
 from setuptools import setup, find_packages
 from circusweb import __version__
 
-if not hasattr(sys, 'version_info') or sys.version_info < (2, 6, 0, 'final'):
-    raise SystemExit("Circus requires Python 2.6 or later.")
+if not hasattr(sys, 'version_info') or sys.version_info < (2, 7, 0, 'final'):
+    raise SystemExit("Circus requires Python 2.7 or later.")
 
 
 install_requires = ['Mako', 'MarkupSafe', 'anyjson', 'six',
-                    'pyzmq', 'circus', 'tornado', 'tornadIO2==0.0.3', 'tomako']
-
-try:
-    import argparse     # NOQA
-except ImportError:
-    install_requires.append('argparse')
+                    'pyzmq', 'circus', 'tornado', 'tornadIO2==0.0.3']
 
 with open("README.rst") as f:
     README = f.read()
@@ -32,7 +27,6 @@ setup(name='circus-web',
       zip_safe=False,
       classifiers=[
           "Programming Language :: Python",
-          "Programming Language :: Python :: 2.6",
           "Programming Language :: Python :: 2.7",
           "License :: OSI Approved :: Apache Software License",
           "Development Status :: 3 - Alpha"],